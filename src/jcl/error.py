@@ -24,7 +24,7 @@
 
 __revision__ = "$Id: error.py,v 1.1 2006/11/05 20:13:48 dax Exp $"
 
-from jcl.lang import Lang
+from jcl.lang import Lang, get_label
 
 class FieldError(Exception):
     """Error raised when error exists on Jabber Data Form fields"""
@@ -42,9 +42,9 @@ class FieldError(Exception):
         full_message = ""
         if self.detailed_message is not None:
             full_message = self.detailed_message
-        elif self.message_property is not None \
-                and hasattr(self.lang_class, self.message_property):
-            full_message = str(getattr(self.lang_class, self.message_property))
+        elif self.message_property is not None:
+            full_message = str(get_label(self.lang_class,
+                                         self.message_property, ""))
         return self.lang_class.field_error % (str(self.field), full_message)
 
 class MandatoryFieldError(FieldError):
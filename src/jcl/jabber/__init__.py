@@ -4,9 +4,19 @@ __revision__ = ""
 import jcl.model.account as account
 from jcl.model.account import Account
 
+# Kinds of stanza receiver a handler can be routed to
+ROOT = "root"
+ACCOUNT_TYPE = "account_type"
+ACCOUNT = "account"
+
 class Handler(object):
     """handling class"""
 
+    # kinds of stanza receiver (ROOT, ACCOUNT_TYPE, ACCOUNT) the handler
+    # filter can accept, used when the filter function does not declare
+    # them (see routed_filter). None to try the handler with every stanza
+    routes = None
+
     def __init__(self, component):
         """Default Handler constructor"""
         self.component = component
@@ -26,6 +36,19 @@ class Handler(object):
         """
         return []
 
+def routed_filter(routes, shared=False):
+    """
+    Decorator declaring the kinds of stanza receiver `routes` accepted by a
+    filter function. Results of `shared` filters do not depend on the
+    handler and are computed once per stanza by
+    JCLComponent.apply_registered_behavior.
+    """
+    def decorate(filter_func):
+        filter_func.routes = routes
+        filter_func.shared = shared
+        return filter_func
+    return decorate
+
 def root_filter(self, stanza, lang_class, node=None):
     """Filter stanza sent to root node"""
     to_jid = stanza.get_to()
@@ -33,6 +56,7 @@ def root_filter(self, stanza, lang_class, node=None):
         return True
     else:
         return None
+root_filter = routed_filter((ROOT,))(root_filter)
 
 def account_type_filter(self, stanza, lang_class, node=None):
     """Filter stanzas sent to account type node"""
@@ -42,11 +66,13 @@ def account_type_filter(self, stanza, lang_class, node=None):
         return account_type
     else:
         return None
+account_type_filter = routed_filter((ACCOUNT_TYPE,))(account_type_filter)
 
 def account_filter(self, stanza, lang_class, node=None):
     """Filter stanzas sent to account jid"""
     name = stanza.get_to().node
     return name
+account_filter = routed_filter((ACCOUNT,))(account_filter)
 
 def get_account_filter(self, stanza, lang_class, node=None):
     """Filter stanzas sent to account jid, only if account exists"""
@@ -56,14 +82,81 @@ def get_account_filter(self, stanza, lang_class, node=None):
                                    name)
     else:
         return None
+get_account_filter = routed_filter((ACCOUNT,), True)(get_account_filter)
 
 def get_accounts_root_filter(self, stanza, lang_class, node=None):
     """Filter stanza sent to root node"""
     to_jid = stanza.get_to()
     if to_jid.resource is None and to_jid.node is None and node is None:
-        return account.get_accounts(unicode(stanza.get_from().bare()))
+        # fetched at once so that handlers sharing the result do not run
+        # the query again
+        return list(account.get_accounts(unicode(stanza.get_from().bare())))
     else:
         return None
+get_accounts_root_filter = routed_filter((ROOT,),
+                                         True)(get_accounts_root_filter)
+
+def get_target(stanza):
+    """Return the kind of receiver (ROOT, ACCOUNT_TYPE or ACCOUNT) of
+    `stanza`"""
+    to_jid = stanza.get_to()
+    if to_jid is None:
+        return None
+    elif to_jid.node is not None:
+        return ACCOUNT
+    elif to_jid.resource is None:
+        return ROOT
+    else:
+        return ACCOUNT_TYPE
+
+def get_handler_routes(handler):
+    """
+    Return kinds of receiver `handler` accepts (None for any). Routes of the
+    filter function come first so that a handler replacing its filter is
+    not routed by inherited routes.
+    """
+    routes = getattr(handler.filter, "routes", None)
+    if routes is None:
+        routes = getattr(handler, "routes", None)
+    return routes
+
+def get_handlers_signature(handlers):
+    """Return a value changing when `handlers` groups or their filters
+    change"""
+    return [[(handler, getattr(handler.filter, "im_func", handler.filter))
+             for handler in handler_group]
+            for handler_group in handlers]
+
+class DispatchTable(object):
+    """
+    Handler groups indexed by the kind of stanza receiver, keeping for
+    each kind only the handlers which can accept it (see Handler.routes).
+    """
+
+    def __init__(self, handlers):
+        """DispatchTable constructor"""
+        self.handlers = handlers
+        self.signature = get_handlers_signature(handlers)
+        self.groups = {}
+        for target in (ROOT, ACCOUNT_TYPE, ACCOUNT):
+            groups = []
+            for handler_group in handlers:
+                group = []
+                for handler in handler_group:
+                    routes = get_handler_routes(handler)
+                    if routes is None or target in routes:
+                        group.append(handler)
+                groups.append(group)
+            self.groups[target] = groups
+
+    def is_valid(self, handlers):
+        """Return True if the table is still valid for `handlers`"""
+        return self.handlers is handlers \
+            and self.signature == get_handlers_signature(handlers)
+
+    def get_handlers(self, stanza):
+        """Return handler groups to try for `stanza`"""
+        return self.groups.get(get_target(stanza), self.handlers)
 
 def replace_handlers(handlers, old_handler_type, new_handler):
     """
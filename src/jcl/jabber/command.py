@@ -22,7 +22,6 @@
 ##
 
 import re
-import datetime
 import logging
 import threading
 
@@ -33,12 +32,17 @@ from pyxmpp.jabber.disco import DiscoInfo, DiscoItems, DiscoItem, DiscoIdentity
 from pyxmpp.jabber.dataforms import Form, Field
 from pyxmpp.message import Message
 
+from jcl.lang import get_label
 from jcl.jabber.disco import DiscoHandler, RootDiscoGetInfoHandler
 from jcl.jabber.register import SetRegisterHandler
+from jcl.jabber.jobs import JobManager, BroadcastJob, JOB_PENDING, \
+     JOB_RUNNING, JOB_COMPLETED, JOB_CANCELED
 from jcl.model import account
+from jcl.model.session import SessionStore
 from jcl.model.account import Account, User
 
 COMMAND_NS = "http://jabber.org/protocol/commands"
+RSM_NS = "http://jabber.org/protocol/rsm"
 
 ACTION_COMPLETE = "complete"
 ACTION_EXECUTE = "execute"
@@ -87,7 +91,8 @@ class CommandManager(object):
         self.account_manager = account_manager
         self.commands = {}
         self.command_re = re.compile("([^#]*#)?(.*)")
-        self.sessions = {}
+        self.sessions = SessionStore()
+        self.jobs = JobManager()
 
     def get_short_command_name(self, command_name):
         """
@@ -100,12 +105,8 @@ class CommandManager(object):
     def get_command_desc(self, command_name, lang_class):
         """Return localized command description"""
         short_command_name = self.get_short_command_name(command_name)
-        command_desc_attribut = "command_" + short_command_name
-        if hasattr(lang_class, command_desc_attribut):
-            command_desc = getattr(lang_class, command_desc_attribut)
-        else:
-            command_desc = short_command_name
-        return command_desc
+        return get_label(lang_class, "command_" + short_command_name,
+                         short_command_name)
 
     def list_commands(self, jid, to_jid, disco_items, lang_class):
         """Return DiscoItem for each supported commands"""
@@ -189,12 +190,16 @@ class CommandManager(object):
             command_node.setProp("status", STATUS_CANCELED)
             command_node.setProp("sessionid",
                                  session_id)
-            del self.sessions[session_id]
+            if self.sessions.has_key(session_id):
+                # stop background job started by the command
+                job_id = self.sessions[session_id][1].get("job_id")
+                if job_id is not None:
+                    self.jobs.cancel(job_id)
+                del self.sessions[session_id]
             return [response]
 
     def generate_session_id(self, node):
-        return self.get_short_command_name(node) + ":" + \
-               datetime.datetime.now().isoformat()
+        return self.sessions.new_session_id(self.get_short_command_name(node))
 
     def _create_response(self, info_query, completed=True):
         xml_command = info_query.xpath_eval(\
@@ -240,6 +245,33 @@ class CommandManager(object):
                 else:
                     self.sessions[session_id][1][field_name] = values
 
+    def parse_result_set(self, info_query):
+        """
+        Return the Result Set Management (XEP-0059) request of the command
+        as a dict with 'max', 'after' and 'before' keys (None if missing)
+        """
+        result_set = {"max": None, "after": None, "before": None}
+        for name in result_set.keys():
+            values = info_query.xpath_eval(\
+                "c:command/rsm:set/rsm:" + name,
+                {"c": COMMAND_NS,
+                 "rsm": RSM_NS})
+            if len(values) > 0:
+                result_set[name] = values[0].content
+        return result_set
+
+    def add_result_set(self, command_node, first, last, count, index=None):
+        """Add a Result Set Management (XEP-0059) result to command_node"""
+        set_node = command_node.newChild(None, "set", None)
+        set_node.setNs(set_node.newNs(RSM_NS, None))
+        if first is not None:
+            first_node = set_node.newTextChild(None, "first", str(first))
+            if index is not None:
+                first_node.setProp("index", str(index))
+            set_node.newTextChild(None, "last", str(last))
+        set_node.newTextChild(None, "count", str(count))
+        return set_node
+
     def execute_multi_step_command(self, info_query, short_node,
                                    update_step_func):
         self.__logger.debug("Executing multi-step command " + str(short_node))
@@ -284,6 +316,34 @@ class CommandManager(object):
                                 + str(short_node) + " command: ",
                                 exc_info=True)
             return [info_query.make_error_response("service-unavailable")]
+        finally:
+            # context has been modified in place
+            self.sessions.save(session_id)
+
+    def add_job_progress(self, job, command_node, lang_class):
+        """
+        Report progress of background `job` in a note of command_node. The
+        command stays 'executing' (with a 'next' action to refresh its
+        progress, 'cancel' stops it) until the job is finished.
+        """
+        if job.state in [JOB_PENDING, JOB_RUNNING]:
+            if job.total is None:
+                message = lang_class.job_pending
+            else:
+                message = lang_class.job_running % (job.done, job.total)
+            command_node.setProp("status", STATUS_EXECUTING)
+            self.add_actions(command_node, [ACTION_NEXT])
+        else:
+            if job.state == JOB_COMPLETED:
+                message = lang_class.job_completed % (job.done)
+            elif job.state == JOB_CANCELED:
+                message = lang_class.job_canceled % (job.done)
+            else:
+                message = lang_class.job_failed % (job.done)
+            command_node.setProp("status", STATUS_COMPLETED)
+        note_node = command_node.newTextChild(None, "note", message)
+        note_node.setProp("type", "info")
+        return note_node
 
     def add_actions(self, command_node, actions, default_action_idx=0):
         actions_node = command_node.newTextChild(None, "actions", None)
@@ -301,7 +361,6 @@ class JCLCommandManager(CommandManager):
         """
         JCLCommandManager constructor
         commands not implemented:
-        'http://jabber.org/protocol/admin#user-stats',
         'http://jabber.org/protocol/admin#edit-blacklist',
         'http://jabber.org/protocol/admin#add-to-blacklist-in',
         'http://jabber.org/protocol/admin#add-to-blacklist-out',
@@ -341,6 +400,8 @@ class JCLCommandManager(CommandManager):
             (True, root_node_re)
         self.commands["http://jabber.org/protocol/admin#get-online-users-list"] = \
             (True, root_node_re)
+        self.commands["http://jabber.org/protocol/admin#user-stats"] = \
+            (True, root_node_re)
         self.commands["http://jabber.org/protocol/admin#announce"] = \
             (True, root_node_re)
         self.commands["http://jabber.org/protocol/admin#set-motd"] = \
@@ -362,6 +423,10 @@ class JCLCommandManager(CommandManager):
         self.commands["jcl#get-last-error"] = (False, account_node_re)
         self.restart_thread = None
         self.shutdown_thread = None
+        # users read at once and messages sent per second (when the
+        # outbound queue is disabled) by broadcasts
+        self.broadcast_chunk_size = 500
+        self.broadcast_rate = 0
         #self.commands["http://jabber.org/protocol/admin#get-user-password"] = True
         #self.commands["http://jabber.org/protocol/admin#change-user-password"] = True
 
@@ -395,23 +460,27 @@ class JCLCommandManager(CommandManager):
 
     def __add_accounts_to_field(self, user_jids, field, lang_class, filter=None,
                                 show_user_jid=True):
+        account_types = []
         for (account_type, type_label) in \
                 self.account_manager.list_account_types(lang_class):
-            account_class = self.account_manager.get_account_class(\
-                account_type=account_type)
-            for user_jid in user_jids:
-                self.__logger.debug("Listing " + str(user_jid) + "'s accounts")
-                for _account in account.get_accounts(user_jid, account_class,
-                                                     filter):
-                    self.__logger.debug(" - " + _account.name)
-                    if show_user_jid:
-                        label = _account.name + " (" + account_type \
-                            + ") (" + user_jid + ")"
-                    else:
-                        label = _account.name + " (" + account_type \
-                            + ")"
-                    field.add_option(label=label,
-                                     value=_account.name + "/" + user_jid)
+            account_types.append((account_type,
+                                  self.account_manager.get_account_class(\
+                        account_type=account_type)))
+        self.__logger.debug("Listing " + str(user_jids) + " accounts")
+        accounts = account.get_accounts_for_users(\
+            user_jids, [account_class for (account_type, account_class)
+                        in account_types], filter)
+        for (account_type, account_class) in account_types:
+            for (user_jid, _account) in accounts[account_class]:
+                self.__logger.debug(" - " + _account.name)
+                if show_user_jid:
+                    label = _account.name + " (" + account_type \
+                        + ") (" + user_jid + ")"
+                else:
+                    label = _account.name + " (" + account_type \
+                        + ")"
+                field.add_option(label=label,
+                                 value=_account.name + "/" + user_jid)
 
     def add_form_select_accounts(self, session_context,
                                  command_node, lang_class,
@@ -456,7 +525,7 @@ class JCLCommandManager(CommandManager):
         return result_form
 
     def add_form_select_max(self, command_node, lang_class):
-        self.add_actions(command_node, [ACTION_COMPLETE])
+        self.add_actions(command_node, [ACTION_NEXT])
         result_form = Form(xmlnode_or_type="form")
         result_form.add_field(field_type="hidden",
                               name="FORM_TYPE",
@@ -470,25 +539,110 @@ class JCLCommandManager(CommandManager):
         result_form.as_xml(command_node)
         return (result_form, [])
 
-    def add_form_list_accounts(self, command_node,
-                               var_name, var_label,
-                               filter=None, limit=None):
+    def __add_form_accounts(self, command_node, var_name, var_label,
+                            accounts):
+        """
+        Add a form listing `accounts` (account id, user JID, account name,
+        class name) tuples
+        """
         result_form = Form(xmlnode_or_type="form")
         result_form.add_field(field_type="hidden",
                               name="FORM_TYPE",
                               value="http://jabber.org/protocol/admin")
-        accounts = account.get_all_accounts(filter=filter, limit=limit)
         accounts_labels = []
-        for _account in accounts:
-            accounts_labels += [_account.user.jid + " (" + _account.name
-                                + " " + str(_account.__class__.__name__) + ")"]
+        for (account_id, user_jid, name, class_name) in accounts:
+            accounts_labels += [user_jid + " (" + name + " " + class_name + ")"]
         result_form.fields.append(FieldNoType(name=var_name,
                                               label=var_label,
                                               values=accounts_labels))
         result_form.as_xml(command_node)
+        return result_form
+
+    def add_form_list_accounts(self, command_node,
+                               var_name, var_label,
+                               filter=None, limit=None):
+        accounts = account.get_accounts_page(filter=filter, limit=limit)
+        result_form = self.__add_form_accounts(command_node, var_name,
+                                               var_label, accounts)
         command_node.setProp("status", STATUS_COMPLETED)
         return (result_form, [])
 
+    def add_form_list_accounts_page(self, info_query, session_context,
+                                    command_node, var_name, var_label,
+                                    count_func, filter=None):
+        """
+        Add a form listing a page of max_items accounts with its Result Set
+        Management (XEP-0059) description. Pages are read by account id
+        (keyset pagination): the id after which each page starts is kept
+        in the session so 'next' and 'prev' actions never skip rows with
+        OFFSET. An 'after' or 'before' result set request completes the
+        command with the requested page.
+        """
+        result_set = self.parse_result_set(info_query)
+        try:
+            if result_set["max"] is not None:
+                limit = int(result_set["max"])
+            else:
+                limit = int(session_context["max_items"][-1])
+            after = result_set["after"]
+            if after is not None:
+                after = int(after)
+            before = result_set["before"]
+            if before is not None:
+                before = int(before)
+        except ValueError:
+            raise CommandError("bad-request")
+        action = info_query.xpath_eval("c:command",
+                                       {"c": COMMAND_NS})[0].prop("action")
+        page = None
+        if after is None and before is None:
+            # page_keys[i]: id of the account after which page i starts
+            page_keys = session_context.setdefault("page_keys", [None])
+            page = session_context.get("page")
+            if page is None:
+                page = 0
+            elif action == ACTION_PREVIOUS:
+                page = max(page - 1, 0)
+            elif action != ACTION_COMPLETE:
+                page = min(page + 1, len(page_keys) - 1)
+            session_context["page"] = page
+            after = page_keys[page]
+        # one more account is read to know if there is another page
+        accounts = account.get_accounts_page(filter=filter, limit=limit + 1,
+                                             after=after, before=before)
+        has_more = len(accounts) > limit
+        if has_more and before is not None:
+            accounts = accounts[1:]
+        else:
+            accounts = accounts[:limit]
+        actions = []
+        if page is not None and action != ACTION_COMPLETE:
+            del page_keys[page + 1:]
+            if page > 0:
+                actions.append(ACTION_PREVIOUS)
+            if has_more:
+                page_keys.append(accounts[-1][0])
+                actions.append(ACTION_NEXT)
+        if actions:
+            actions.append(ACTION_COMPLETE)
+            # 'next' by default, 'complete' on the last page
+            self.add_actions(command_node, actions,
+                             len(actions) - 1 - int(has_more))
+        else:
+            command_node.setProp("status", STATUS_COMPLETED)
+        result_form = self.__add_form_accounts(command_node, var_name,
+                                               var_label, accounts)
+        if len(accounts) > 0:
+            (first, last) = (accounts[0][0], accounts[-1][0])
+        else:
+            (first, last) = (None, None)
+        if page is not None:
+            index = page * limit
+        else:
+            index = None
+        self.add_result_set(command_node, first, last, count_func(), index)
+        return (result_form, [])
+
     ###########################################################################
     # Reusable steps
     ###########################################################################
@@ -534,6 +688,23 @@ class JCLCommandManager(CommandManager):
                                              format_as_xml=format_as_xml),
                 [])
 
+    def list_accounts_step_1(self, session_context, command_node, lang_class,
+                             var_name, var_label, count_func, filter=None):
+        """
+        List accounts matching `filter` if there are few of them (as
+        returned by `count_func`), else ask the number of accounts to list
+        in each page
+        """
+        self.__logger.debug("Executing list_accounts step 1")
+        num_accounts = count_func()
+        if num_accounts < 25:
+            return self.add_form_list_accounts(command_node, var_name,
+                                               var_label, filter=filter)
+        else:
+            session_context.pop("page", None)
+            session_context.pop("page_keys", None)
+            return self.add_form_select_max(command_node, lang_class)
+
     ###########################################################################
     # add-user command
     ###########################################################################
@@ -869,7 +1040,7 @@ class JCLCommandManager(CommandManager):
         result_form.add_field(field_type="hidden",
                               name="FORM_TYPE",
                               value="http://jabber.org/protocol/admin")
-        num_accounts = account.get_all_accounts_count()
+        num_accounts = account.get_registered_accounts_count()
         result_form.fields.append(FieldNoType(name="registeredusersnum",
                                               label=lang_class.field_registered_users_num,
                                               value=num_accounts))
@@ -886,8 +1057,7 @@ class JCLCommandManager(CommandManager):
         result_form.add_field(field_type="hidden",
                               name="FORM_TYPE",
                               value="http://jabber.org/protocol/admin")
-        num_accounts = account.get_all_accounts_count(\
-            filter=(Account.q.enabled == False))
+        num_accounts = account.get_disabled_accounts_count()
         result_form.fields.append(FieldNoType(name="disabledusersnum",
                                               label=lang_class.field_disabled_users_num,
                                               value=num_accounts))
@@ -904,8 +1074,7 @@ class JCLCommandManager(CommandManager):
         result_form.add_field(field_type="hidden",
                               name="FORM_TYPE",
                               value="http://jabber.org/protocol/admin")
-        num_accounts = account.get_all_accounts_count(\
-            filter=(Account.q._status != account.OFFLINE))
+        num_accounts = account.get_online_accounts_count()
         result_form.fields.append(FieldNoType(name="onlineusersnum",
                                               label=lang_class.field_online_users_num,
                                               value=num_accounts))
@@ -918,68 +1087,112 @@ class JCLCommandManager(CommandManager):
     ###########################################################################
     def execute_get_registered_users_list_1(self, info_query, session_context,
                                             command_node, lang_class):
-        num_accounts = account.get_all_accounts_count()
-        if num_accounts < 25:
-            return self.add_form_list_accounts(command_node,
-                                               "registeredusers",
-                                               lang_class.field_registered_users_list)
-        else:
-            return self.add_form_select_max(command_node, lang_class)
+        return self.list_accounts_step_1(\
+            session_context, command_node, lang_class, "registeredusers",
+            lang_class.field_registered_users_list,
+            account.get_registered_accounts_count)
 
-    def execute_get_registered_users_list_2(self, info_query, session_context,
-                                            command_node, lang_class):
-        limit = int(session_context["max_items"][0])
-        return self.add_form_list_accounts(command_node,
-                                           "registeredusers",
-                                           lang_class.field_registered_users_list,
-                                           limit=limit)
+    def execute_get_registered_users_list(self, info_query, session_context,
+                                          command_node, lang_class):
+        return self.add_form_list_accounts_page(\
+            info_query, session_context, command_node, "registeredusers",
+            lang_class.field_registered_users_list,
+            account.get_registered_accounts_count)
 
     ###########################################################################
     # get-disabled-users-list command
     ###########################################################################
     def execute_get_disabled_users_list_1(self, info_query, session_context,
                                           command_node, lang_class):
-        num_accounts = account.get_all_accounts_count()
-        if num_accounts < 25:
-            return self.add_form_list_accounts(command_node,
-                                               "disabledusers",
-                                               lang_class.field_disabled_users_list,
-                                               filter=(Account.q.enabled == False))
-        else:
-            return self.add_form_select_max(command_node, lang_class)
+        return self.list_accounts_step_1(\
+            session_context, command_node, lang_class, "disabledusers",
+            lang_class.field_disabled_users_list,
+            account.get_disabled_accounts_count,
+            filter=(Account.q.enabled == False))
 
-    def execute_get_disabled_users_list_2(self, info_query, session_context,
-                                          command_node, lang_class):
-        limit = int(session_context["max_items"][0])
-        return self.add_form_list_accounts(command_node,
-                                           "disabledusers",
-                                           lang_class.field_disabled_users_list,
-                                           limit=limit,
-                                           filter=(Account.q.enabled == False))
+    def execute_get_disabled_users_list(self, info_query, session_context,
+                                        command_node, lang_class):
+        return self.add_form_list_accounts_page(\
+            info_query, session_context, command_node, "disabledusers",
+            lang_class.field_disabled_users_list,
+            account.get_disabled_accounts_count,
+            filter=(Account.q.enabled == False))
 
     ###########################################################################
     # get-online-users-list command
     ###########################################################################
     def execute_get_online_users_list_1(self, info_query, session_context,
                                         command_node, lang_class):
-        num_accounts = account.get_all_accounts_count()
-        if num_accounts < 25:
-            return self.add_form_list_accounts(\
-                command_node, "onlineusers",
-                lang_class.field_online_users_list,
-                filter=(Account.q._status != account.OFFLINE))
-        else:
-            return self.add_form_select_max(command_node, lang_class)
+        return self.list_accounts_step_1(\
+            session_context, command_node, lang_class, "onlineusers",
+            lang_class.field_online_users_list,
+            account.get_online_accounts_count,
+            filter=(Account.q._status != account.OFFLINE))
 
-    def execute_get_online_users_list_2(self, info_query, session_context,
-                                        command_node, lang_class):
-        limit = int(session_context["max_items"][0])
-        return self.add_form_list_accounts(\
-            command_node, "onlineusers",
+    def execute_get_online_users_list(self, info_query, session_context,
+                                      command_node, lang_class):
+        return self.add_form_list_accounts_page(\
+            info_query, session_context, command_node, "onlineusers",
             lang_class.field_online_users_list,
-            limit=limit,
+            account.get_online_accounts_count,
             filter=(Account.q._status != account.OFFLINE))
 
+    ###########################################################################
+    # user-stats command
+    ###########################################################################
+    def execute_user_stats_1(self, info_query, session_context,
+                             command_node, lang_class):
+        return self.select_user_jid_step(\
+            session_context, command_node, lang_class,
+            lang_class.command_user_stats,
+            lang_class.command_user_stats_1_description,
+            actions=[ACTION_COMPLETE])
+
+    def execute_user_stats_2(self, info_query, session_context,
+                             command_node, lang_class):
+        """
+        Return statistics of user accounts, or of all accounts (from
+        account counters if enabled) if no user JID is given
+        """
+        self.__logger.debug("Executing command 'user-stats' step 2")
+        result_form = Form(xmlnode_or_type="result")
+        result_form.add_field(field_type="hidden",
+                              name="FORM_TYPE",
+                              value="http://jabber.org/protocol/admin")
+        if session_context.has_key("user_jid") \
+                and session_context["user_jid"][0]:
+            user_jid = session_context["user_jid"][0]
+            accounts = list(account.get_accounts(user_jid))
+            num_accounts = len(accounts)
+            num_disabled = len([_account for _account in accounts
+                                if not _account.enabled])
+            num_online = len([_account for _account in accounts
+                              if _account.status != account.OFFLINE])
+            result_form.fields.append(FieldNoType(name="accountjid",
+                                                  value=user_jid,
+                                                  label=lang_class.field_user_jid))
+            result_form.fields.append(\
+                FieldNoType(name="rostersize",
+                            value=num_accounts
+                            + len(account.get_legacy_jids(user_jid)),
+                            label=lang_class.field_roster_size))
+        else:
+            num_accounts = account.get_registered_accounts_count()
+            num_disabled = account.get_disabled_accounts_count()
+            num_online = account.get_online_accounts_count()
+        result_form.fields.append(FieldNoType(name="registeredusersnum",
+                                              label=lang_class.field_registered_users_num,
+                                              value=num_accounts))
+        result_form.fields.append(FieldNoType(name="disabledusersnum",
+                                              label=lang_class.field_disabled_users_num,
+                                              value=num_disabled))
+        result_form.fields.append(FieldNoType(name="onlineusersnum",
+                                              label=lang_class.field_online_users_num,
+                                              value=num_online))
+        result_form.as_xml(command_node)
+        command_node.setProp("status", STATUS_COMPLETED)
+        return (result_form, [])
+
     ###########################################################################
     # announce command
     ###########################################################################
@@ -999,22 +1212,43 @@ class JCLCommandManager(CommandManager):
         result_form.as_xml(command_node)
         return (result_form, [])
 
+    def create_broadcast_job(self, session_context, command_node):
+        """
+        Return a job sending session_context announcement to online users
+        (identified by the command session id), None if there is no
+        announcement.
+        """
+        if not session_context.has_key("announcement"):
+            return None
+        announcement = session_context["announcement"][0]
+        if announcement is None or announcement == "":
+            return None
+        job_id = command_node.prop("sessionid")
+        session_context["job_id"] = job_id
+        return BroadcastJob(job_id, self.component, announcement,
+                            self.broadcast_chunk_size, self.broadcast_rate)
+
+    def execute_job_progress(self, info_query, session_context,
+                             command_node, lang_class):
+        """Report progress of the background job of the command"""
+        job = self.jobs.get(session_context.get("job_id"))
+        if job is None:
+            raise CommandError("item-not-found")
+        self.add_job_progress(job, command_node, lang_class)
+        return (None, [])
+
     def execute_announce_2(self, info_query, session_context,
                            command_node, lang_class):
         self.__logger.debug("Executing command 'announce' step 2")
-        result = []
-        if session_context.has_key("announcement"):
-            announcement = session_context["announcement"][0]
-            users = account.get_all_users(\
-                filter=AND(Account.q.userID == User.q.id,
-                           Account.q._status != account.OFFLINE),
-                distinct=True)
-            for user in users:
-                result.append(Message(from_jid=self.component.jid,
-                                      to_jid=user.jid,
-                                      body=announcement))
-        command_node.setProp("status", STATUS_COMPLETED)
-        return (None, result)
+        job = self.create_broadcast_job(session_context, command_node)
+        if job is None:
+            command_node.setProp("status", STATUS_COMPLETED)
+            return (None, [])
+        self.add_job_progress(job, command_node, lang_class)
+        self.jobs.start(job)
+        return (None, [])
+
+    execute_announce = execute_job_progress
 
     ###########################################################################
     # set-motd command
@@ -1192,27 +1426,27 @@ class JCLCommandManager(CommandManager):
                           command_node, lang_class):
         self.__logger.debug("Executing command 'restart' step 2")
         delay = int(session_context["delay"][0])
-        result = []
-        if session_context.has_key("announcement"):
-            announcement = session_context["announcement"][0]
-            if announcement is not None and announcement != "":
-                users = account.get_all_users(\
-                    filter=AND(Account.q.userID == User.q.id,
-                               Account.q._status != account.OFFLINE),
-                    distinct=True)
-                for user in users:
-                    result.append(Message(from_jid=self.component.jid,
-                                          to_jid=user.jid,
-                                          body=announcement))
-        command_node.setProp("status", STATUS_COMPLETED)
+        job = self.create_broadcast_job(session_context, command_node)
         def delayed_restart(self, delay):
+            if job is not None:
+                # the announcement is sent before waiting
+                job.run()
             self.sleep(delay)
-            self.component.restart = True
+            if job is None or not job.canceled:
+                self.component.restart = True
         self.restart_thread = threading.Thread(\
             target=lambda : delayed_restart(self, delay),
             name="TimerThread")
+        if job is None:
+            command_node.setProp("status", STATUS_COMPLETED)
+        else:
+            # canceling the command cancels the restart
+            self.jobs.add(job)
+            self.add_job_progress(job, command_node, lang_class)
         self.restart_thread.start()
-        return (None, result)
+        return (None, [])
+
+    execute_restart = execute_job_progress
 
     ###########################################################################
     # shutdown command
@@ -1254,27 +1488,27 @@ class JCLCommandManager(CommandManager):
                            command_node, lang_class):
         self.__logger.debug("Executing command 'shutdown' step 2")
         delay = int(session_context["delay"][0])
-        result = []
-        if session_context.has_key("announcement"):
-            announcement = session_context["announcement"][0]
-            if announcement is not None and announcement != "":
-                users = account.get_all_users(\
-                    filter=AND(Account.q.userID == User.q.id,
-                               Account.q._status != account.OFFLINE),
-                    distinct=True)
-                for user in users:
-                    result.append(Message(from_jid=self.component.jid,
-                                          to_jid=user.jid,
-                                          body=announcement))
-        command_node.setProp("status", STATUS_COMPLETED)
+        job = self.create_broadcast_job(session_context, command_node)
         def delayed_shutdown(self, delay):
+            if job is not None:
+                # the announcement is sent before waiting
+                job.run()
             self.sleep(delay)
-            self.component.running = False
+            if job is None or not job.canceled:
+                self.component.running = False
         self.shutdown_thread = threading.Thread(\
             target=lambda : delayed_shutdown(self, delay),
             name="TimerThread")
+        if job is None:
+            command_node.setProp("status", STATUS_COMPLETED)
+        else:
+            # canceling the command cancels the shutdown
+            self.jobs.add(job)
+            self.add_job_progress(job, command_node, lang_class)
         self.shutdown_thread.start()
-        return (None, result)
+        return (None, [])
+
+    execute_shutdown = execute_job_progress
 
     def execute_get_last_error_1(self, info_query, session_context,
                                  command_node, lang_class):
@@ -44,10 +44,10 @@ from pyxmpp.presence import Presence
 from pyxmpp.jabber.dataforms import Form
 import pyxmpp.jabber.vcard as vcard
 
-from jcl.error import FieldError
+import jcl.jabber as jabber
 from jcl.jabber.disco import AccountDiscoGetInfoHandler, \
      AccountTypeDiscoGetInfoHandler, RootDiscoGetItemsHandler, \
-     AccountTypeDiscoGetItemsHandler
+     AccountTypeDiscoGetItemsHandler, DiscoItemsCache
 from jcl.jabber.message import PasswordMessageHandler, HelpMessageHandler
 import jcl.jabber.command as command
 from jcl.jabber.command import CommandDiscoGetItemsHandler, \
@@ -61,11 +61,15 @@ from jcl.jabber.presence import AccountPresenceAvailableHandler, \
 from jcl.jabber.register import RootSetRegisterHandler, \
      AccountSetRegisterHandler, AccountTypeSetRegisterHandler
 from jcl.jabber.vcard import DefaultVCardHandler
+from jcl.jabber.outbound import OutboundQueue, PRIORITY_BULK
+from jcl.jabber.dispatcher import StanzaDispatcher
 
 import jcl.model as model
-from jcl.model import account
+from jcl.model.session import SessionStore, MemorySessionBackend, \
+    SQLSessionBackend
+from jcl.model import account, context
 from jcl.model.account import Account, User
-from jcl.lang import Lang
+from jcl.lang import Lang, get_label
 
 class AccountManager(object):
     """Implement component account behavior"""
@@ -86,6 +90,8 @@ class AccountManager(object):
     def _set_account_classes(self, account_classes):
         """account_classes setter"""
         self._account_classes = account_classes
+        # (account class, lang class) -> registration form template
+        self.registration_form_templates = {}
         self.has_multiple_account_type = (len(self._account_classes) > 1)
         self.account_types = []
         for account_class in account_classes:
@@ -111,14 +117,15 @@ class AccountManager(object):
         info_query = info_query.make_result_response()
         account_class = self.get_account_class(account_type)
         model.db_connect()
-        _account = account.get_account(unicode(from_jid.bare()), name, account_class)
+        try:
+            _account = account.get_account(unicode(from_jid.bare()), name,
+                                           account_class)
+        finally:
+            model.db_disconnect()
         if _account is not None:
             query = info_query.new_query("jabber:iq:register")
-            model.db_disconnect()
             self.generate_registration_form_init(lang_class,
                                                  _account).as_xml(query)
-        else:
-            model.db_disconnect()
         return [info_query]
 
     def _account_type_get_register(self, info_query, account_class, lang_class):
@@ -147,10 +154,10 @@ class AccountManager(object):
                                                    lang_class)
 
     ###### set_register handlers ######
+    @model.transactional
     def remove_all_accounts(self, user_jid):
         """Unsubscribe all accounts associated to 'user_jid' then delete
         those accounts from the DataBase"""
-        model.db_connect()
         result = []
         bare_user_jid = user_jid.bare()
         for _account in account.get_accounts(bare_user_jid):
@@ -164,7 +171,7 @@ class AccountManager(object):
         result.append(Presence(from_jid=self.component.jid,
                                to_jid=bare_user_jid,
                                stanza_type="unsubscribed"))
-        model.db_disconnect()
+        self.component.disco_items_cache.invalidate(bare_user_jid)
         return result
 
     def remove_account_from_name(self, user_jid, name):
@@ -174,10 +181,10 @@ class AccountManager(object):
         else:
             return []
 
+    @model.transactional
     def remove_account(self, _account, user_jid, remove_user=True):
         self.__logger.debug("Deleting account: " + str(_account))
         result = []
-        model.db_connect()
         bare_user_jid = user_jid.bare()
         result.append(Presence(from_jid=_account.jid,
                                to_jid=bare_user_jid,
@@ -186,32 +193,28 @@ class AccountManager(object):
                                to_jid=bare_user_jid,
                                stanza_type="unsubscribed"))
         _account.destroySelf()
+        self.component.disco_items_cache.invalidate(bare_user_jid)
         if remove_user:
             bare_user_jid = unicode(user_jid.bare())
             accounts_count = account.get_accounts_count(bare_user_jid)
             if accounts_count == 0:
                 user = account.get_user(bare_user_jid)
                 user.destroySelf()
-        model.db_disconnect()
         return result
 
+    @model.transactional
     def populate_account(self, _account, lang_class, x_data,
                          new_account, first_account, from_jid=None):
         """Populate given account"""
         if from_jid is None:
             from_jid = _account.user.jid
-        field = None
         result = []
-        for (field, field_type, field_options, field_post_func,
-             field_default_func) in _account.get_register_fields():
-            if field is not None:
-                if field in x_data:
-                    value = x_data[field].value
-                else:
-                    value = None
-                setattr(_account, field,
-                        field_post_func(value, field_default_func,
-                                        unicode(from_jid.bare())))
+        # every field is checked before the account is modified
+        for (field_name, value) in _account.get_register_schema().process(\
+                x_data, unicode(from_jid.bare())):
+            setattr(_account, field_name, value)
+        # account long names may depend on its fields
+        self.component.disco_items_cache.invalidate(from_jid.bare())
 
         if hasattr(_account, "populate_handler"):
             try:
@@ -276,6 +279,7 @@ class AccountManager(object):
                                        lang_class,
                                        x_data)
 
+    @model.transactional
     def create_account(self,
                        account_name,
                        from_jid,
@@ -285,24 +289,17 @@ class AccountManager(object):
         """Create new account from account_class"""
         bare_from_jid = unicode(from_jid.bare())
         first_account = (account.get_accounts_count(bare_from_jid) == 0)
-        model.db_connect()
         user = account.get_user(bare_from_jid)
         if user is None:
             user = User(jid=bare_from_jid)
         _account = account_class(user=user,
                                  name=account_name,
                                  jid=self.get_account_jid(account_name))
-        model.db_disconnect()
-        try:
-            return self.populate_account(_account, lang_class, x_data,
-                                         new_account=True,
-                                         first_account=first_account,
-                                         from_jid=from_jid)
-        except FieldError, field_error:
-            model.db_connect()
-            _account.destroySelf()
-            model.db_disconnect()
-            raise field_error
+        # a FieldError rolls back user and account creation
+        return self.populate_account(_account, lang_class, x_data,
+                                     new_account=True,
+                                     first_account=first_account,
+                                     from_jid=from_jid)
 
     def create_account_from_type(self,
                                  account_name,
@@ -333,16 +330,26 @@ class AccountManager(object):
 
     ###### presence generic handlers ######
     def get_presence_all(self, presence):
-        """Send presence to all account."""
-        result = []
-        for user in account.get_all_users():
-            result.append(self.get_presence(self.component.jid,
-                                            user.jid,
-                                            presence))
-        for _account in account.get_all_accounts():
-            result.extend(getattr(self, "get_account_presence_" +
-                                  str(presence))(_account.user.jid, _account))
-        return result
+        """
+        Yield `presence` stanzas from component to every user and from
+        every account to its user (see get_account_presence_<presence>).
+        Accounts are given to these methods as AccountPresenceInfo rows, so
+        statuses they set are not stored: accounts are set OFFLINE once
+        every 'unavailable' presence has been yielded, or when producing
+        them fails.
+        """
+        try:
+            for user_jid in account.get_all_users_jid():
+                yield self.get_presence(self.component.jid, user_jid,
+                                        presence)
+            for presence_info in account.get_all_accounts_presence_info():
+                for stanza in getattr(self, "get_account_presence_"
+                                      + str(presence))(presence_info.user_jid,
+                                                       presence_info):
+                    yield stanza
+        finally:
+            if presence == "unavailable":
+                account.set_all_accounts_offline()
 
     def get_root_presence(self, to_jid, presence_type,
                             show=None, status=None):
@@ -379,37 +386,83 @@ class AccountManager(object):
         if necessary"""
         result = []
         old_status = _account.status
-        if _account.error is not None:
-            _account.status = account.DND
-        elif not _account.enabled:
-            _account.status = account.XA
-        else:
-            _account.status = account.ONLINE
+        _account.status = self.get_available_status(_account)
         if not update or old_status != _account.status:
             result.append(self.get_presence(from_jid=_account.jid,
                                             to_jid=to_jid,
                                             status=_account.status_msg,
                                             show=_account.status,
                                             presence_type="available"))
+        result.extend(self.__ask_password_if_needed(to_jid, _account,
+                                                    old_status, lang_class))
+        return result
+
+    def get_accounts_presence_available(self, to_jid, accounts, lang_class):
+        """Send available presence of every account of a user who came
+        online and ask for passwords if necessary. New statuses are written
+        with a single UPDATE (see account.set_accounts_status), unless
+        get_account_presence_available is overridden: it is then called
+        for each account in a single transaction"""
+        if getattr(self.get_account_presence_available, "im_func", None) \
+                is not AccountManager.get_account_presence_available.im_func:
+            result = []
+            model.begin_transaction()
+            try:
+                for _account in accounts:
+                    result.extend(self.get_account_presence_available(\
+                            to_jid, _account, lang_class))
+            except:
+                model.end_transaction(False)
+                raise
+            model.end_transaction()
+            return result
+        result = []
+        accounts_status = []
+        for _account in accounts:
+            old_status = _account.status
+            status = self.get_available_status(_account)
+            if status != old_status:
+                accounts_status.append((_account, status))
+            result.append(self.get_presence(\
+                    from_jid=_account.jid,
+                    to_jid=to_jid,
+                    status=_account.get_status_msg(status=status),
+                    show=status,
+                    presence_type="available"))
+            result.extend(self.__ask_password_if_needed(to_jid, _account,
+                                                        old_status,
+                                                        lang_class))
+        account.set_accounts_status(accounts_status)
+        return result
+
+    def get_available_status(self, _account):
+        """Return status of `_account` when its user is available"""
+        if _account.error is not None:
+            return account.DND
+        elif not _account.enabled:
+            return account.XA
+        else:
+            return account.ONLINE
+
+    def __ask_password_if_needed(self, to_jid, _account, old_status,
+                                 lang_class):
+        """Ask for password of `_account` if it is not stored and the
+        account was offline"""
         if hasattr(_account, 'store_password') \
             and hasattr(_account, 'password') \
             and _account.store_password == False \
             and old_status == account.OFFLINE \
             and _account.password == None :
-            result.extend(self.ask_password(to_jid, _account, lang_class))
-        return result
+            return self.ask_password(to_jid, _account, lang_class)
+        return []
 
     def probe_all_accounts_presence(self):
-        """Send presence probe to all registered accounts"""
-        result = [self.get_presence(self.component.jid,
-                                    user.jid,
+        """Yield presence probe to all registered accounts"""
+        for user_jid in account.get_all_users_jid():
+            yield self.get_presence(self.component.jid, user_jid, "probe")
+        for presence_info in account.get_all_accounts_presence_info():
+            yield self.get_presence(presence_info.jid, presence_info.user_jid,
                                     "probe")
-                  for user in account.get_all_users()]
-        result += [self.get_presence(_account.jid,
-                                     _account.user.jid,
-                                     "probe")
-                   for _account in account.get_all_accounts()]
-        return result
 
     ###### Utils methods ######
     def list_accounts(self, bare_from_jid, account_class=None,
@@ -423,20 +476,20 @@ class AccountManager(object):
         else:
             resource = ""
         model.db_connect()
-        accounts = account.get_accounts(bare_from_jid, account_class)
-        if accounts.count() > 0:
-            for _account in accounts:
+        try:
+            for _account in account.get_accounts(bare_from_jid,
+                                                 account_class):
                 yield (_account, resource, account_type)
-        model.db_disconnect()
+        finally:
+            model.db_disconnect()
 
     def list_account_types(self, lang_class):
         """List account supported types"""
         for account_type in self.account_types:
-            type_label_attr = "type_" + str(account_type).lower() + "_name"
-            if hasattr(lang_class, type_label_attr):
-                type_label = getattr(lang_class, type_label_attr)
-            else:
-                type_label = account_type
+            type_label = get_label(lang_class,
+                                   "type_" + str(account_type).lower()
+                                   + "_name",
+                                   account_type)
             yield (account_type, type_label)
 
     def get_account_class(self, account_type=None,
@@ -456,6 +509,33 @@ class AccountManager(object):
         self.__logger.debug(account_class_name + " class not found")
         return None
 
+    def get_registration_form_template(self, lang_class, _account_class):
+        """
+        Return (register field, label, options) tuples describing
+        `_account_class` registration form fields in `lang_class` language.
+        Computed once, dropped when account_classes is set.
+        """
+        key = (_account_class, lang_class)
+        template = self.registration_form_templates.get(key)
+        if template is not None:
+            return template
+        template = []
+        for field in _account_class.get_register_schema().fields:
+            label = get_label(lang_class, "field_" + field.name, field.name)
+            self.__logger.debug("Adding field " + field.name
+                                + " to registration form template")
+            options = None
+            if field.options is not None:
+                options = [(get_label(lang_class,
+                                      "field_" + field.name + "_"
+                                      + option_value,
+                                      option_value),
+                            option_value)
+                           for option_value in field.options]
+            template.append((field, label, options))
+        self.registration_form_templates[key] = template
+        return template
+
     def generate_registration_form(self, lang_class, _account_class, bare_from_jid):
         """
         Return register form based on language and account class
@@ -468,40 +548,21 @@ class AccountManager(object):
                            name="name",
                            required=True)
 
-        for (field_name,
-             field_type,
-             field_options,
-             post_func,
-             default_func) in \
-                _account_class.get_register_fields():
-            if field_name is None:
-                # TODO : Add page when empty tuple given
-                pass
-            else:
-                lang_label_attr = "field_" + field_name
-                if hasattr(lang_class, lang_label_attr):
-                    label = getattr(lang_class, lang_label_attr)
-                else:
-                    label = field_name
-                self.__logger.debug("Adding field " + field_name + " to registration form")
-                field = reg_form.add_field(field_type=field_type,
-                                           label=label,
-                                           name=field_name,
-                                           value=default_func(bare_from_jid))
-                if field_options is not None:
-                    for option_value in field_options:
-                        lang_label_attr = "field_" + field_name + "_" + option_value
-                        if hasattr(lang_class, lang_label_attr):
-                            label = getattr(lang_class, lang_label_attr)
-                        else:
-                            label = option_value
-                        field.add_option(label=label,
-                                         value=option_value)
-                try:
-                    post_func(None, default_func, bare_from_jid)
-                except:
-                    self.__logger.debug("Setting field " + field_name + " required")
-                    field.required = True
+        for (register_field, label, options) in \
+                self.get_registration_form_template(lang_class,
+                                                    _account_class):
+            field = reg_form.add_field(\
+                field_type=register_field.type,
+                label=label,
+                name=register_field.name,
+                value=register_field.get_default(bare_from_jid))
+            if options is not None:
+                for (option_label, option_value) in options:
+                    field.add_option(label=option_label,
+                                     value=option_value)
+            # default value depends on the user
+            if register_field.is_required(bare_from_jid):
+                field.required = True
         return reg_form
 
     def generate_registration_form_init(self, lang_class, _account):
@@ -542,14 +603,15 @@ class AccountManager(object):
         Set password to given account
         """
         model.db_connect()
-        _account.password = password
-        _account.waiting_password_reply = False
-        result = [Message(from_jid=_account.jid,
-                          to_jid=from_jid,
-                          subject=lang_class.password_saved_for_session,
-                          body=lang_class.password_saved_for_session)]
-        model.db_disconnect()
-        return result
+        try:
+            _account.password = password
+            _account.waiting_password_reply = False
+        finally:
+            model.db_disconnect()
+        return [Message(from_jid=_account.jid,
+                        to_jid=from_jid,
+                        subject=lang_class.password_saved_for_session,
+                        body=lang_class.password_saved_for_session)]
 
     def get_account_error_stanzas(self, _account, exception):
         """Send an error message only one time until _account.error
@@ -617,6 +679,12 @@ class JCLComponent(Component, object):
         self.version = "0.0"
         self.time_unit = 60
         self.queue = Queue(100)
+        self.outbound_queue = None
+        self.send_stop_timeout = 60
+        self.dispatcher = None
+        self.disco_items_cache = DiscoItemsCache()
+        # jabber.DispatchTable of each handlers list
+        self.dispatch_tables = []
         self.account_manager = account_manager_class(self)
         self.msg_handlers = [[PasswordMessageHandler(self),
                               HelpMessageHandler(self)]]
@@ -671,6 +739,11 @@ class JCLComponent(Component, object):
         self.running = True
         try:
             try:
+                self.setup_outbound_queue()
+                self.setup_dispatcher()
+                self.setup_command_sessions()
+                self.setup_command_jobs()
+                self.setup_disco_items_cache()
                 self.connect()
                 self.spool_dir += "/" + unicode(self.jid)
                 self.last_activity = int(time.time())
@@ -680,7 +753,11 @@ class JCLComponent(Component, object):
                 while (self.running and self.stream
                        and not self.stream.eof
                        and self.stream.socket is not None):
-                    self.stream.loop_iter(JCLComponent.timeout)
+                    if self.dispatcher is not None:
+                        self.stream.loop_iter(self.dispatcher.poll_interval)
+                        self.dispatcher.process_results()
+                    else:
+                        self.stream.loop_iter(JCLComponent.timeout)
                     if self.queue.qsize():
                         raise self.queue.get(0)
             except socket.error, e:
@@ -696,10 +773,21 @@ class JCLComponent(Component, object):
             if timer_thread is not None:
                 self.wait_event.set()
                 timer_thread.join(JCLComponent.timeout)
+            if self.dispatcher is not None:
+                self.dispatcher.stop()
+                if self.stream and not self.stream.eof \
+                       and self.stream.socket is not None:
+                    self.dispatcher.process_results()
+                self.dispatcher = None
             if self.stream and not self.stream.eof \
                    and self.stream.socket is not None:
                 presences = self.account_manager.get_presence_all("unavailable")
-                self.send_stanzas(presences)
+                self.send_stanzas(presences, PRIORITY_BULK)
+            if self.outbound_queue is not None:
+                self.outbound_queue.stop(self.send_stop_timeout)
+                self.outbound_queue = None
+            if self.stream and not self.stream.eof \
+                   and self.stream.socket is not None:
                 self.disconnect()
         self.__logger.debug("Exitting normally")
         return (self._restart, wait_before_restart)
@@ -739,7 +827,7 @@ class JCLComponent(Component, object):
             while (self.running and self.stream
                    and not self.stream.eof
                    and self.stream.socket is not None):
-                self.wait_event.wait(self.time_unit)
+                self.wait_event.wait(self.get_tick_delay())
 		if not self.wait_event.is_set():
 		    self.handle_tick()
 		    self.__logger.debug(".")
@@ -756,46 +844,48 @@ class JCLComponent(Component, object):
         """
         self.__logger.debug("AUTHENTICATED")
         Component.authenticated(self)
+        wrap = self.wrap_stanza_handler
         self.stream.set_iq_get_handler("query", "jabber:iq:version",
-                                       self.handle_get_version)
+                                       wrap(self.handle_get_version))
         self.stream.set_iq_get_handler("query", "jabber:iq:register",
-                                       self.handle_get_register)
+                                       wrap(self.handle_get_register))
         self.stream.set_iq_set_handler("query", "jabber:iq:register",
-                                       self.handle_set_register)
+                                       wrap(self.handle_set_register))
         self.stream.set_iq_get_handler("query", "jabber:iq:gateway",
-                                       self.handle_get_gateway)
+                                       wrap(self.handle_get_gateway))
         self.stream.set_iq_set_handler("query", "jabber:iq:gateway",
-                                       self.handle_set_gateway)
+                                       wrap(self.handle_set_gateway))
         self.stream.set_iq_get_handler("query", "jabber:iq:last",
-                                       self.handle_get_last)
+                                       wrap(self.handle_get_last))
 
         self.stream.set_iq_set_handler("command", command.COMMAND_NS,
-                                       self.handle_command)
+                                       wrap(self.handle_command))
 
         self.stream.set_iq_get_handler("vCard", vcard.VCARD_NS,
-                                       self.handle_vcard)
+                                       wrap(self.handle_vcard))
 
         self.stream.set_presence_handler("available",
-                                         self.handle_presence_available)
+                                         wrap(self.handle_presence_available))
 
         self.stream.set_presence_handler("probe",
-                                         self.handle_presence_available)
+                                         wrap(self.handle_presence_available))
 
         self.stream.set_presence_handler("unavailable",
-                                         self.handle_presence_unavailable)
+                                         wrap(self.handle_presence_unavailable))
 
         self.stream.set_presence_handler("unsubscribe",
-                                         self.handle_presence_unsubscribe)
+                                         wrap(self.handle_presence_unsubscribe))
         self.stream.set_presence_handler("unsubscribed",
-                                         self.handle_presence_unsubscribed)
+                                         wrap(self.handle_presence_unsubscribed))
         self.stream.set_presence_handler("subscribe",
-                                         self.handle_presence_subscribe)
+                                         wrap(self.handle_presence_subscribe))
         self.stream.set_presence_handler("subscribed",
-                                         self.handle_presence_subscribed)
+                                         wrap(self.handle_presence_subscribed))
 
         self.stream.set_message_handler("normal",
-                                        self.handle_message)
-        self.send_stanzas(self.account_manager.probe_all_accounts_presence())
+                                        wrap(self.handle_message))
+        self.send_stanzas(self.account_manager.probe_all_accounts_presence(),
+                          PRIORITY_BULK)
 
     def signal_handler(self, signum, frame):
         """Stop method handler
@@ -803,12 +893,141 @@ class JCLComponent(Component, object):
         self.__logger.debug("Signal %i received, shutting down..." % (signum,))
         self.running = False
 
-    def send_stanzas(self, stanzas):
-        """Send given stanza list"""
+    def setup_outbound_queue(self):
+        """
+        Create the outbound queue if 'send_rate' (stanzas per second) is set
+        in [component] section. 'send_burst' is the number of stanzas that
+        can be sent at once (default to send_rate), 'send_queue_size'
+        the number of queued stanzas above which senders wait and
+        'send_stop_timeout' the number of seconds queued stanzas are still
+        sent at send_rate when shutting down.
+        """
+        send_rate = self.get_config_parameter("component", "send_rate")
+        if send_rate is None or float(send_rate) <= 0:
+            self.outbound_queue = None
+            return
+        send_burst = self.get_config_parameter("component", "send_burst") \
+            or send_rate
+        send_queue_size = self.get_config_parameter("component",
+                                                    "send_queue_size") \
+                                                    or 10000
+        send_stop_timeout = self.get_config_parameter("component",
+                                                      "send_stop_timeout") \
+                                                      or 60
+        self.send_stop_timeout = float(send_stop_timeout)
+        self.outbound_queue = OutboundQueue(self.send_stanza,
+                                            float(send_rate),
+                                            float(send_burst),
+                                            int(send_queue_size))
+        self.outbound_queue.start()
+
+    def setup_command_sessions(self):
+        """
+        Create the ad-hoc command session store: 'command_session_store'
+        in [component] section is 'memory' (default) or 'sql' to keep
+        sessions across restarts, 'command_session_ttl' the delay (in
+        seconds) after which an unused session expires and
+        'command_session_max_size' the maximum number of sessions.
+        """
+        store = self.get_config_parameter("component",
+                                          "command_session_store")
+        if store == "sql":
+            backend = SQLSessionBackend()
+        else:
+            backend = MemorySessionBackend()
+        ttl = self.get_config_parameter("component", "command_session_ttl") \
+            or 600
+        max_size = self.get_config_parameter("component",
+                                             "command_session_max_size") \
+                                             or 1000
+        command.command_manager.sessions = SessionStore(backend, int(ttl),
+                                                        int(max_size))
+
+    def setup_command_jobs(self):
+        """
+        Configure background jobs of ad-hoc commands: 'broadcast_chunk_size'
+        in [component] section is the number of users read at once by
+        announcements, 'broadcast_rate' the maximum number of announcement
+        messages sent per second when the outbound queue is disabled (0 for
+        no limit).
+        """
+        chunk_size = self.get_config_parameter("component",
+                                               "broadcast_chunk_size") \
+                                               or 500
+        rate = self.get_config_parameter("component", "broadcast_rate") or 0
+        command.command_manager.broadcast_chunk_size = int(chunk_size)
+        command.command_manager.broadcast_rate = float(rate)
+
+    def setup_disco_items_cache(self):
+        """
+        Set the maximum number of disco#items responses kept in memory from
+        'disco_items_cache_size' in [component] section (0 disables the
+        cache).
+        """
+        max_size = self.get_config_parameter("component",
+                                             "disco_items_cache_size") \
+                                             or 1000
+        self.disco_items_cache.max_size = int(max_size)
+        self.disco_items_cache.clear()
+
+    def setup_dispatcher(self):
+        """
+        Create the stanza dispatcher if 'handler_workers' (number of worker
+        threads) is set in [component] section. 'handler_queue_size' is the
+        number of queued stanzas above which the stream thread stops
+        reading, 'slow_handler_threshold' the handler duration (in seconds)
+        above which a warning is logged.
+        """
+        handler_workers = self.get_config_parameter("component",
+                                                    "handler_workers")
+        if handler_workers is None or int(handler_workers) <= 0:
+            self.dispatcher = None
+            return
+        handler_queue_size = self.get_config_parameter("component",
+                                                       "handler_queue_size") \
+                                                       or 1000
+        slow_handler_threshold = \
+            self.get_config_parameter("component",
+                                      "slow_handler_threshold") or 1.0
+        self.dispatcher = StanzaDispatcher(self, int(handler_workers),
+                                           int(handler_queue_size),
+                                           float(slow_handler_threshold))
+        self.dispatcher.start()
+
+    def wrap_stanza_handler(self, handler):
+        """
+        Return `handler` to be registered in the stream, dispatched to
+        worker threads if enabled.
+        """
+        if self.dispatcher is not None:
+            return self.dispatcher.wrap(handler)
+        return handler
+
+    def send_stanza(self, stanza):
+        """Write stanza to the stream"""
+        if self.stream is not None:
+            self.stream.send(stanza)
+
+    def send_stanzas(self, stanzas, priority=None):
+        """
+        Send given stanza list (or generator). When the outbound queue is
+        enabled, stanzas are queued with `priority` (default depends on
+        stanza type, see jcl.jabber.outbound). PRIORITY_BULK generators
+        are pulled by the outbound queue sender thread so the calling
+        thread does not wait for the rate limiter.
+        """
         self.__logger.debug("Sending responses: " + str(stanzas))
         if stanzas is not None and self.stream is not None:
+            outbound_queue = self.outbound_queue
+            if outbound_queue is not None and priority == PRIORITY_BULK \
+                    and not isinstance(stanzas, (list, tuple)):
+                outbound_queue.put_source(stanzas, priority)
+                return
             for stanza in stanzas:
-                self.stream.send(stanza)
+                if outbound_queue is not None:
+                    outbound_queue.put(stanza, priority)
+                else:
+                    self.stream.send(stanza)
 
     def apply_behavior(self, info_query,
                        account_handler,
@@ -821,26 +1040,30 @@ class JCLComponent(Component, object):
         name = to_jid.node
         account_type = to_jid.resource
         lang_class = self.lang.get_lang_class_from_node(info_query.get_node())
-        # * root
-        # |-* account_type1
-        # | |-* account1
-        # | |-* account2
-        # |-* account_type2
-        #   |-* account3
-        #   |-* account4
-        if name is not None: # account
-            self.__logger.debug("Applying behavior on account " + name)
-            result = account_handler(name, from_jid, account_type or "",
-                                     lang_class)
-        elif account_type is None: # root
-            self.__logger.debug("Applying behavior on root node")
-            result = root_handler(name, from_jid, "",
-                                  lang_class)
-        else: # account type
-            self.__logger.debug("Applying behavior on account type " +
-                                account_type)
-            result = account_type_handler(name, from_jid, account_type,
-                                          lang_class)
+        self.begin_request_context(info_query)
+        try:
+            # * root
+            # |-* account_type1
+            # | |-* account1
+            # | |-* account2
+            # |-* account_type2
+            #   |-* account3
+            #   |-* account4
+            if name is not None: # account
+                self.__logger.debug("Applying behavior on account " + name)
+                result = account_handler(name, from_jid, account_type or "",
+                                         lang_class)
+            elif account_type is None: # root
+                self.__logger.debug("Applying behavior on root node")
+                result = root_handler(name, from_jid, "",
+                                      lang_class)
+            else: # account type
+                self.__logger.debug("Applying behavior on account type " +
+                                    account_type)
+                result = account_type_handler(name, from_jid, account_type,
+                                              lang_class)
+        finally:
+            self.end_request_context(info_query)
         if send_result:
             self.send_stanzas(result)
         return result
@@ -858,14 +1081,38 @@ class JCLComponent(Component, object):
         """
         result = []
         lang_class = self.lang.get_lang_class_from_node(stanza.get_node())
-        for handler_group in handlers:
+        self.begin_request_context(stanza)
+        try:
+            self.__apply_handlers(handlers, stanza, lang_class, result,
+                                  apply_filter_func, apply_handle_func)
+        finally:
+            self.end_request_context(stanza)
+        if send_result:
+            self.send_stanzas(result)
+        return result
+
+    def __apply_handlers(self, handlers, stanza, lang_class, result,
+                         apply_filter_func, apply_handle_func):
+        """Apply handlers for apply_registered_behavior, adding their
+        results to `result`"""
+        # shared filter function -> result for this stanza
+        filter_results = {}
+        for handler_group in self.get_dispatch_table(handlers)\
+                .get_handlers(stanza):
             for handler in handler_group:
                 try:
                     self.__logger.debug("Applying filter " + repr(handler))
-                    if apply_filter_func is not None:
-                        data = apply_filter_func(handler.filter, stanza, lang_class)
+                    filter_func = handler.filter
+                    filter_key = getattr(filter_func, "im_func", filter_func)
+                    shared = getattr(filter_func, "shared", False)
+                    if shared and filter_key in filter_results:
+                        data = filter_results[filter_key]
+                    elif apply_filter_func is not None:
+                        data = apply_filter_func(filter_func, stanza, lang_class)
                     else:
-                        data = handler.filter(stanza, lang_class)
+                        data = filter_func(stanza, lang_class)
+                    if shared:
+                        filter_results[filter_key] = data
                     if data is not None and data != False and data != "":
                         self.__logger.debug("Applying handler " + repr(handler))
                         if apply_handle_func is not None:
@@ -889,9 +1136,36 @@ class JCLComponent(Component, object):
                                        stanza_type="error",
                                        subject=lang_class.error_subject,
                                        body=lang_class.error_body % (e))]
-        if send_result:
-            self.send_stanzas(result)
-        return result
+
+    def begin_request_context(self, stanza):
+        """
+        Start the request context caching objects of `stanza` sender while
+        it is handled (see jcl.model.context)
+        """
+        from_jid = stanza.get_from()
+        if from_jid is not None:
+            context.begin(from_jid.bare())
+
+    def end_request_context(self, stanza):
+        """End the request context started by begin_request_context"""
+        if stanza.get_from() is not None:
+            context.end()
+
+    def get_dispatch_table(self, handlers):
+        """
+        Return the jabber.DispatchTable of `handlers`, rebuilt when handler
+        groups have been modified.
+        """
+        for i in xrange(len(self.dispatch_tables)):
+            table = self.dispatch_tables[i]
+            if table.handlers is handlers:
+                if not table.is_valid(handlers):
+                    table = jabber.DispatchTable(handlers)
+                    self.dispatch_tables[i] = table
+                return table
+        table = jabber.DispatchTable(handlers)
+        self.dispatch_tables.append(table)
+        return table
 
     def handle_get_last(self, info_query):
         """
@@ -1176,6 +1450,11 @@ class JCLComponent(Component, object):
     ###########################################################################
     # Virtual methods
     ###########################################################################
+    def get_tick_delay(self):
+        """Return the delay (in seconds) before the next call to
+        handle_tick"""
+        return self.time_unit
+
     def handle_tick(self):
         """Virtual method
         Called regularly
@@ -21,6 +21,7 @@
 ##
 
 import logging
+import threading
 
 from pyxmpp.jid import JID
 from pyxmpp.jabber.disco import DiscoInfo, DiscoItems, DiscoItem, DiscoIdentity
@@ -28,6 +29,122 @@ import pyxmpp.jabber.vcard as vcard
 
 import jcl.jabber as jabber
 
+class DiscoItemsCache(object):
+    """
+    DiscoItems listing user accounts indexed by (user bare JID, account
+    type, node, lang class). Entries of a user must be invalidated when its
+    accounts change, at most `max_size` entries are kept (0 disables the
+    cache).
+    """
+
+    def __init__(self, max_size=1000):
+        """DiscoItemsCache constructor"""
+        self.__logger = logging.getLogger("jcl.jabber.disco.DiscoItemsCache")
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # key -> [DiscoItems, last access tick]
+        self.entries = {}
+        # bare JID -> set of keys
+        self.user_keys = {}
+        self.tick = 0
+        # incremented on each invalidation to detect changes while a
+        # missing entry is built
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.invalidations = 0
+
+    def get(self, bare_jid, account_type, node, lang_class, build_func):
+        """
+        Return a copy of cached DiscoItems, built by `build_func` (and
+        cached) when missing. build_func must return DiscoItems or None.
+        """
+        if self.max_size <= 0:
+            return build_func()
+        key = (bare_jid, account_type, node, lang_class)
+        self.lock.acquire()
+        try:
+            self.tick += 1
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.hits += 1
+                entry[1] = self.tick
+                # handlers of next groups may add items to the result
+                return DiscoItems(entry[0].xmlnode)
+            self.misses += 1
+            generation = self.generation
+        finally:
+            self.lock.release()
+        disco_items = build_func()
+        if disco_items is None:
+            return None
+        self.lock.acquire()
+        try:
+            if generation == self.generation:
+                self.entries[key] = [DiscoItems(disco_items.xmlnode),
+                                     self.tick]
+                self.user_keys.setdefault(bare_jid, set()).add(key)
+                self.__evict()
+        finally:
+            self.lock.release()
+        return disco_items
+
+    def __remove(self, key):
+        """Remove `key` entry (lock must be held)"""
+        del self.entries[key]
+        keys = self.user_keys.get(key[0])
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self.user_keys[key[0]]
+
+    def __evict(self):
+        """Drop least recently used entries above max_size (lock must be
+        held)"""
+        while len(self.entries) > self.max_size:
+            oldest = None
+            for (key, entry) in self.entries.iteritems():
+                if oldest is None or entry[1] < self.entries[oldest][1]:
+                    oldest = key
+            self.__remove(oldest)
+            self.evicted += 1
+
+    def invalidate(self, bare_jid):
+        """Drop entries of `bare_jid` user"""
+        bare_jid = unicode(bare_jid)
+        self.lock.acquire()
+        try:
+            for key in list(self.user_keys.get(bare_jid, [])):
+                self.__remove(key)
+            self.generation += 1
+            self.invalidations += 1
+        finally:
+            self.lock.release()
+        self.__logger.debug("Invalidated disco items of " + bare_jid)
+
+    def clear(self):
+        """Drop every entry"""
+        self.lock.acquire()
+        try:
+            self.entries = {}
+            self.user_keys = {}
+            self.generation += 1
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        """Return cache statistics as a dictionary"""
+        self.lock.acquire()
+        try:
+            return {"entries": len(self.entries),
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evicted": self.evicted,
+                    "invalidations": self.invalidations}
+        finally:
+            self.lock.release()
+
 class DiscoHandler(object):
     """Handle disco get items requests"""
 
@@ -104,6 +221,12 @@ class RootDiscoGetItemsHandler(DiscoHandler):
         from_jid = stanza.get_from()
         if node is not None:
             return None
+        return [self.component.disco_items_cache.get(\
+                unicode(from_jid.bare()), "", node, lang_class,
+                lambda: self.get_items(from_jid, lang_class, node))]
+
+    def get_items(self, from_jid, lang_class, node):
+        """Return DiscoItems listing account types or accounts"""
         disco_items = None
         if self.component.account_manager.has_multiple_account_type: # list accounts with only one type declared
             disco_items = DiscoItems(node)
@@ -123,7 +246,7 @@ class RootDiscoGetItemsHandler(DiscoHandler):
                           JID(unicode(_account.jid) + resource),
                           account_type + _account.name,
                           _account.long_name)
-        return [disco_items]
+        return disco_items
 
 class AccountTypeDiscoGetItemsHandler(DiscoHandler):
 
@@ -143,17 +266,24 @@ class AccountTypeDiscoGetItemsHandler(DiscoHandler):
         self.__logger.debug("Listing account for " + account_type)
         account_class = self.component.account_manager.get_account_class(account_type)
         if account_class is not None:
-            disco_items = DiscoItems(node)
-            for (_account, resource, account_type) in \
-                    self.component.account_manager.list_accounts(unicode(from_jid.bare()),
-                                                                 account_class,
-                                                                 account_type=account_type):
-                DiscoItem(disco_items,
-                          JID(unicode(_account.jid) + resource),
-                          account_type + _account.name,
-                          _account.long_name)
-            return [disco_items]
+            return [self.component.disco_items_cache.get(\
+                    unicode(from_jid.bare()), account_type, node, lang_class,
+                    lambda: self.get_items(from_jid, account_class,
+                                           account_type, node))]
         else:
             self.__logger.error("Error: " + str(account_class)
                                 + " class not in account_classes")
             return []
+
+    def get_items(self, from_jid, account_class, account_type, node):
+        """Return DiscoItems listing `account_type` accounts"""
+        disco_items = DiscoItems(node)
+        for (_account, resource, account_type) in \
+                self.component.account_manager.list_accounts(unicode(from_jid.bare()),
+                                                             account_class,
+                                                             account_type=account_type):
+            DiscoItem(disco_items,
+                      JID(unicode(_account.jid) + resource),
+                      account_type + _account.name,
+                      _account.long_name)
+        return disco_items
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+##
+## dispatcher.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+
+"""Worker pool running stanza handlers outside of the stream thread"""
+
+__revision__ = ""
+
+import logging
+import threading
+import time
+from collections import deque
+from Queue import Queue, Empty
+
+from pyxmpp.stanza import Stanza
+from pyxmpp.exceptions import ProtocolError
+
+class StanzaDispatcher(object):
+    """
+    Run stanza handlers in a pool of worker threads. Stanzas from the same
+    bare JID are handled one at a time in reception order. Handler
+    responses are queued and sent by the stream thread when it calls
+    process_results.
+    """
+
+    def __init__(self, component, workers=4, max_size=1000,
+                 slow_handler_threshold=1.0, poll_interval=0.05):
+        """StanzaDispatcher constructor"""
+        self.__logger = logging.getLogger("jcl.jabber.dispatcher.StanzaDispatcher")
+        self.component = component
+        self.workers = workers
+        self.max_size = max_size
+        self.slow_handler_threshold = slow_handler_threshold
+        self.poll_interval = poll_interval
+        self.condition = threading.Condition()
+        # bare JID -> list of (handler, stanza, enqueue time), the first task
+        # of a list is being processed or is waiting for a worker
+        self.pending = {}
+        # bare JIDs whose first task is waiting for a worker
+        self.ready = deque()
+        self.size = 0
+        self.max_depth = 0
+        self.results = Queue()
+        self.threads = []
+        self.running = False
+        # handler name -> [count, total time, max time]
+        self.handler_stats = {}
+        self.total_wait = 0.0
+        self.handled = 0
+
+    def wrap(self, handler):
+        """Return a stream handler dispatching stanzas to `handler`"""
+        def dispatch_stanza(stanza):
+            return self.dispatch(handler, stanza)
+        return dispatch_stanza
+
+    def dispatch(self, handler, stanza):
+        """
+        Queue `stanza` for `handler`. Block the stream thread while the
+        queue is full. Run `handler` directly if workers are not started.
+        """
+        if not self.running:
+            return handler(stanza)
+        from_jid = stanza.get_from()
+        if from_jid is not None:
+            bare_jid = unicode(from_jid.bare())
+        else:
+            bare_jid = None
+        # the stream frees the stanza once its handler has returned
+        stanza = stanza.__class__(stanza)
+        self.condition.acquire()
+        try:
+            while self.running and self.size >= self.max_size:
+                self.condition.wait()
+            task = (handler, stanza, time.time())
+            if bare_jid in self.pending:
+                self.pending[bare_jid].append(task)
+            else:
+                self.pending[bare_jid] = [task]
+                self.ready.append(bare_jid)
+            self.size += 1
+            self.max_depth = max(self.max_depth, self.size)
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        return True
+
+    def __get_handler_name(self, handler):
+        """Return name used in statistics for `handler`"""
+        return getattr(handler, "__name__", repr(handler))
+
+    def handle(self, handler, stanza, enqueue_time):
+        """Run `handler` on `stanza` and queue its response"""
+        start = time.time()
+        try:
+            try:
+                response = handler(stanza)
+            except ProtocolError, error:
+                self.__logger.debug("Protocol error in " + repr(handler),
+                                    exc_info=True)
+                response = stanza.make_error_response(error.xmpp_name)
+            except Exception:
+                self.__logger.error("Error with handler " + repr(handler)
+                                    + " with " + str(stanza) + ": ",
+                                    exc_info=True)
+                if stanza.stanza_type == "iq" \
+                        and stanza.get_type() in ("get", "set"):
+                    response = stanza.make_error_response(\
+                        "internal-server-error")
+                else:
+                    response = None
+            if isinstance(response, Stanza):
+                response = [response]
+            elif response is not None and response is not True \
+                    and response is not False:
+                response = [_stanza for _stanza in response
+                            if isinstance(_stanza, Stanza)]
+            else:
+                response = None
+            if response:
+                self.results.put(response)
+        finally:
+            end = time.time()
+            duration = end - start
+            name = self.__get_handler_name(handler)
+            if duration > self.slow_handler_threshold:
+                self.__logger.warning("Slow handler " + name + ": "
+                                      + str(duration) + "s")
+            self.condition.acquire()
+            try:
+                stats = self.handler_stats.setdefault(name, [0, 0.0, 0.0])
+                stats[0] += 1
+                stats[1] += duration
+                stats[2] = max(stats[2], duration)
+                self.total_wait += start - enqueue_time
+                self.handled += 1
+            finally:
+                self.condition.release()
+
+    def run(self):
+        """Worker thread loop"""
+        self.__logger.debug("Worker thread started...")
+        while True:
+            self.condition.acquire()
+            try:
+                # pending stanzas are handled before stopping
+                while self.running and not self.ready:
+                    self.condition.wait()
+                if not self.ready:
+                    break
+                bare_jid = self.ready.popleft()
+                (handler, stanza, enqueue_time) = self.pending[bare_jid][0]
+            finally:
+                self.condition.release()
+            try:
+                self.handle(handler, stanza, enqueue_time)
+            finally:
+                self.condition.acquire()
+                try:
+                    tasks = self.pending[bare_jid]
+                    del tasks[0]
+                    if tasks:
+                        self.ready.append(bare_jid)
+                    else:
+                        del self.pending[bare_jid]
+                    self.size -= 1
+                    self.condition.notifyAll()
+                finally:
+                    self.condition.release()
+        self.__logger.debug("Worker thread terminated...")
+
+    def start(self):
+        """Start worker threads"""
+        self.condition.acquire()
+        try:
+            self.running = True
+        finally:
+            self.condition.release()
+        for i in xrange(self.workers):
+            thread = threading.Thread(target=self.run,
+                                      name="WorkerThread-" + str(i))
+            thread.setDaemon(True)
+            thread.start()
+            self.threads.append(thread)
+
+    def stop(self):
+        """Wait for queued stanzas to be handled and stop worker threads"""
+        self.condition.acquire()
+        try:
+            self.running = False
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def process_results(self):
+        """Send handlers responses (must be called from the stream thread)"""
+        while True:
+            try:
+                response = self.results.get_nowait()
+            except Empty:
+                return
+            self.component.send_stanzas(response)
+
+    def get_stats(self):
+        """Return dispatcher statistics as a dictionary"""
+        self.condition.acquire()
+        try:
+            if self.handled > 0:
+                average_wait = self.total_wait / self.handled
+            else:
+                average_wait = 0.0
+            handlers = {}
+            for (name, (count, total, max_time)) \
+                    in self.handler_stats.iteritems():
+                handlers[name] = {"count": count,
+                                  "average_latency": total / count,
+                                  "max_latency": max_time}
+            return {"depth": self.size,
+                    "max_depth": self.max_depth,
+                    "users": len(self.pending),
+                    "handled": self.handled,
+                    "average_wait": average_wait,
+                    "handlers": handlers}
+        finally:
+            self.condition.release()
@@ -27,12 +27,23 @@ implementation"""
 __revision__ = "$Id: feeder.py,v 1.3 2005/09/18 20:24:07 dax Exp $"
 
 import logging
+import threading
+import time
+import random
+import heapq
+import math
+import select
+from collections import deque
+
+from sqlobject.main import SQLObjectNotFound
 
 from jcl.jabber import Handler
 from jcl.jabber.component import JCLComponent, AccountManager
 from jcl.lang import Lang
 from jcl.jabber.command import JCLCommandManager
 
+import jcl.model as model
+
 from pyxmpp.message import Message
 
 class FeederComponent(JCLComponent):
@@ -65,15 +76,144 @@ class FeederComponent(JCLComponent):
                               command_manager_class=command_manager_class)
         # Define default feeder and sender, can be override
         self.tick_handlers = [FeederHandler(Feeder(self), Sender(self))]
+        self.feeder_engine = None
+        self.feeder_scheduler = None
         self.__logger = logging.getLogger("jcl.jabber.FeederComponent")
 
+    def run(self):
+        """Start the feeder engine around JCLComponent main loop"""
+        self.setup_feeder_engine()
+        self.setup_feeder_scheduler()
+        try:
+            return JCLComponent.run(self)
+        finally:
+            self.feeder_scheduler = None
+            if self.feeder_engine is not None:
+                self.feeder_engine.stop()
+                self.feeder_engine = None
+
+    def setup_feeder_engine(self):
+        """
+        Create the feeder engine if 'feeder_workers' (number of threads
+        feeding accounts) is set in [component] section or if accounts are
+        scheduled one by one. 'feeder_timeout' is the number of seconds
+        after which a tick stops waiting for an account.
+        'feeder_async_class_limit' and 'feeder_async_host_limit' are the
+        maximum numbers of accounts of one class and of one remote host
+        fed at the same time by AsyncFeeder.
+        """
+        feeder_workers = int(self.get_config_parameter("component",
+                                                       "feeder_workers")
+                             or 0)
+        if feeder_workers <= 0 \
+                and self.get_config_parameter("component",
+                                              "feeder_scheduling") \
+                != "account":
+            self.feeder_engine = None
+            return
+        feeder_timeout = self.get_config_parameter("component",
+                                                   "feeder_timeout")
+        if feeder_timeout is not None and float(feeder_timeout) > 0:
+            feeder_timeout = float(feeder_timeout)
+        else:
+            feeder_timeout = None
+        async_class_limit = \
+            self.get_config_parameter("component",
+                                      "feeder_async_class_limit") or 100
+        async_host_limit = \
+            self.get_config_parameter("component",
+                                      "feeder_async_host_limit") or 4
+        self.feeder_engine = FeederEngine(\
+            self, max(feeder_workers, 0), feeder_timeout,
+            async_class_limit=int(async_class_limit),
+            async_host_limit=int(async_host_limit))
+        if feeder_workers > 0:
+            self.feeder_engine.start()
+
+    def setup_feeder_scheduler(self):
+        """
+        Create the feeder scheduler if 'feeder_scheduling' is 'account' in
+        [component] section: each account is then fed at its own interval
+        instead of every account at each tick. 'feeder_jitter' is the
+        fraction of the interval randomly added or removed,
+        'feeder_max_backoff' the maximum factor applied to the interval of
+        accounts returning nothing or failing and 'feeder_refresh_interval'
+        the delay (in seconds) between two reloads of the accounts list.
+        """
+        scheduling = self.get_config_parameter("component",
+                                               "feeder_scheduling")
+        if scheduling != "account":
+            self.feeder_scheduler = None
+            return
+        jitter = self.get_config_parameter("component", "feeder_jitter") \
+            or 0.1
+        max_backoff = self.get_config_parameter("component",
+                                                "feeder_max_backoff") or 8
+        refresh_interval = \
+            self.get_config_parameter("component",
+                                      "feeder_refresh_interval") or 300
+        self.feeder_scheduler = FeederScheduler(self.feeder_engine,
+                                                self.time_unit,
+                                                float(jitter),
+                                                float(max_backoff),
+                                                float(refresh_interval))
+
+    def get_tick_delay(self):
+        """Return the delay before the scheduler next due account or the
+        next batch to flush"""
+        if self.feeder_scheduler is not None:
+            delay = self.feeder_scheduler.get_delay()
+            for sender in self.get_batching_senders():
+                flush_delay = sender.get_flush_delay()
+                if flush_delay is not None:
+                    delay = min(delay, flush_delay)
+            return delay
+        return JCLComponent.get_tick_delay(self)
+
+    def get_batching_senders(self):
+        """Return BatchingSender of tick handlers"""
+        return [handler.sender for handler in self.tick_handlers
+                if isinstance(getattr(handler, "sender", None),
+                              BatchingSender)]
+
+    def time_handler(self):
+        """
+        Timer thread handler. Batches still waiting are sent when it ends,
+        before JCLComponent.run sends unavailable presences and closes the
+        stream.
+        """
+        try:
+            JCLComponent.time_handler(self)
+        finally:
+            if self.stream and not self.stream.eof \
+                    and self.stream.socket is not None:
+                try:
+                    self.flush_senders(True)
+                except Exception:
+                    self.__logger.error("Error while sending batches:",
+                                        exc_info=True)
+
+    def flush_senders(self, force=False):
+        """Send batches of BatchingSender which are due (or all of them if
+        `force`)"""
+        for sender in self.get_batching_senders():
+            sender.flush(force)
+
     def handle_tick(self):
         """Implement main feed/send behavior"""
-        for handler in self.tick_handlers:
-            handler.handle(\
-                None, self.lang.get_default_lang_class(),
-                handler.filter(None,
-                               self.lang.get_default_lang_class()))
+        if self.feeder_scheduler is not None:
+            self.feeder_scheduler.run(self.tick_handlers,
+                                      self.lang.get_default_lang_class())
+        elif self.feeder_engine is not None and self.feeder_engine.running:
+            self.feeder_engine.run_tick(self.tick_handlers,
+                                        self.lang.get_default_lang_class())
+        else:
+            for handler in self.tick_handlers:
+                handler.handle(\
+                    None, self.lang.get_default_lang_class(),
+                    handler.filter(None,
+                                   self.lang.get_default_lang_class()))
+        self.flush_senders()
 
 class Feeder(object):
     """Abstract feeder class"""
@@ -84,6 +224,117 @@ class Feeder(object):
         """Feed data for given account"""
         raise NotImplementedError
 
+class FeedWait(object):
+    """
+    Event yielded by AsyncFeeder.feed_async to wait for a file (socket) to
+    be readable or writable, or for a delay.
+    """
+
+    def __init__(self, read=None, write=None, timeout=None):
+        """FeedWait constructor"""
+        self.read = read
+        self.write = write
+        self.timeout = timeout
+
+    def block(self):
+        """Wait for the event, blocking the current thread"""
+        if self.read is None and self.write is None:
+            if self.timeout:
+                time.sleep(self.timeout)
+            return
+        wait_files([_file for _file in [self.read] if _file is not None],
+                   [_file for _file in [self.write] if _file is not None],
+                   self.timeout)
+
+def wait_files(read_files, write_files, timeout=None):
+    """
+    Wait at most `timeout` seconds (None for no limit) for files (or file
+    descriptors) of `read_files` to be readable or of `write_files` to be
+    writable. Return (readable files, writable files). select.poll is used
+    when available as select.select cannot wait for file descriptors above
+    FD_SETSIZE (usually 1024).
+    """
+    if not hasattr(select, "poll"):
+        (readable, writable, errors) = select.select(read_files, write_files,
+                                                     [], timeout)
+        return (readable, writable)
+    read_mask = select.POLLIN | select.POLLPRI
+    write_mask = select.POLLOUT
+    # errors and hang ups wake up readers and writers, as with select
+    error_mask = select.POLLERR | select.POLLHUP | select.POLLNVAL
+    # file descriptor -> (read files, write files)
+    files = {}
+    events = {}
+    for _file in read_files:
+        fileno = get_fileno(_file)
+        files.setdefault(fileno, ([], []))[0].append(_file)
+        events[fileno] = events.get(fileno, 0) | read_mask
+    for _file in write_files:
+        fileno = get_fileno(_file)
+        files.setdefault(fileno, ([], []))[1].append(_file)
+        events[fileno] = events.get(fileno, 0) | write_mask
+    poller = select.poll()
+    for (fileno, event_mask) in events.iteritems():
+        poller.register(fileno, event_mask)
+    if timeout is not None:
+        # in milliseconds, rounded up not to poll again before timeout
+        timeout = int(math.ceil(timeout * 1000))
+    readable = []
+    writable = []
+    for (fileno, event) in poller.poll(timeout):
+        (fd_read_files, fd_write_files) = files[fileno]
+        if event & (read_mask | error_mask):
+            readable.extend(fd_read_files)
+        if event & (write_mask | error_mask):
+            writable.extend(fd_write_files)
+    return (readable, writable)
+
+def get_fileno(_file):
+    """Return file descriptor of `_file` (a file object or descriptor)"""
+    if isinstance(_file, (int, long)):
+        return _file
+    return _file.fileno()
+
+def wait_read(_file, timeout=None):
+    """Return FeedWait for `_file` to be readable"""
+    return FeedWait(read=_file, timeout=timeout)
+
+def wait_write(_file, timeout=None):
+    """Return FeedWait for `_file` to be writable"""
+    return FeedWait(write=_file, timeout=timeout)
+
+def sleep(delay):
+    """Return FeedWait for `delay` seconds"""
+    return FeedWait(timeout=delay)
+
+class AsyncFeeder(Feeder):
+    """
+    Abstract feeder not blocking while waiting for the network.
+    feed_async is a generator yielding data to send and FeedWait events
+    (see wait_read, wait_write and sleep) on non-blocking sockets.
+    Thousands of accounts can then be fed by a FeederEngine in a single
+    thread (AsyncFeederLoop).
+    """
+
+    def feed_async(self, _account):
+        """Return a generator feeding data for given account"""
+        raise NotImplementedError
+
+    def get_host(self, _account):
+        """Return remote host polled for `_account`, used to limit
+        concurrent polls per host (None for no limit)"""
+        return None
+
+    def feed(self, _account):
+        """Run feed_async blocking the current thread"""
+        result = []
+        for data in self.feed_async(_account):
+            if isinstance(data, FeedWait):
+                data.block()
+            else:
+                result.append(data)
+        return result
+
 class Sender(object):
     """Abstract sender class"""
     def __init__(self, component = None):
@@ -108,9 +359,7 @@ class MessageSender(Sender):
         """Implement abstract method from Sender class and send
         data as Jabber message.
         """
-        if self.component.stream is not None:
-            self.component.stream.send(self.create_message(to_account,
-                                                           data))
+        self.component.send_stanzas([self.create_message(to_account, data)])
 
 class HeadlineSender(MessageSender):
     """Send data as Jabber Headline"""
@@ -124,16 +373,213 @@ class HeadlineSender(MessageSender):
                        stanza_type="headline",
                        body=body)
 
+def merge_data(items):
+    """
+    Merge (subject, body) data `items` into one (subject, body): the subject
+    of the first one and every subject and body in the body.
+    """
+    if len(items) == 1:
+        return items[0]
+    bodies = []
+    for (subject, body) in items:
+        if subject:
+            bodies.append(subject + "\n" + (body or ""))
+        else:
+            bodies.append(body or "")
+    return (items[0][0], "\n\n".join(bodies))
+
+class BatchingSender(MessageSender):
+    """
+    Coalesce data sent to the same user by the same account into one
+    message, sent once `batch_size` data are waiting or `max_delay`
+    seconds after the first one (when flush is called).
+    """
+
+    def __init__(self, component=None, batch_size=10, max_delay=60,
+                 stanza_type=None):
+        """BatchingSender constructor"""
+        MessageSender.__init__(self, component)
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.stanza_type = stanza_type
+        self.lock = threading.Lock()
+        # (account jid, user jid) -> [first data time, data list]
+        self.batches = {}
+        self.sent_messages = 0
+        self.batched_data = 0
+
+    def create_batch_message(self, from_jid, to_jid, items):
+        """Create message sending `items`"""
+        subject, body = merge_data(items)
+        return Message(from_jid=from_jid,
+                       to_jid=to_jid,
+                       subject=subject,
+                       stanza_type=self.stanza_type,
+                       body=body)
+
+    def send(self, to_account, data):
+        """Add data to the batch of `to_account` user, sending it if
+        full"""
+        key = (to_account.jid, to_account.user.jid)
+        self.lock.acquire()
+        try:
+            self.batched_data += 1
+            if key in self.batches:
+                batch = self.batches[key]
+            else:
+                batch = [time.time(), []]
+                self.batches[key] = batch
+            batch[1].append(data)
+            if len(batch[1]) < self.batch_size:
+                return
+            del self.batches[key]
+            self.sent_messages += 1
+        finally:
+            self.lock.release()
+        self.component.send_stanzas([self.create_batch_message(\
+                    key[0], key[1], batch[1])])
+
+    def flush(self, force=False):
+        """Send batches older than max_delay (every batch if `force`)"""
+        now = time.time()
+        messages = []
+        self.lock.acquire()
+        try:
+            for (key, (first_time, items)) in self.batches.items():
+                if force or now - first_time >= self.max_delay:
+                    del self.batches[key]
+                    messages.append(self.create_batch_message(key[0],
+                                                              key[1],
+                                                              items))
+            self.sent_messages += len(messages)
+        finally:
+            self.lock.release()
+        if messages:
+            self.component.send_stanzas(messages)
+
+    def get_flush_delay(self):
+        """Return the delay before the oldest batch must be sent (None if
+        there is no batch)"""
+        self.lock.acquire()
+        try:
+            if not self.batches:
+                return None
+            first_time = min([batch[0]
+                              for batch in self.batches.itervalues()])
+            return max(first_time + self.max_delay - time.time(), 0)
+        finally:
+            self.lock.release()
+
+class FeedPipeline(object):
+    """
+    Chain of stages applied lazily to data fed for an account before
+    being sent. A stage is a callable taking the account and an iterable
+    of data and returning an iterable of data (see FilterStage,
+    TransformStage, DedupStage and BatchStage).
+    """
+
+    def __init__(self, stages=None):
+        """FeedPipeline constructor"""
+        self.stages = list(stages or [])
+
+    def add(self, stage):
+        """Append `stage` to the pipeline and return the pipeline"""
+        self.stages.append(stage)
+        return self
+
+    def process(self, _account, items):
+        """Return an iterator over `items` processed by every stage"""
+        items = iter(items)
+        for stage in self.stages:
+            items = stage(_account, items)
+        return items
+
+class FilterStage(object):
+    """Keep data for which predicate(account, data) is true"""
+
+    def __init__(self, predicate):
+        """FilterStage constructor"""
+        self.predicate = predicate
+
+    def __call__(self, _account, items):
+        for data in items:
+            if self.predicate(_account, data):
+                yield data
+
+class TransformStage(object):
+    """Replace data by function(account, data), dropping None results"""
+
+    def __init__(self, function):
+        """TransformStage constructor"""
+        self.function = function
+
+    def __call__(self, _account, items):
+        for data in items:
+            data = self.function(_account, data)
+            if data is not None:
+                yield data
+
+class DedupStage(object):
+    """
+    Drop data already sent for the same account. The last `max_size` keys
+    (key(data), data by default) of each account are remembered.
+    """
+
+    def __init__(self, key=None, max_size=100):
+        """DedupStage constructor"""
+        self.key = key
+        self.max_size = max_size
+        # account id -> (set of keys, deque of keys in sending order)
+        self.seen = {}
+
+    def __call__(self, _account, items):
+        (keys, order) = self.seen.setdefault(_account.id, (set(), deque()))
+        for data in items:
+            if self.key is not None:
+                key = self.key(data)
+            else:
+                key = data
+            if key in keys:
+                continue
+            keys.add(key)
+            order.append(key)
+            if len(order) > self.max_size:
+                keys.discard(order.popleft())
+            yield data
+
+class BatchStage(object):
+    """Merge every `size` data fed for an account into one (see
+    merge_data)"""
+
+    def __init__(self, size=10, merge=merge_data):
+        """BatchStage constructor"""
+        self.size = size
+        self.merge = merge
+
+    def __call__(self, _account, items):
+        batch = []
+        for data in items:
+            batch.append(data)
+            if len(batch) >= self.size:
+                yield self.merge(batch)
+                batch = []
+        if batch:
+            yield self.merge(batch)
+
 class FeederHandler(Handler):
     """
     Filter (nothing by default) and call sender for each message from
-    Feeder.
+    Feeder. Data can be processed by a FeedPipeline before being sent,
+    chosen by account class in `pipelines` or `pipeline` by default.
     """
 
-    def __init__(self, feeder, sender):
+    def __init__(self, feeder, sender, pipeline=None):
         """DefaultFeederHandler constructor"""
         self.feeder = feeder
         self.sender = sender
+        self.pipeline = pipeline
+        # account class -> FeedPipeline
+        self.pipelines = {}
 
     def handle(self, stanza, lang_class, data):
         """
@@ -142,7 +588,753 @@ class FeederHandler(Handler):
         """
         for _account in data:
             if _account.enabled:
-                for data in self.feeder.feed(_account):
-                    if self.sender is not None:
-                        self.sender.send(_account, data)
+                self.feed_account(_account)
         return []
+
+    def feed_account(self, _account):
+        """Feed data for `_account` and send it. Return the number of data
+        sent"""
+        return self.send_data(_account, self.feeder.feed(_account))
+
+    def get_pipeline(self, _account):
+        """Return the FeedPipeline of `_account` class (or of its nearest
+        parent class) or the default one"""
+        for account_class in _account.__class__.__mro__:
+            if account_class in self.pipelines:
+                return self.pipelines[account_class]
+        return self.pipeline
+
+    def send_data(self, _account, items):
+        """Process `items` with `_account` pipeline and send them. Return
+        the number of data sent"""
+        pipeline = self.get_pipeline(_account)
+        if pipeline is not None:
+            items = pipeline.process(_account, items)
+        count = 0
+        for data in items:
+            count += 1
+            if self.sender is not None:
+                self.sender.send(_account, data)
+        return count
+
+    def get_feed_interval(self, _account):
+        """
+        Return the number of seconds between two feeds of `_account` when
+        accounts are scheduled one by one (None to use the component
+        time_unit)
+        """
+        return None
+
+class FeedTimeoutError(Exception):
+    """Raised when feeding an account takes more than the engine timeout"""
+
+    def __init__(self, timeout):
+        Exception.__init__(self)
+        self.timeout = timeout
+
+    def __str__(self):
+        return "Feed timeout (" + str(self.timeout) + "s)"
+
+class FeedTask(object):
+    """Feeding of one account by a FeederHandler during a tick"""
+
+    def __init__(self, handler, _account, key):
+        """FeedTask constructor"""
+        self.handler = handler
+        self.account = _account
+        self.key = key
+        self.tick = None
+        self.worker = None
+        self.start_time = None
+        self.timed_out = False
+        self.skipped = False
+        self.error = False
+        # number of data fed
+        self.count = 0
+        # AsyncFeeder generator and (account class name, host) it is
+        # counted in
+        self.coroutine = None
+        self.limit_keys = None
+        # data fed by an AsyncFeeder, kept until the end of the feed when
+        # processed by a pipeline
+        self.pipeline = None
+        self.data = []
+
+class FeederEngine(object):
+    """
+    Feed accounts of FeederHandler instances in a pool of worker threads.
+    A tick returns once every account has been fed or has timed out. An
+    account still being fed when the next tick starts is skipped by it.
+    Errors are isolated per account and sent with get_account_error_stanzas.
+    The worker of a timed out account is replaced by a new thread unless
+    `max_abandoned` (default to `workers`) workers are already stuck.
+    """
+
+    def __init__(self, component, workers=4, feed_timeout=None,
+                 poll_interval=1, async_class_limit=100, async_host_limit=4,
+                 max_abandoned=None):
+        """FeederEngine constructor"""
+        self.__logger = logging.getLogger("jcl.jabber.feeder.FeederEngine")
+        self.component = component
+        self.workers = workers
+        self.feed_timeout = feed_timeout
+        self.poll_interval = poll_interval
+        if max_abandoned is None:
+            max_abandoned = workers
+        self.max_abandoned = max_abandoned
+        self.loop = AsyncFeederLoop(self, async_class_limit,
+                                    async_host_limit)
+        self.condition = threading.Condition()
+        self.tasks = deque()
+        # tasks being fed
+        self.running_tasks = []
+        # (handler, account id) of tasks queued or being fed
+        self.in_progress = set()
+        # workers stuck on a timed out task, stopping once it is done
+        self.abandoned = set()
+        self.threads = []
+        self.running = False
+        self.worker_count = 0
+        # account class name -> [count, total time, max time, errors,
+        # timeouts]
+        self.feed_stats = {}
+        self.ticks = 0
+        self.skipped = 0
+
+    def start(self):
+        """Start worker threads"""
+        self.condition.acquire()
+        try:
+            self.running = True
+            for i in xrange(self.workers):
+                self.__start_worker()
+        finally:
+            self.condition.release()
+
+    def __start_worker(self):
+        """Start a new worker thread (condition must be acquired)"""
+        thread = threading.Thread(target=self.run,
+                                  name="FeederThread-"
+                                  + str(self.worker_count))
+        thread.setDaemon(True)
+        self.worker_count += 1
+        self.threads.append(thread)
+        thread.start()
+
+    def stop(self):
+        """
+        Drop queued accounts and stop worker threads, waiting at most
+        feed_timeout for accounts being fed.
+        """
+        self.condition.acquire()
+        try:
+            self.running = False
+            for task in self.tasks:
+                self.in_progress.discard(task.key)
+                task.tick[0] -= 1
+            self.tasks.clear()
+            self.condition.notifyAll()
+            threads = self.threads
+            self.threads = []
+        finally:
+            self.condition.release()
+        for thread in threads:
+            thread.join(self.feed_timeout)
+
+    def run(self):
+        """Worker thread loop"""
+        thread = threading.currentThread()
+        self.__logger.debug("Feeder thread started...")
+        while True:
+            self.condition.acquire()
+            try:
+                while self.running and not self.tasks:
+                    self.condition.wait()
+                if not self.running:
+                    break
+                task = self.tasks.popleft()
+                task.worker = thread
+                task.start_time = time.time()
+                self.running_tasks.append(task)
+                self.condition.notifyAll()
+            finally:
+                self.condition.release()
+            try:
+                self.feed(task)
+            finally:
+                self.condition.acquire()
+                try:
+                    self.running_tasks.remove(task)
+                    self.in_progress.discard(task.key)
+                    if not task.timed_out:
+                        task.tick[0] -= 1
+                    self.condition.notifyAll()
+                    if thread in self.abandoned:
+                        self.abandoned.remove(thread)
+                        break
+                finally:
+                    self.condition.release()
+        self.__logger.debug("Feeder thread terminated...")
+
+    def feed(self, task):
+        """Feed account of `task` and send error stanzas on failure"""
+        _account = task.account
+        model.db_connect()
+        try:
+            try:
+                task.count = task.handler.feed_account(_account) or 0
+            except Exception, exception:
+                task.error = True
+                if not task.timed_out:
+                    self.send_error(_account, exception)
+                else:
+                    self.__logger.error("Error while feeding timed out "
+                                        + "account " + str(task.key) + ":",
+                                        exc_info=True)
+        finally:
+            model.db_disconnect()
+            self.record_stats(_account, time.time() - task.start_time,
+                              error=task.error)
+
+    def send_error(self, _account, exception):
+        """Send error stanzas of `_account`, never raising"""
+        model.db_connect()
+        try:
+            try:
+                self.component.send_error(_account, exception)
+            except Exception:
+                self.__logger.error("Error while sending account error:",
+                                    exc_info=True)
+        finally:
+            model.db_disconnect()
+
+    def record_stats(self, _account, duration, error=False, timeout=False):
+        """Update feed statistics of `_account` class"""
+        self.condition.acquire()
+        try:
+            stats = self.feed_stats.setdefault(_account.__class__.__name__,
+                                               [0, 0.0, 0.0, 0, 0])
+            if timeout:
+                stats[4] += 1
+                return
+            stats[0] += 1
+            stats[1] += duration
+            stats[2] = max(stats[2], duration)
+            if error:
+                stats[3] += 1
+        finally:
+            self.condition.release()
+
+    def get_tasks(self, handlers, lang_class):
+        """
+        Return FeedTask of enabled accounts of FeederHandler in `handlers`.
+        Other handlers are run directly.
+        """
+        tasks = []
+        model.db_connect()
+        try:
+            for handler in handlers:
+                if not hasattr(handler, "feed_account"):
+                    handler.handle(None, lang_class,
+                                   handler.filter(None, lang_class))
+                    continue
+                for _account in handler.filter(None, lang_class):
+                    if not _account.enabled:
+                        continue
+                    key = (id(handler), _account.id)
+                    tasks.append(FeedTask(handler, _account, key))
+        finally:
+            model.db_disconnect()
+        return tasks
+
+    def run_tick(self, handlers, lang_class):
+        """Feed accounts of `handlers` and wait until they are fed"""
+        self.run_tasks(self.get_tasks(handlers, lang_class))
+
+    def run_tasks(self, tasks):
+        """
+        Feed accounts of `tasks` and wait until they are fed or timed out.
+        Accounts of AsyncFeeder are fed by the AsyncFeederLoop in the
+        current thread while others are fed by worker threads, or in the
+        current thread if workers are not started.
+        """
+        sync_tasks = []
+        async_tasks = []
+        for task in tasks:
+            if isinstance(getattr(task.handler, "feeder", None), AsyncFeeder):
+                async_tasks.append(task)
+            else:
+                sync_tasks.append(task)
+        self.condition.acquire()
+        try:
+            self.ticks += 1
+        finally:
+            self.condition.release()
+        if not self.running:
+            self.loop.run(async_tasks)
+            for task in sync_tasks:
+                task.start_time = time.time()
+                self.feed(task)
+            return
+        tick = self.__queue_tasks(sync_tasks)
+        self.loop.run(async_tasks)
+        self.__wait_tasks(tick)
+
+    def __queue_tasks(self, tasks):
+        """
+        Queue `tasks` for worker threads, skipping accounts still being
+        fed. Return the tick counter of queued tasks.
+        """
+        # number of tasks of the tick neither done nor timed out
+        tick = [0]
+        self.condition.acquire()
+        try:
+            for task in tasks:
+                task.tick = tick
+                if task.key in self.in_progress:
+                    task.skipped = True
+                    self.skipped += 1
+                    self.__logger.warning("Account " + str(task.key)
+                                          + " still being fed, skipped")
+                    continue
+                self.in_progress.add(task.key)
+                self.tasks.append(task)
+                tick[0] += 1
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        return tick
+
+    def __wait_tasks(self, tick):
+        """Wait for tasks of `tick` to be fed or timed out"""
+        timed_out = []
+        self.condition.acquire()
+        try:
+            while self.running and tick[0] > 0:
+                wait = self.poll_interval
+                if self.feed_timeout is not None:
+                    now = time.time()
+                    for task in self.running_tasks:
+                        if task.tick is not tick or task.timed_out:
+                            continue
+                        remaining = task.start_time + self.feed_timeout - now
+                        if remaining <= 0:
+                            self.__timeout(task)
+                            timed_out.append(task)
+                        else:
+                            wait = min(wait, remaining)
+                if tick[0] > 0:
+                    self.condition.wait(wait)
+        finally:
+            self.condition.release()
+        for task in timed_out:
+            self.__logger.warning("Feeding account " + str(task.key)
+                                  + " timed out")
+            self.record_stats(task.account, self.feed_timeout, timeout=True)
+            self.send_error(task.account, FeedTimeoutError(self.feed_timeout))
+
+    def __timeout(self, task):
+        """
+        Stop waiting for `task` and replace its worker unless too many
+        workers are already abandoned: it then keeps its place in the pool
+        and goes on once `task` is done (condition must be acquired)
+        """
+        task.timed_out = True
+        task.tick[0] -= 1
+        if len(self.abandoned) >= self.max_abandoned:
+            self.__logger.warning("Too many stuck feeder threads, worker of "
+                                  + str(task.key) + " not replaced")
+            return
+        self.abandoned.add(task.worker)
+        self.threads.remove(task.worker)
+        self.__start_worker()
+
+    def get_stats(self):
+        """Return feeder statistics as a dictionary"""
+        self.condition.acquire()
+        try:
+            account_types = {}
+            for (name, (count, total, max_time, errors, timeouts)) \
+                    in self.feed_stats.iteritems():
+                if count > 0:
+                    average = total / count
+                else:
+                    average = 0.0
+                account_types[name] = {"count": count,
+                                       "average_duration": average,
+                                       "max_duration": max_time,
+                                       "errors": errors,
+                                       "timeouts": timeouts}
+            return {"ticks": self.ticks,
+                    "skipped": self.skipped,
+                    "queued": len(self.tasks),
+                    "feeding": len(self.running_tasks),
+                    "abandoned": len(self.abandoned),
+                    "account_types": account_types}
+        finally:
+            self.condition.release()
+
+class ScheduleEntry(object):
+    """Feeding schedule of one account by a FeederHandler"""
+
+    def __init__(self, handler, account_class, account_id, interval):
+        """ScheduleEntry constructor"""
+        self.handler = handler
+        self.account_class = account_class
+        self.account_id = account_id
+        self.key = (id(handler), account_id)
+        self.interval = interval
+        self.backoff = 1.0
+        self.due = None
+
+class FeederScheduler(object):
+    """
+    Feed each account of FeederHandler instances at its own interval
+    (FeederHandler.get_feed_interval) using a heap of due times. The
+    interval of accounts returning nothing or failing is increased up to
+    max_backoff times, and a random jitter spreads feeds over time. Due
+    accounts are fed through a FeederEngine.
+    """
+
+    # backoff factor applied when feeding an account failed
+    error_backoff = 2.0
+    # backoff factor applied when feeding an account returned nothing
+    empty_backoff = 1.25
+
+    def __init__(self, engine, default_interval=60, jitter=0.1,
+                 max_backoff=8, refresh_interval=300):
+        """FeederScheduler constructor"""
+        self.__logger = logging.getLogger(\
+            "jcl.jabber.feeder.FeederScheduler")
+        self.engine = engine
+        self.default_interval = default_interval
+        self.jitter = jitter
+        self.max_backoff = max(max_backoff, 1.0)
+        self.refresh_interval = refresh_interval
+        self.random = random.Random()
+        # heap of (due time, sequence, entry), entries rescheduled or
+        # removed are skipped when popped
+        self.heap = []
+        self.sequence = 0
+        # (handler, account id) -> ScheduleEntry
+        self.entries = {}
+        self.next_refresh = None
+        # next run of tick handlers which are not FeederHandler
+        self.next_handlers_run = None
+
+    def push(self, entry, due):
+        """Schedule `entry` at `due` time"""
+        entry.due = due
+        self.sequence += 1
+        heapq.heappush(self.heap, (due, self.sequence, entry))
+
+    def reschedule(self, entry, now, count=1, error=False):
+        """
+        Schedule next feed of `entry` from `now`, updating its backoff with
+        the number of data fed (`count`) and `error`.
+        """
+        if error:
+            entry.backoff = min(entry.backoff * self.error_backoff,
+                                self.max_backoff)
+        elif count == 0:
+            entry.backoff = min(entry.backoff * self.empty_backoff,
+                                self.max_backoff)
+        else:
+            entry.backoff = 1.0
+        delay = entry.interval * entry.backoff
+        delay += delay * self.random.uniform(-self.jitter, self.jitter)
+        self.push(entry, now + max(delay, 0))
+
+    def refresh(self, handlers, lang_class, now):
+        """
+        Reload accounts of FeederHandler in `handlers`: new accounts are
+        scheduled at a random time within their interval, removed ones are
+        dropped.
+        """
+        entries = {}
+        model.db_connect()
+        try:
+            for handler in handlers:
+                if not hasattr(handler, "feed_account"):
+                    continue
+                for _account in handler.filter(None, lang_class):
+                    interval = handler.get_feed_interval(_account) \
+                        or self.default_interval
+                    key = (id(handler), _account.id)
+                    entry = self.entries.get(key)
+                    if entry is None:
+                        entry = ScheduleEntry(handler, _account.__class__,
+                                              _account.id, interval)
+                        self.push(entry,
+                                  now + self.random.uniform(0, interval))
+                    entry.interval = interval
+                    entries[key] = entry
+        finally:
+            model.db_disconnect()
+        self.entries = entries
+        self.next_refresh = now + self.refresh_interval
+        self.__logger.debug(str(len(entries)) + " accounts scheduled")
+
+    def get_delay(self, now=None):
+        """Return the delay (in seconds) before something is due"""
+        if now is None:
+            now = time.time()
+        if self.next_refresh is None:
+            return 0
+        due = min(self.next_refresh, self.next_handlers_run)
+        while self.heap:
+            (entry_due, sequence, entry) = self.heap[0]
+            if self.entries.get(entry.key) is entry \
+                    and entry.due == entry_due:
+                due = min(due, entry_due)
+                break
+            heapq.heappop(self.heap)
+        return max(due - now, 0)
+
+    def pop_due(self, now):
+        """Return entries due at `now`"""
+        entries = []
+        while self.heap and self.heap[0][0] <= now:
+            (entry_due, sequence, entry) = heapq.heappop(self.heap)
+            if self.entries.get(entry.key) is entry \
+                    and entry.due == entry_due:
+                entries.append(entry)
+        return entries
+
+    def get_tasks(self, entries, now):
+        """
+        Return FeedTask of due `entries`. Entries of disabled accounts are
+        rescheduled, those of deleted accounts are dropped.
+        """
+        tasks = []
+        model.db_connect()
+        try:
+            for entry in entries:
+                try:
+                    _account = entry.account_class.get(entry.account_id)
+                except SQLObjectNotFound:
+                    del self.entries[entry.key]
+                    continue
+                if not _account.enabled:
+                    self.reschedule(entry, now)
+                    continue
+                tasks.append(FeedTask(entry.handler, _account, entry.key))
+        finally:
+            model.db_disconnect()
+        return tasks
+
+    def run(self, handlers, lang_class):
+        """Feed due accounts of `handlers` and reschedule them"""
+        now = time.time()
+        if self.next_refresh is None or now >= self.next_refresh:
+            self.refresh(handlers, lang_class, now)
+        if self.next_handlers_run is None or now >= self.next_handlers_run:
+            self.next_handlers_run = now + self.default_interval
+            for handler in handlers:
+                if not hasattr(handler, "feed_account"):
+                    handler.handle(None, lang_class,
+                                   handler.filter(None, lang_class))
+        entries = self.pop_due(now)
+        if not entries:
+            return
+        tasks = self.get_tasks(entries, now)
+        self.engine.run_tasks(tasks)
+        now = time.time()
+        for task in tasks:
+            entry = self.entries.get(task.key)
+            if entry is None:
+                continue
+            if task.skipped:
+                self.reschedule(entry, now, count=1)
+            else:
+                self.reschedule(entry, now, task.count,
+                                task.error or task.timed_out)
+
+    def get_stats(self):
+        """Return scheduler statistics as a dictionary"""
+        backoff_count = 0
+        for entry in self.entries.itervalues():
+            if entry.backoff > 1.0:
+                backoff_count += 1
+        return {"accounts": len(self.entries),
+                "heap_size": len(self.heap),
+                "backed_off": backoff_count,
+                "delay": self.get_delay()}
+
+class AsyncFeederLoop(object):
+    """
+    Feed accounts of AsyncFeeder in the current thread, multiplexing their
+    feed_async generators with poll (or select where poll is not
+    available). At most class_limit accounts of one class and host_limit
+    accounts of one host (AsyncFeeder.get_host) are fed at the same time.
+    """
+
+    def __init__(self, engine, class_limit=100, host_limit=4):
+        """AsyncFeederLoop constructor"""
+        self.__logger = logging.getLogger(\
+            "jcl.jabber.feeder.AsyncFeederLoop")
+        self.engine = engine
+        self.class_limit = max(class_limit, 1)
+        self.host_limit = max(host_limit, 1)
+        self.max_running = 0
+
+    def start_task(self, task, class_counts, host_counts):
+        """
+        Start feeding `task` account if class and host limits allow it.
+        Return False if it must wait.
+        """
+        class_name = task.account.__class__.__name__
+        host = task.handler.feeder.get_host(task.account)
+        if class_counts.get(class_name, 0) >= self.class_limit \
+                or (host is not None
+                    and host_counts.get(host, 0) >= self.host_limit):
+            return False
+        class_counts[class_name] = class_counts.get(class_name, 0) + 1
+        if host is not None:
+            host_counts[host] = host_counts.get(host, 0) + 1
+        task.limit_keys = (class_name, host)
+        task.start_time = time.time()
+        task.pipeline = task.handler.get_pipeline(task.account)
+        task.coroutine = task.handler.feeder.feed_async(task.account)
+        return True
+
+    def step(self, task):
+        """
+        Run `task` coroutine until it waits. Return the FeedWait event or
+        None when the account has been fed.
+        """
+        try:
+            try:
+                while True:
+                    data = task.coroutine.next()
+                    if isinstance(data, FeedWait):
+                        return data
+                    if task.pipeline is not None:
+                        task.data.append(data)
+                    else:
+                        task.count += task.handler.send_data(task.account,
+                                                             [data])
+            except StopIteration:
+                pass
+            except Exception, exception:
+                task.error = True
+                self.engine.send_error(task.account, exception)
+            if task.data:
+                task.count += task.handler.send_data(task.account, task.data)
+                task.data = []
+        except Exception, exception:
+            task.error = True
+            self.engine.send_error(task.account, exception)
+        return None
+
+    def run(self, tasks):
+        """Feed accounts of `tasks` and return once they are all fed or
+        timed out"""
+        if not tasks:
+            return
+        feed_timeout = self.engine.feed_timeout
+        pending = deque(tasks)
+        # task -> (FeedWait, deadline of the wait)
+        waiting = {}
+        class_counts = {}
+        host_counts = {}
+        model.db_connect()
+        try:
+            while pending or waiting:
+                ready = []
+                for i in xrange(len(pending)):
+                    task = pending.popleft()
+                    if self.start_task(task, class_counts, host_counts):
+                        ready.append(task)
+                    else:
+                        pending.append(task)
+                if not ready:
+                    ready = self.select(waiting)
+                now = time.time()
+                if feed_timeout is not None:
+                    for task in waiting.keys():
+                        if now - task.start_time >= feed_timeout:
+                            del waiting[task]
+                            task.coroutine.close()
+                            task.timed_out = True
+                            self.__logger.warning("Feeding account "
+                                                  + str(task.key)
+                                                  + " timed out")
+                            self.engine.send_error(\
+                                task.account, FeedTimeoutError(feed_timeout))
+                            self.done(task, class_counts, host_counts)
+                for task in ready:
+                    if task.timed_out:
+                        # closed and released by the timeout check above
+                        continue
+                    if task in waiting:
+                        del waiting[task]
+                    wait = self.step(task)
+                    if wait is None:
+                        self.done(task, class_counts, host_counts)
+                    else:
+                        if wait.timeout is not None:
+                            deadline = time.time() + wait.timeout
+                        else:
+                            deadline = None
+                        waiting[task] = (wait, deadline)
+                self.max_running = max(self.max_running, len(waiting))
+        finally:
+            for task in waiting.keys():
+                task.coroutine.close()
+            model.db_disconnect()
+
+    def select(self, waiting):
+        """Wait for events of `waiting` tasks and return ready tasks"""
+        now = time.time()
+        timeout = self.engine.poll_interval
+        read_files = {}
+        write_files = {}
+        ready = []
+        for (task, (wait, deadline)) in waiting.iteritems():
+            if deadline is not None:
+                if deadline <= now:
+                    ready.append(task)
+                    continue
+                timeout = min(timeout, deadline - now)
+            if self.engine.feed_timeout is not None:
+                timeout = min(timeout, max(task.start_time
+                                           + self.engine.feed_timeout - now,
+                                           0))
+            if wait.read is not None:
+                read_files.setdefault(wait.read, []).append(task)
+            if wait.write is not None:
+                write_files.setdefault(wait.write, []).append(task)
+        if ready:
+            return ready
+        if not read_files and not write_files:
+            time.sleep(timeout)
+            return [task for (task, (wait, deadline)) in waiting.iteritems()
+                    if deadline is not None and deadline <= time.time()]
+        (readable, writable) = wait_files(read_files.keys(),
+                                          write_files.keys(), timeout)
+        for _file in readable:
+            ready.extend(read_files[_file])
+        for _file in writable:
+            for task in write_files[_file]:
+                if task not in ready:
+                    ready.append(task)
+        now = time.time()
+        for (task, (wait, deadline)) in waiting.iteritems():
+            if deadline is not None and deadline <= now and task not in ready:
+                ready.append(task)
+        return ready
+
+    def done(self, task, class_counts, host_counts):
+        """Release limits of `task` and record its statistics"""
+        (class_name, host) = task.limit_keys
+        class_counts[class_name] -= 1
+        if host is not None:
+            host_counts[host] -= 1
+        if task.timed_out:
+            self.engine.record_stats(task.account, self.engine.feed_timeout,
+                                     timeout=True)
+        else:
+            self.engine.record_stats(task.account,
+                                     time.time() - task.start_time,
+                                     error=task.error)
@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+##
+## jobs.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+
+"""Background jobs started by ad-hoc commands"""
+
+__revision__ = ""
+
+import logging
+import threading
+
+from pyxmpp.message import Message
+
+import jcl.model as model
+from jcl.model import account
+from jcl.jabber.outbound import TokenBucket, PRIORITY_BULK
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_COMPLETED = "completed"
+JOB_CANCELED = "canceled"
+JOB_FAILED = "failed"
+
+class Job(object):
+    """
+    Task run in a background thread. Its progress (`done` out of `total`
+    items) can be read while it runs and it can be canceled between two
+    items.
+    """
+
+    def __init__(self, job_id):
+        """Job constructor"""
+        self.__logger = logging.getLogger("jcl.jabber.jobs.Job")
+        self.job_id = job_id
+        self.state = JOB_PENDING
+        self.done = 0
+        self.total = None
+        self.canceled = False
+        self.finished = threading.Event()
+
+    def execute(self):
+        """Do the job work, checking `canceled` regularly"""
+        raise NotImplementedError
+
+    def run(self):
+        """Execute the job and record its final state"""
+        self.state = JOB_RUNNING
+        try:
+            try:
+                self.execute()
+                if self.canceled:
+                    self.state = JOB_CANCELED
+                else:
+                    self.state = JOB_COMPLETED
+            except Exception:
+                self.state = JOB_FAILED
+                self.__logger.error("Error while running job "
+                                    + str(self.job_id), exc_info=True)
+        finally:
+            self.finished.set()
+
+    def cancel(self):
+        """Ask the job to stop"""
+        self.canceled = True
+        if self.state == JOB_PENDING:
+            self.state = JOB_CANCELED
+            self.finished.set()
+
+    def is_finished(self):
+        """Return True if the job is not pending or running anymore"""
+        return self.finished.isSet()
+
+    def wait(self, timeout=None):
+        """Wait for the job to finish"""
+        self.finished.wait(timeout)
+        return self.finished.isSet()
+
+class BroadcastJob(Job):
+    """
+    Send a message to every user having an online account. Users are read
+    by chunks of `chunk_size` (keyset pagination on user id) and messages
+    are queued with the bulk priority of the outbound queue, which paces
+    them. When the outbound queue is disabled, `rate` (messages per second,
+    0 for no limit) paces them.
+    """
+
+    def __init__(self, job_id, component, body, chunk_size=500, rate=0):
+        """BroadcastJob constructor"""
+        Job.__init__(self, job_id)
+        self.component = component
+        self.body = body
+        self.chunk_size = chunk_size
+        self.rate = rate
+
+    def execute(self):
+        """Send the message to online users, chunk by chunk"""
+        if model.write_behind is not None:
+            # online statuses kept in memory must be read by queries
+            model.write_behind.flush()
+        self.total = account.get_online_users_count()
+        bucket = None
+        if self.component.outbound_queue is None and self.rate > 0:
+            bucket = TokenBucket(self.rate, self.rate)
+        after = 0
+        while not self.canceled:
+            users = account.get_online_users_jid_page(after, self.chunk_size)
+            if not users:
+                break
+            for (user_id, user_jid) in users:
+                if self.canceled:
+                    break
+                if bucket is not None:
+                    delay = bucket.consume()
+                    while delay > 0 and not self.canceled:
+                        self.finished.wait(delay)
+                        delay = bucket.consume()
+                self.component.send_stanzas([Message(\
+                            from_jid=self.component.jid,
+                            to_jid=user_jid,
+                            body=self.body)], PRIORITY_BULK)
+                self.done += 1
+                after = user_id
+        # users coming online during the broadcast
+        self.total = max(self.total, self.done)
+
+class JobManager(object):
+    """
+    Jobs indexed by id (the ad-hoc command session id). At most
+    `max_finished` finished jobs are kept for progress requests.
+    """
+
+    def __init__(self, max_finished=100):
+        """JobManager constructor"""
+        self.max_finished = max_finished
+        self.lock = threading.Lock()
+        self.jobs = {}
+        # job ids in adding order
+        self.job_ids = []
+
+    def add(self, job):
+        """Register `job` (run by the caller)"""
+        self.lock.acquire()
+        try:
+            if not self.jobs.has_key(job.job_id):
+                self.job_ids.append(job.job_id)
+            self.jobs[job.job_id] = job
+            self.__cleanup()
+        finally:
+            self.lock.release()
+        return job
+
+    def start(self, job):
+        """Register `job` and run it in a new thread"""
+        self.add(job)
+        thread = threading.Thread(target=job.run,
+                                  name="JobThread")
+        thread.setDaemon(True)
+        thread.start()
+        return job
+
+    def get(self, job_id):
+        """Return job `job_id`, None if unknown"""
+        self.lock.acquire()
+        try:
+            return self.jobs.get(job_id)
+        finally:
+            self.lock.release()
+
+    def cancel(self, job_id):
+        """Cancel job `job_id` if known"""
+        job = self.get(job_id)
+        if job is not None:
+            job.cancel()
+        return job
+
+    def __cleanup(self):
+        """Drop oldest finished jobs above max_finished (lock held)"""
+        finished_ids = [job_id for job_id in self.job_ids
+                        if self.jobs[job_id].is_finished()]
+        for job_id in finished_ids[:len(finished_ids) - self.max_finished]:
+            del self.jobs[job_id]
+            self.job_ids.remove(job_id)
+
+    def get_stats(self):
+        """Return the number of jobs in each state as a dictionary"""
+        self.lock.acquire()
+        try:
+            stats = {JOB_PENDING: 0, JOB_RUNNING: 0, JOB_COMPLETED: 0,
+                     JOB_CANCELED: 0, JOB_FAILED: 0}
+            for job in self.jobs.values():
+                stats[job.state] += 1
+            return stats
+        finally:
+            self.lock.release()
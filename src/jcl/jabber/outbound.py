@@ -0,0 +1,347 @@
+# -*- coding: utf-8 -*-
+##
+## outbound.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+
+"""Rate limited outbound stanza queue"""
+
+__revision__ = ""
+
+import logging
+import threading
+import time
+import heapq
+
+from pyxmpp.iq import Iq
+from pyxmpp.message import Message
+
+# priority classes, lowest value is sent first
+PRIORITY_IQ = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+
+def get_stanza_priority(stanza):
+    """Return default priority class of `stanza`"""
+    if isinstance(stanza, Iq):
+        return PRIORITY_IQ
+    if isinstance(stanza, Message) and stanza.get_type() == "headline":
+        return PRIORITY_BULK
+    return PRIORITY_NORMAL
+
+class TokenBucket(object):
+    """
+    Token bucket rate limiter: `rate` tokens per second are added to the
+    bucket which holds at most `burst` tokens.
+    """
+
+    def __init__(self, rate, burst, time_func=time.time):
+        """TokenBucket constructor"""
+        self.rate = float(rate)
+        self.burst = max(float(burst), 1.0)
+        self.time_func = time_func
+        self.tokens = self.burst
+        self.last_refill = time_func()
+
+    def get_delay(self):
+        """
+        Return 0 if a token is available or the delay to wait (in seconds)
+        before a token is available.
+        """
+        now = self.time_func()
+        self.tokens = min(self.burst,
+                          self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        """
+        Take a token from the bucket. Return 0 if a token has been taken or
+        the delay to wait (in seconds) before a token is available.
+        """
+        delay = self.get_delay()
+        if delay == 0:
+            self.tokens -= 1
+        return delay
+
+class OutboundQueue(object):
+    """
+    Queue of stanzas sent by a sender thread, highest priority first,
+    paced by a TokenBucket. Stanzas of the same priority are sent in
+    order. Stanzas can also be queued as an iterator (see put_source)
+    pulled by the sender thread, one stanza at a time.
+    """
+
+    def __init__(self, send_func, rate, burst, max_size=10000,
+                 time_func=time.time):
+        """OutboundQueue constructor"""
+        self.__logger = logging.getLogger("jcl.jabber.outbound.OutboundQueue")
+        self.send_func = send_func
+        self.bucket = TokenBucket(rate, burst, time_func)
+        self.max_size = max_size
+        self.time_func = time_func
+        self.condition = threading.Condition()
+        # heap of (priority, sequence number, enqueue time, stanza, source)
+        # where source is the iterator to pull the stanza from (stanza is
+        # then None)
+        self.heap = []
+        self.sequence = 0
+        self.running = False
+        # time after which the stopped sender thread gives up sending
+        # remaining stanzas at the allowed rate, None to wait until they
+        # are all sent
+        self.stop_deadline = None
+        self.thread = None
+        self.depths = {PRIORITY_IQ: 0, PRIORITY_NORMAL: 0, PRIORITY_BULK: 0}
+        self.sources = 0
+        self.max_depth = 0
+        self.sent = 0
+        self.errors = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def __push(self, priority, stanza, source):
+        """Push a heap entry (condition must be held)"""
+        heapq.heappush(self.heap, (priority, self.sequence,
+                                   self.time_func(), stanza, source))
+        self.sequence += 1
+        self.max_depth = max(self.max_depth, len(self.heap))
+        self.condition.notifyAll()
+
+    def put(self, stanza, priority=None):
+        """
+        Queue `stanza`. Block while the queue is full, except for IQ
+        priority stanzas which must not wait for bulk traffic.
+        """
+        if priority is None:
+            priority = get_stanza_priority(stanza)
+        self.condition.acquire()
+        try:
+            while self.running and priority != PRIORITY_IQ \
+                    and len(self.heap) >= self.max_size:
+                self.condition.wait()
+            self.depths[priority] = self.depths.get(priority, 0) + 1
+            self.__push(priority, stanza, None)
+        finally:
+            self.condition.release()
+
+    def put_source(self, stanzas, priority=PRIORITY_BULK):
+        """
+        Queue stanzas of `stanzas` iterable with `priority` without
+        blocking: the sender thread pulls the next stanza from it only when
+        it is its turn to be sent, so a large generator is neither built
+        in memory nor drained by the calling thread.
+        """
+        self.condition.acquire()
+        try:
+            self.sources += 1
+            self.__push(priority, None, iter(stanzas))
+        finally:
+            self.condition.release()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def __pop(self):
+        """
+        Pop next entry (condition must be held). Return (priority, enqueue
+        time, stanza, source).
+        """
+        (priority, sequence, enqueue_time, stanza, source) = \
+            heapq.heappop(self.heap)
+        if source is None:
+            self.depths[priority] -= 1
+        self.condition.notifyAll()
+        return (priority, enqueue_time, stanza, source)
+
+    def __pull(self, priority, source):
+        """
+        Return the next stanza of `source` and queue it back for the
+        following ones. Return None when `source` is exhausted.
+        """
+        try:
+            stanza = source.next()
+        except StopIteration:
+            stanza = None
+        except Exception:
+            self.errors += 1
+            self.__logger.error("Error while producing stanza",
+                                exc_info=True)
+            stanza = None
+        self.condition.acquire()
+        try:
+            if stanza is None:
+                self.sources -= 1
+            else:
+                self.__push(priority, None, source)
+        finally:
+            self.condition.release()
+        return stanza
+
+    def __send(self, enqueue_time, stanza):
+        """Send `stanza` and update statistics"""
+        try:
+            self.send_func(stanza)
+        except Exception:
+            self.errors += 1
+            self.__logger.error("Error while sending stanza", exc_info=True)
+        latency = self.time_func() - enqueue_time
+        self.sent += 1
+        self.total_latency += latency
+        self.max_latency = max(self.max_latency, latency)
+
+    def process(self):
+        """
+        Send next stanza if the rate limiter allows it. Return 0 if a
+        stanza has been sent (or the queue is empty), else the delay to
+        wait before retrying. No token is taken for an exhausted source.
+        """
+        self.condition.acquire()
+        try:
+            if not self.heap:
+                return 0
+            delay = self.bucket.get_delay()
+            if delay > 0:
+                return delay
+            (priority, enqueue_time, stanza, source) = self.__pop()
+        finally:
+            self.condition.release()
+        if source is not None:
+            stanza = self.__pull(priority, source)
+            if stanza is None:
+                return 0
+        self.condition.acquire()
+        try:
+            self.bucket.consume()
+        finally:
+            self.condition.release()
+        self.__send(enqueue_time, stanza)
+        return 0
+
+    def flush(self):
+        """Send every queued stanza now, ignoring the rate limiter"""
+        while True:
+            self.condition.acquire()
+            try:
+                if not self.heap:
+                    return
+                (priority, enqueue_time, stanza, source) = self.__pop()
+            finally:
+                self.condition.release()
+            if source is not None:
+                stanza = self.__pull(priority, source)
+                if stanza is None:
+                    continue
+            self.__send(enqueue_time, stanza)
+
+    def __is_stopped(self):
+        """
+        Return True if the sender thread must exit (condition must be held)
+        """
+        if self.running:
+            return False
+        return not self.heap \
+            or (self.stop_deadline is not None
+                and self.time_func() >= self.stop_deadline)
+
+    def run(self):
+        """
+        Sender thread loop. Once stopped, remaining stanzas are still sent
+        at the allowed rate until the stop deadline.
+        """
+        self.__logger.info("Outbound queue thread started...")
+        while True:
+            self.condition.acquire()
+            try:
+                while self.running and not self.heap:
+                    self.condition.wait()
+                if self.__is_stopped():
+                    break
+            finally:
+                self.condition.release()
+            delay = self.process()
+            if delay > 0:
+                self.condition.acquire()
+                try:
+                    if self.stop_deadline is not None:
+                        delay = min(delay,
+                                    self.stop_deadline - self.time_func())
+                    if delay > 0:
+                        self.condition.wait(delay)
+                finally:
+                    self.condition.release()
+        self.__logger.info("Outbound queue thread terminated...")
+
+    def start(self):
+        """Start sender thread"""
+        self.condition.acquire()
+        try:
+            self.running = True
+            self.stop_deadline = None
+        finally:
+            self.condition.release()
+        self.thread = threading.Thread(target=self.run,
+                                       name="OutboundQueueThread")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """
+        Stop sender thread once remaining stanzas have been sent at the
+        allowed rate. Stanzas still queued after `timeout` seconds (if
+        given) are sent at once.
+        """
+        self.condition.acquire()
+        try:
+            self.running = False
+            if timeout is not None:
+                self.stop_deadline = self.time_func() + timeout
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+        if self.heap:
+            self.__logger.warning("Outbound queue stopped with "
+                                  + str(len(self.heap))
+                                  + " entries left, sending them at once")
+        self.flush()
+
+    def get_stats(self):
+        """Return queue statistics as a dictionary"""
+        self.condition.acquire()
+        try:
+            if self.sent > 0:
+                average_latency = self.total_latency / self.sent
+            else:
+                average_latency = 0.0
+            return {"depth": len(self.heap),
+                    "iq_depth": self.depths[PRIORITY_IQ],
+                    "normal_depth": self.depths[PRIORITY_NORMAL],
+                    "bulk_depth": self.depths[PRIORITY_BULK],
+                    "sources": self.sources,
+                    "max_depth": self.max_depth,
+                    "sent": self.sent,
+                    "errors": self.errors,
+                    "average_latency": average_latency,
+                    "max_latency": self.max_latency}
+        finally:
+            self.condition.release()
@@ -118,6 +118,19 @@ class RootPresenceHandler(AccountPresenceHandler):
         return result
 
 class RootPresenceAvailableHandler(RootPresenceHandler, AccountPresenceAvailableHandler):
+    def handle(self, stanza, lang_class, data):
+        """handle available presence sent to component JID: statuses of
+        every account are updated at once"""
+        accounts = list(data)
+        for _account in accounts:
+            _account.default_lang_class = lang_class
+        result = self.component.account_manager.get_accounts_presence_available(\
+            stanza.get_from(), accounts, lang_class)
+        if len(accounts) > 0:
+            result.extend(self.get_root_presence(stanza, lang_class,
+                                                 len(accounts)))
+        return result
+
     def get_root_presence(self, stanza, lang_class, nb_accounts):
         from_jid = stanza.get_from()
         result = self.component.account_manager.get_root_presence(\
@@ -86,6 +86,7 @@ class RootSetRegisterHandler(SetRegisterHandler):
         """
         """
         return jabber.root_filter(self, stanza, lang_class)
+    filter = jabber.routed_filter((jabber.ROOT,))(filter)
 
     def handle(self, info_query, lang_class, data, x_data):
         """
@@ -118,6 +119,7 @@ class AccountSetRegisterHandler(SetRegisterHandler):
         """
         """
         return jabber.account_filter(self, stanza, lang_class)
+    filter = jabber.routed_filter((jabber.ACCOUNT,))(filter)
 
     def handle(self, info_query, lang_class, data, x_data):
         """
@@ -156,6 +158,7 @@ class AccountTypeSetRegisterHandler(SetRegisterHandler):
         """
         """
         return jabber.account_type_filter(self, stanza, lang_class)
+    filter = jabber.routed_filter((jabber.ACCOUNT_TYPE,))(filter)
 
     def handle(self, info_query, lang_class, data, x_data):
         """
@@ -3,10 +3,12 @@ __revision__ = ""
 
 import unittest
 
+from pyxmpp.message import Message
+
 import jcl.jabber as jabber
 
 from jcl.jabber.tests import component, feeder, command, message, presence, \
-    disco, vcard, register
+    disco, vcard, register, outbound, dispatcher, jobs
 
 class HandlerType1:
     pass
@@ -29,9 +31,75 @@ class JabberModule_TestCase(unittest.TestCase):
         self.assertEquals(handlers[1][1].__class__.__name__, "HandlerType1")
         self.assertEquals(handlers[1][2].__class__.__name__, "HandlerType3")
 
+class RoutedHandler(object):
+    def __init__(self, routes=None):
+        self.routes = routes
+
+    def filter(self, stanza, lang_class):
+        return True
+
+class DispatchTable_TestCase(unittest.TestCase):
+    def create_message(self, to_jid):
+        return Message(from_jid="user1@test.com", to_jid=to_jid)
+
+    def test_get_target(self):
+        self.assertEquals(jabber.get_target(\
+                self.create_message("jcl.test.com")), jabber.ROOT)
+        self.assertEquals(jabber.get_target(\
+                self.create_message("jcl.test.com/Example")),
+                          jabber.ACCOUNT_TYPE)
+        self.assertEquals(jabber.get_target(\
+                self.create_message("account1@jcl.test.com/Example")),
+                          jabber.ACCOUNT)
+
+    def test_get_handler_routes(self):
+        class FilterHandler(object):
+            filter = jabber.get_account_filter
+        self.assertEquals(jabber.get_handler_routes(FilterHandler()),
+                          (jabber.ACCOUNT,))
+        self.assertEquals(jabber.get_handler_routes(RoutedHandler()), None)
+        self.assertEquals(jabber.get_handler_routes(\
+                RoutedHandler((jabber.ROOT,))), (jabber.ROOT,))
+
+    def test_get_handler_routes_filter_first(self):
+        handler = RoutedHandler((jabber.ROOT,))
+        handler.filter = jabber.get_account_filter
+        self.assertEquals(jabber.get_handler_routes(handler),
+                          (jabber.ACCOUNT,))
+
+    def test_get_handlers(self):
+        root_handler = RoutedHandler((jabber.ROOT,))
+        account_handler = RoutedHandler((jabber.ACCOUNT,
+                                         jabber.ACCOUNT_TYPE))
+        any_handler = RoutedHandler()
+        handlers = [[root_handler, account_handler], [any_handler]]
+        table = jabber.DispatchTable(handlers)
+        self.assertEquals(table.get_handlers(\
+                self.create_message("jcl.test.com")),
+                          [[root_handler], [any_handler]])
+        self.assertEquals(table.get_handlers(\
+                self.create_message("account1@jcl.test.com")),
+                          [[account_handler], [any_handler]])
+        self.assertEquals(table.get_handlers(\
+                self.create_message("jcl.test.com/Example")),
+                          [[account_handler], [any_handler]])
+
+    def test_is_valid(self):
+        handler1 = RoutedHandler()
+        handlers = [[handler1]]
+        table = jabber.DispatchTable(handlers)
+        self.assertTrue(table.is_valid(handlers))
+        self.assertFalse(table.is_valid([[handler1]]))
+        handler1.filter = lambda stanza, lang_class: True
+        self.assertFalse(table.is_valid(handlers))
+        table = jabber.DispatchTable(handlers)
+        handlers[0].append(RoutedHandler())
+        self.assertFalse(table.is_valid(handlers))
+
 def suite():
     test_suite = unittest.TestSuite()
     test_suite.addTest(unittest.makeSuite(JabberModule_TestCase, 'test'))
+    test_suite.addTest(unittest.makeSuite(DispatchTable_TestCase, 'test'))
     test_suite.addTest(component.suite())
     test_suite.addTest(feeder.suite())
     test_suite.addTest(command.suite())
@@ -40,6 +108,9 @@ def suite():
     test_suite.addTest(disco.suite())
     test_suite.addTest(vcard.suite())
     test_suite.addTest(register.suite())
+    test_suite.addTest(outbound.suite())
+    test_suite.addTest(dispatcher.suite())
+    test_suite.addTest(jobs.suite())
     return test_suite
 
 if __name__ == '__main__':
@@ -41,10 +41,13 @@ from jcl.jabber.component import JCLComponent
 import jcl.jabber.command as command
 from jcl.jabber.command import FieldNoType, CommandManager, JCLCommandManager, \
     CommandError
+import jcl.model as model
 import jcl.model.account as account
+from jcl.model import counters
 from jcl.model.account import Account, PresenceAccount, LegacyJID, User
 from jcl.model.tests.account import ExampleAccount, Example2Account
 from jcl.tests import JCLTestCase
+from jcl.jabber.tests.component import MockStream
 
 PYXMPP_NS = pyxmpp.xmlextra.COMMON_NS
 
@@ -1260,13 +1263,13 @@ class JCLCommandManagerDeleteUserCommand_TestCase(JCLCommandManagerTestCase):
                           ["account11/test1@test.com",
                            "account11/test2@test.com"])
         test1_accounts = account.get_accounts("test1@test.com")
-        self.assertEquals(test1_accounts.count(), 1)
+        self.assertEquals(len(test1_accounts), 1)
         self.assertEquals(test1_accounts[0].name, "account12")
         test2_accounts = account.get_accounts("test2@test.com")
-        self.assertEquals(test2_accounts.count(), 1)
+        self.assertEquals(len(test2_accounts), 1)
         self.assertEquals(test2_accounts[0].name, "account21")
         test3_accounts = account.get_accounts("test3@test.com")
-        self.assertEquals(test3_accounts.count(), 2)
+        self.assertEquals(len(test3_accounts), 2)
 
         result_iq = result[0].xmlnode
         result_iq.setNs(None)
@@ -2194,7 +2197,7 @@ class JCLCommandManagerGetRegisteredUsersListCommand_TestCase(JCLCommandManagerT
                 u"<iq from='jcl.test.com' to='admin@test.com' type='result'>"
                 + "<command xmlns='http://jabber.org/protocol/commands'"
                 + "status='executing'>"
-                + "<actions execute='complete'><complete/></actions>"
+                + "<actions execute='next'><next/></actions>"
                 + "<x xmlns='jabber:x:data' type='form'>"
                 + "<field var='FORM_TYPE' type='hidden'><value>"
                 + "http://jabber.org/protocol/admin</value></field>"
@@ -2228,7 +2231,8 @@ class JCLCommandManagerGetRegisteredUsersListCommand_TestCase(JCLCommandManagerT
         self.assertTrue(jcl.tests.is_xml_equal(\
                 u"<iq from='jcl.test.com' to='admin@test.com' type='result'>"
                 + "<command xmlns='http://jabber.org/protocol/commands'"
-                + "status='completed'>"
+                + "status='executing'>"
+                + "<actions execute='next'><next/><complete/></actions>"
                 + "<x xmlns='jabber:x:data' type='form'>"
                 + "<field var='FORM_TYPE' type='hidden'><value>"
                 + "http://jabber.org/protocol/admin</value></field>"
@@ -2259,12 +2263,146 @@ class JCLCommandManagerGetRegisteredUsersListCommand_TestCase(JCLCommandManagerT
                 + "<value>test10@test.com (account1025 Example2Account)</value>"
                 + "<value>test20@test.com (account205 ExampleAccount)</value>"
                 + "<value>test10@test.com (account1016 ExampleAccount)</value>"
-                + "</field></x></command></iq>",
+                + "</field></x>"
+                + "<set xmlns='http://jabber.org/protocol/rsm'>"
+                + "<first index='0'>1</first><last>25</last>"
+                + "<count>36</count></set></command></iq>",
                 result_iq, True))
         context_session = self.command_manager.sessions[session_id][1]
         self.assertEquals(context_session["max_items"],
                           ["25"])
 
+    def _prepare_registered_users_list_pages(self):
+        user10 = User(jid="test10@test.com")
+        for i in xrange(30):
+            ExampleAccount(user=user10,
+                           name="account10" + str(i),
+                           jid="account10" + str(i) + "@" + unicode(self.comp.jid))
+        result = self.command_manager.apply_command_action(\
+            self.info_query,
+            "http://jabber.org/protocol/admin#get-registered-users-list",
+            "execute")
+        session_id = result[0].xmlnode.children.prop("sessionid")
+        info_query = prepare_submit(\
+            node="http://jabber.org/protocol/admin#get-registered-users-list",
+            session_id=session_id,
+            from_jid="admin@test.com",
+            fields=[Field(field_type="list-single",
+                          name="max_items",
+                          value="25")])
+        self.command_manager.apply_command_action(\
+            info_query,
+            "http://jabber.org/protocol/admin#get-registered-users-list",
+            "execute")
+        return session_id
+
+    def test_execute_get_registered_users_list_next_prev(self):
+        session_id = self._prepare_registered_users_list_pages()
+        info_query = prepare_submit(\
+            node="http://jabber.org/protocol/admin#get-registered-users-list",
+            session_id=session_id,
+            from_jid="admin@test.com",
+            action="next")
+        result = self.command_manager.apply_command_action(\
+            info_query,
+            "http://jabber.org/protocol/admin#get-registered-users-list",
+            "next")
+        result_iq = result[0].xmlnode
+        result_iq.setNs(None)
+        self.assertTrue(jcl.tests.is_xml_equal(\
+                u"<iq from='jcl.test.com' to='admin@test.com' type='result'>"
+                + "<command xmlns='http://jabber.org/protocol/commands'"
+                + "status='executing'>"
+                + "<actions execute='complete'><prev/><complete/></actions>"
+                + "<x xmlns='jabber:x:data' type='form'>"
+                + "<field var='FORM_TYPE' type='hidden'><value>"
+                + "http://jabber.org/protocol/admin</value></field>"
+                + "<field var='registeredusers' label='"
+                + Lang.en.field_registered_users_list + "'>"
+                + "".join(["<value>test10@test.com (account10" + str(i)
+                           + " ExampleAccount)</value>"
+                           for i in xrange(19, 30)])
+                + "</field></x>"
+                + "<set xmlns='http://jabber.org/protocol/rsm'>"
+                + "<first index='25'>26</first><last>36</last>"
+                + "<count>36</count></set></command></iq>",
+                result_iq, True))
+        context_session = self.command_manager.sessions[session_id][1]
+        self.assertEquals(context_session["page"], 1)
+        self.assertEquals(context_session["page_keys"], [None, 25])
+
+        info_query = prepare_submit(\
+            node="http://jabber.org/protocol/admin#get-registered-users-list",
+            session_id=session_id,
+            from_jid="admin@test.com",
+            action="prev")
+        result = self.command_manager.apply_command_action(\
+            info_query,
+            "http://jabber.org/protocol/admin#get-registered-users-list",
+            "prev")
+        result_iq = result[0].xmlnode
+        result_iq.setNs(None)
+        self.assertEquals(result_iq.children.prop("status"), "executing")
+        set_node = result_iq.xpathEval("//*[local-name()='set']")[0]
+        self.assertTrue(jcl.tests.is_xml_equal(\
+                u"<set xmlns='http://jabber.org/protocol/rsm'>"
+                + "<first index='0'>1</first><last>25</last>"
+                + "<count>36</count></set>",
+                set_node, True))
+        self.assertEquals(context_session["page"], 0)
+
+    def test_execute_get_registered_users_list_complete(self):
+        session_id = self._prepare_registered_users_list_pages()
+        info_query = prepare_submit(\
+            node="http://jabber.org/protocol/admin#get-registered-users-list",
+            session_id=session_id,
+            from_jid="admin@test.com",
+            action="complete")
+        result = self.command_manager.apply_command_action(\
+            info_query,
+            "http://jabber.org/protocol/admin#get-registered-users-list",
+            "complete")
+        result_iq = result[0].xmlnode
+        result_iq.setNs(None)
+        self.assertEquals(result_iq.children.prop("status"), "completed")
+        self.assertEquals(\
+            len(result_iq.xpathEval("//*[local-name()='actions']")), 0)
+
+    def test_execute_get_registered_users_list_result_set_after(self):
+        session_id = self._prepare_registered_users_list_pages()
+        info_query = prepare_submit(\
+            node="http://jabber.org/protocol/admin#get-registered-users-list",
+            session_id=session_id,
+            from_jid="admin@test.com")
+        command_node = info_query.xpath_eval("c:command",
+                                             {"c": command.COMMAND_NS})[0]
+        set_node = command_node.newChild(None, "set", None)
+        set_node.setNs(set_node.newNs(command.RSM_NS, None))
+        set_node.newTextChild(None, "max", "2")
+        set_node.newTextChild(None, "after", "4")
+        result = self.command_manager.apply_command_action(\
+            info_query,
+            "http://jabber.org/protocol/admin#get-registered-users-list",
+            "next")
+        result_iq = result[0].xmlnode
+        result_iq.setNs(None)
+        self.assertTrue(jcl.tests.is_xml_equal(\
+                u"<iq from='jcl.test.com' to='admin@test.com' type='result'>"
+                + "<command xmlns='http://jabber.org/protocol/commands'"
+                + "status='completed'>"
+                + "<x xmlns='jabber:x:data' type='form'>"
+                + "<field var='FORM_TYPE' type='hidden'><value>"
+                + "http://jabber.org/protocol/admin</value></field>"
+                + "<field var='registeredusers' label='"
+                + Lang.en.field_registered_users_list + "'>"
+                + "<value>test3@test.com (account31 ExampleAccount)</value>"
+                + "<value>test3@test.com (account32 Example2Account)</value>"
+                + "</field></x>"
+                + "<set xmlns='http://jabber.org/protocol/rsm'>"
+                + "<first>5</first><last>6</last>"
+                + "<count>36</count></set></command></iq>",
+                result_iq, True))
+
 class JCLCommandManagerGetDisabledUsersListCommand_TestCase(JCLCommandManagerTestCase):
     """
     Test 'get-disabled-users-list' ad-hoc command
@@ -2330,7 +2468,7 @@ class JCLCommandManagerGetDisabledUsersListCommand_TestCase(JCLCommandManagerTes
                 u"<iq from='jcl.test.com' to='admin@test.com' type='result'>"
                 + "<command xmlns='http://jabber.org/protocol/commands'"
                 + "status='executing'>"
-                + "<actions execute='complete'><complete/></actions>"
+                + "<actions execute='next'><next/></actions>"
                 + "<x xmlns='jabber:x:data' type='form'>"
                 + "<field var='FORM_TYPE' type='hidden'><value>"
                 + "http://jabber.org/protocol/admin</value></field>"
@@ -2364,7 +2502,8 @@ class JCLCommandManagerGetDisabledUsersListCommand_TestCase(JCLCommandManagerTes
         self.assertTrue(jcl.tests.is_xml_equal(\
                 u"<iq from='jcl.test.com' to='admin@test.com' type='result'>"
                 + "<command xmlns='http://jabber.org/protocol/commands'"
-                + "status='completed'>"
+                + "status='executing'>"
+                + "<actions execute='next'><next/><complete/></actions>"
                 + "<x xmlns='jabber:x:data' type='form'>"
                 + "<field var='FORM_TYPE' type='hidden'><value>"
                 + "http://jabber.org/protocol/admin</value></field>"
@@ -2395,7 +2534,10 @@ class JCLCommandManagerGetDisabledUsersListCommand_TestCase(JCLCommandManagerTes
                 + "<value>test10@test.com (account10111 ExampleAccount)</value>"
                 + "<value>test20@test.com (account2011 ExampleAccount)</value>"
                 + "<value>test10@test.com (account10112 ExampleAccount)</value>"
-                + "</field></x></command></iq>",
+                + "</field></x>"
+                + "<set xmlns='http://jabber.org/protocol/rsm'>"
+                + "<first index='0'>7</first><last>43</last>"
+                + "<count>40</count></set></command></iq>",
                 result_iq, True))
         context_session = self.command_manager.sessions[session_id][1]
         self.assertEquals(context_session["max_items"],
@@ -2466,7 +2608,7 @@ class JCLCommandManagerGetOnlineUsersListCommand_TestCase(JCLCommandManagerTestC
                 u"<iq from='jcl.test.com' to='admin@test.com' type='result'>"
                 + "<command xmlns='http://jabber.org/protocol/commands'"
                 + "status='executing'>"
-                + "<actions execute='complete'><complete/></actions>"
+                + "<actions execute='next'><next/></actions>"
                 + "<x xmlns='jabber:x:data' type='form'>"
                 + "<field var='FORM_TYPE' type='hidden'><value>"
                 + "http://jabber.org/protocol/admin</value></field>"
@@ -2500,7 +2642,8 @@ class JCLCommandManagerGetOnlineUsersListCommand_TestCase(JCLCommandManagerTestC
         self.assertTrue(jcl.tests.is_xml_equal(\
                 u"<iq from='jcl.test.com' to='admin@test.com' type='result'>"
                 + "<command xmlns='http://jabber.org/protocol/commands'"
-                + "status='completed'>"
+                + "status='executing'>"
+                + "<actions execute='next'><next/><complete/></actions>"
                 + "<x xmlns='jabber:x:data' type='form'>"
                 + "<field var='FORM_TYPE' type='hidden'><value>"
                 + "http://jabber.org/protocol/admin</value></field>"
@@ -2531,12 +2674,106 @@ class JCLCommandManagerGetOnlineUsersListCommand_TestCase(JCLCommandManagerTestC
                 + "<value>test10@test.com (account10111 ExampleAccount)</value>"
                 + "<value>test20@test.com (account2011 ExampleAccount)</value>"
                 + "<value>test10@test.com (account10112 ExampleAccount)</value>"
-                + "</field></x></command></iq>",
+                + "</field></x>"
+                + "<set xmlns='http://jabber.org/protocol/rsm'>"
+                + "<first index='0'>7</first><last>43</last>"
+                + "<count>40</count></set></command></iq>",
                 result_iq, True))
         context_session = self.command_manager.sessions[session_id][1]
         self.assertEquals(context_session["max_items"],
                           ["25"])
 
+class JCLCommandManagerUserStatsCommand_TestCase(JCLCommandManagerTestCase):
+    """
+    Test 'user-stats' ad-hoc command
+    """
+
+    def setUp (self, tables=[]):
+        """
+        Prepare data
+        """
+        JCLCommandManagerTestCase.setUp(self, tables)
+        self.account11.status = account.ONLINE
+        self.account12.enabled = False
+        self.command_node.setProp("node",
+                                  "http://jabber.org/protocol/admin#user-stats")
+
+    def tearDown(self):
+        counters.disable()
+        JCLCommandManagerTestCase.tearDown(self)
+
+    def _execute_user_stats(self, user_jid):
+        result = self.command_manager.apply_command_action(\
+            self.info_query,
+            "http://jabber.org/protocol/admin#user-stats",
+            "execute")
+        result_iq = result[0].xmlnode
+        session_id = result_iq.children.prop("sessionid")
+        info_query = prepare_submit(\
+            node="http://jabber.org/protocol/admin#user-stats",
+            session_id=session_id,
+            from_jid="admin@test.com",
+            fields=[Field(field_type="jid-single",
+                          name="user_jid",
+                          value=user_jid)],
+            action="complete")
+        result = self.command_manager.apply_command_action(\
+            info_query,
+            "http://jabber.org/protocol/admin#user-stats",
+            "execute")
+        result_iq = result[0].xmlnode
+        result_iq.setNs(None)
+        return result_iq
+
+    def test_execute_user_stats(self):
+        result_iq = self._execute_user_stats("test1@test.com")
+        self.assertTrue(jcl.tests.is_xml_equal(\
+                u"<iq from='jcl.test.com' to='admin@test.com' type='result'>"
+                + "<command xmlns='http://jabber.org/protocol/commands'"
+                + "status='completed'>"
+                + "<x xmlns='jabber:x:data' type='result'>"
+                + "<field var='FORM_TYPE' type='hidden'><value>"
+                + "http://jabber.org/protocol/admin</value></field>"
+                + "<field var='accountjid' label='" + Lang.en.field_user_jid
+                + "'><value>test1@test.com</value></field>"
+                + "<field var='rostersize' label='"
+                + Lang.en.field_roster_size + "'><value>2</value></field>"
+                + "<field var='registeredusersnum' label='"
+                + Lang.en.field_registered_users_num
+                + "'><value>2</value></field>"
+                + "<field var='disabledusersnum' label='"
+                + Lang.en.field_disabled_users_num
+                + "'><value>1</value></field>"
+                + "<field var='onlineusersnum' label='"
+                + Lang.en.field_online_users_num
+                + "'><value>1</value></field>"
+                + "</x></command></iq>",
+                result_iq, True))
+
+    def test_execute_user_stats_all_accounts(self):
+        counters.enable(0)
+        result_iq = self._execute_user_stats("")
+        self.assertTrue(jcl.tests.is_xml_equal(\
+                u"<iq from='jcl.test.com' to='admin@test.com' type='result'>"
+                + "<command xmlns='http://jabber.org/protocol/commands'"
+                + "status='completed'>"
+                + "<x xmlns='jabber:x:data' type='result'>"
+                + "<field var='FORM_TYPE' type='hidden'><value>"
+                + "http://jabber.org/protocol/admin</value></field>"
+                + "<field var='registeredusersnum' label='"
+                + Lang.en.field_registered_users_num
+                + "'><value>6</value></field>"
+                + "<field var='disabledusersnum' label='"
+                + Lang.en.field_disabled_users_num
+                + "'><value>1</value></field>"
+                + "<field var='onlineusersnum' label='"
+                + Lang.en.field_online_users_num
+                + "'><value>1</value></field>"
+                + "</x></command></iq>",
+                result_iq, True))
+        self.assertEquals(model.account_counters.get_stats()["reconciliations"],
+                          1)
+
 class JCLCommandManagerAnnounceCommand_TestCase(JCLCommandManagerTestCase):
     """
     Test 'announce' ad-hoc command
@@ -2579,8 +2816,7 @@ class JCLCommandManagerAnnounceCommand_TestCase(JCLCommandManagerTestCase):
         self.assertNotEquals(session_id, None)
         return session_id
 
-    def test_execute_announce(self):
-        session_id = self._common_execute_announce()
+    def _submit_announce(self, session_id):
         info_query = prepare_submit(\
             node="http://jabber.org/protocol/admin#announce",
             session_id=session_id,
@@ -2588,35 +2824,92 @@ class JCLCommandManagerAnnounceCommand_TestCase(JCLCommandManagerTestCase):
             fields=[Field(field_type="text-multi",
                           name="announcement",
                           value=["test announce"])])
-        result = self.command_manager.apply_command_action(\
+        return self.command_manager.apply_command_action(\
             info_query,
             "http://jabber.org/protocol/admin#announce",
             "execute")
+
+    def test_execute_announce(self):
+        self.comp.stream = MockStream()
+        session_id = self._common_execute_announce()
+        result = self._submit_announce(session_id)
+        self.assertEquals(len(result), 1)
         result_iq = result[0].xmlnode
         result_iq.setNs(None)
         self.assertTrue(jcl.tests.is_xml_equal(\
                 u"<iq from='jcl.test.com' to='admin@test.com' type='result'>"
                 + "<command xmlns='http://jabber.org/protocol/commands' "
-                + "status='completed' sessionid='" + session_id + "'>"
+                + "status='executing' sessionid='" + session_id + "'>"
+                + "<actions execute='next'><next/></actions>"
+                + "<note type='info'>" + Lang.en.job_pending + "</note>"
                 + "</command></iq>",
                 result_iq, True, test_sibling=False))
-        result_iq = result[1].xmlnode
+        job = self.command_manager.jobs.get(session_id)
+        self.assertTrue(job.wait(5))
+        self.assertEquals(job.done, 2)
+        self.assertEquals(job.total, 2)
+        sent = self.comp.stream.sent
+        self.assertEquals(len(sent), 2)
         self.assertTrue(jcl.tests.is_xml_equal(\
                 u"<message from='" + unicode(self.comp.jid) + "' "
                 + "xmlns=\"" + PYXMPP_NS + "\" "
                 + "to='test1@test.com'>"
                 + "<body>test announce</body></message>",
-                result_iq, True, test_sibling=False))
-        result_iq = result[2].xmlnode
+                sent[0].xmlnode, True, test_sibling=False))
         self.assertTrue(jcl.tests.is_xml_equal(\
                 u"<message from='" + unicode(self.comp.jid) + "' "
                 + "xmlns=\"" + PYXMPP_NS + "\" "
                 + "to='test2@test.com'>"
                 + "<body>test announce</body></message>",
-                result_iq, True, test_sibling=False))
+                sent[1].xmlnode, True, test_sibling=False))
         context_session = self.command_manager.sessions[session_id][1]
         self.assertEquals(context_session["announcement"],
                           ["test announce"])
+        self.assertEquals(context_session["job_id"], session_id)
+
+        # progress request
+        info_query = prepare_submit(\
+            node="http://jabber.org/protocol/admin#announce",
+            session_id=session_id,
+            from_jid="admin@test.com")
+        result = self.command_manager.apply_command_action(\
+            info_query,
+            "http://jabber.org/protocol/admin#announce",
+            "next")
+        result_iq = result[0].xmlnode
+        result_iq.setNs(None)
+        self.assertTrue(jcl.tests.is_xml_equal(\
+                u"<iq from='jcl.test.com' to='admin@test.com' type='result'>"
+                + "<command xmlns='http://jabber.org/protocol/commands' "
+                + "status='completed' sessionid='" + session_id + "'>"
+                + "<note type='info'>" + (Lang.en.job_completed % (2))
+                + "</note></command></iq>",
+                result_iq, True, test_sibling=False))
+
+    def test_execute_announce_cancel(self):
+        self.comp.stream = MockStream()
+        session_id = self._common_execute_announce()
+        # job is registered but not run
+        self.command_manager.jobs.start = self.command_manager.jobs.add
+        self._submit_announce(session_id)
+        job = self.command_manager.jobs.get(session_id)
+        self.assertEquals(job.state, "pending")
+        info_query = prepare_submit(\
+            node="http://jabber.org/protocol/admin#announce",
+            session_id=session_id,
+            from_jid="admin@test.com",
+            action="cancel")
+        result = self.command_manager.apply_command_action(\
+            info_query,
+            "http://jabber.org/protocol/admin#announce",
+            "cancel")
+        self.assertEquals(result[0].xmlnode.children.prop("status"),
+                          "canceled")
+        self.assertTrue(job.canceled)
+        job.run()
+        self.assertEquals(job.state, "canceled")
+        self.assertEquals(job.done, 0)
+        self.assertEquals(len(self.comp.stream.sent), 0)
 
     def test_execute_announce_no_announcement(self):
         session_id = self._common_execute_announce()
@@ -3076,6 +3369,7 @@ class JCLCommandManagerRestartCommand_TestCase(JCLCommandManagerTestCase):
         return session_id
 
     def test_execute_restart(self):
+        self.comp.stream = MockStream()
         session_id = self._common_execute_restart()
         info_query = prepare_submit(\
             node="http://jabber.org/protocol/admin#restart",
@@ -3107,29 +3401,67 @@ class JCLCommandManagerRestartCommand_TestCase(JCLCommandManagerTestCase):
         self.assertTrue(jcl.tests.is_xml_equal(\
                 u"<iq from='jcl.test.com' to='admin@test.com' type='result'>"
                 + "<command xmlns='http://jabber.org/protocol/commands' "
-                + "status='completed' sessionid='" + session_id + "'>"
+                + "status='executing' sessionid='" + session_id + "'>"
+                + "<actions execute='next'><next/></actions>"
+                + "<note type='info'>" + Lang.en.job_pending + "</note>"
                 + "</command></iq>",
                 result_iq, True, test_sibling=False))
-        result_iq = result[1].xmlnode
+        self.assertEquals(len(result), 1)
+        sent = self.comp.stream.sent
+        self.assertEquals(len(sent), 2)
         self.assertTrue(jcl.tests.is_xml_equal(\
                 u"<message from='" + unicode(self.comp.jid) + "' "
                 + "xmlns=\"" + PYXMPP_NS + "\" "
                 + "to='test1@test.com'>"
                 + "<body>service will be restarted in 1 second</body></message>",
-                result_iq, True, test_sibling=False))
-        result_iq = result[2].xmlnode
+                sent[0].xmlnode, True, test_sibling=False))
         self.assertTrue(jcl.tests.is_xml_equal(\
                 u"<message from='" + unicode(self.comp.jid) + "' "
                 + "xmlns=\"" + PYXMPP_NS + "\" "
                 + "to='test2@test.com'>"
                 + "<body>service will be restarted in 1 second</body></message>",
-                result_iq, True, test_sibling=False))
+                sent[1].xmlnode, True, test_sibling=False))
+        self.assertEquals(self.command_manager.jobs.get(session_id).state,
+                          "completed")
         context_session = self.command_manager.sessions[session_id][1]
         self.assertEquals(context_session["announcement"],
                           ["service will be restarted in 1 second"])
         self.assertEquals(context_session["delay"],
                           ["1"])
 
+    def test_execute_restart_cancel(self):
+        self.comp.stream = MockStream()
+        session_id = self._common_execute_restart()
+        info_query = prepare_submit(\
+            node="http://jabber.org/protocol/admin#restart",
+            session_id=session_id,
+            from_jid="admin@test.com",
+            fields=[Field(field_type="list-multi",
+                          name="delay",
+                          value=[1]),
+                    Field(field_type="text-multi",
+                          name="announcement",
+                          value=["service will be restarted in 1 second"])])
+        self.command_manager.apply_command_action(\
+            info_query,
+            "http://jabber.org/protocol/admin#restart",
+            "execute")
+        info_query = prepare_submit(\
+            node="http://jabber.org/protocol/admin#restart",
+            session_id=session_id,
+            from_jid="admin@test.com",
+            action="cancel")
+        result = self.command_manager.apply_command_action(\
+            info_query,
+            "http://jabber.org/protocol/admin#restart",
+            "cancel")
+        self.assertEquals(result[0].xmlnode.children.prop("status"),
+                          "canceled")
+        self.wait_event.set()
+        self.command_manager.restart_thread.join(1)
+        self.assertFalse(self.comp.restart)
+        self.assertTrue(self.comp.running)
+
     def test_execute_restart_no_announcement(self):
         session_id = self._common_execute_restart()
         info_query = prepare_submit(\
@@ -3229,6 +3561,7 @@ class JCLCommandManagerShutdownCommand_TestCase(JCLCommandManagerTestCase):
         return session_id
 
     def test_execute_shutdown(self):
+        self.comp.stream = MockStream()
         session_id = self._common_execute_shutdown()
         info_query = prepare_submit(\
             node="http://jabber.org/protocol/admin#shutdown",
@@ -3260,23 +3593,28 @@ class JCLCommandManagerShutdownCommand_TestCase(JCLCommandManagerTestCase):
         self.assertTrue(jcl.tests.is_xml_equal(\
                 u"<iq from='jcl.test.com' to='admin@test.com' type='result'>"
                 + "<command xmlns='http://jabber.org/protocol/commands' "
-                + "status='completed' sessionid='" + session_id + "'>"
+                + "status='executing' sessionid='" + session_id + "'>"
+                + "<actions execute='next'><next/></actions>"
+                + "<note type='info'>" + Lang.en.job_pending + "</note>"
                 + "</command></iq>",
                 result_iq, True, test_sibling=False))
-        result_iq = result[1].xmlnode
+        self.assertEquals(len(result), 1)
+        sent = self.comp.stream.sent
+        self.assertEquals(len(sent), 2)
         self.assertTrue(jcl.tests.is_xml_equal(\
                 u"<message from='" + unicode(self.comp.jid) + "' "
                 + "xmlns=\"" + PYXMPP_NS + "\" "
                 + "to='test1@test.com'>"
                 + "<body>service will be shutdown in 1 second</body></message>",
-                result_iq, True, test_sibling=False))
-        result_iq = result[2].xmlnode
+                sent[0].xmlnode, True, test_sibling=False))
         self.assertTrue(jcl.tests.is_xml_equal(\
                 u"<message from='" + unicode(self.comp.jid) + "' "
                 + "xmlns=\"" + PYXMPP_NS + "\" "
                 + "to='test2@test.com'>"
                 + "<body>service will be shutdown in 1 second</body></message>",
-                result_iq, True, test_sibling=False))
+                sent[1].xmlnode, True, test_sibling=False))
+        self.assertEquals(self.command_manager.jobs.get(session_id).state,
+                          "completed")
         context_session = self.command_manager.sessions[session_id][1]
         self.assertEquals(context_session["announcement"],
                           ["service will be shutdown in 1 second"])
@@ -3392,6 +3730,7 @@ def suite():
     test_suite.addTest(unittest.makeSuite(JCLCommandManagerGetRegisteredUsersNumCommand_TestCase, 'test'))
     test_suite.addTest(unittest.makeSuite(JCLCommandManagerGetDisabledUsersNumCommand_TestCase, 'test'))
     test_suite.addTest(unittest.makeSuite(JCLCommandManagerGetOnlineUsersNumCommand_TestCase, 'test'))
+    test_suite.addTest(unittest.makeSuite(JCLCommandManagerUserStatsCommand_TestCase, 'test'))
     test_suite.addTest(unittest.makeSuite(JCLCommandManagerAnnounceCommand_TestCase, 'test'))
     test_suite.addTest(unittest.makeSuite(JCLCommandManagerSetMOTDCommand_TestCase, 'test'))
     test_suite.addTest(unittest.makeSuite(JCLCommandManagerEditMOTDCommand_TestCase, 'test'))
@@ -42,6 +42,7 @@ import pyxmpp.jabber.vcard as vcard
 
 import jcl.tests
 from jcl.jabber import Handler
+import jcl.jabber as jabber
 from jcl.jabber.component import JCLComponent, AccountManager
 from jcl.jabber.presence import DefaultSubscribeHandler, \
     DefaultUnsubscribeHandler, DefaultPresenceHandler
@@ -284,6 +285,69 @@ class JCLComponent_apply_registered_behavior_TestCase(JCLComponent_TestCase):
         self.assertEquals(len(handler1.handled), 1)
         self.assertEquals(len(handler2.handled), 0)
 
+    def test_apply_registered_behavior_routes(self):
+        self.comp.stream = MockStreamNoConnect()
+        self.comp.stream_class = MockStreamNoConnect
+        message = Message(from_jid="user1@test.com",
+                          to_jid="account11@jcl.test.com")
+        handler1 = HandlerMock()
+        handler1.routes = (jabber.ROOT,)
+        handler2 = HandlerMock()
+        handler2.routes = (jabber.ACCOUNT,)
+        handlers = [[handler1, handler2]]
+        result = self.comp.apply_registered_behavior(handlers, message)
+        self.assertEquals(len(result), 1)
+        self.assertEquals(result[0][0], message)
+        self.assertEquals(len(handler1.handled), 0)
+        self.assertEquals(len(handler2.handled), 1)
+        # dispatch table is rebuilt when handlers change
+        handler3 = HandlerMock()
+        handlers[0].insert(0, handler3)
+        result = self.comp.apply_registered_behavior(handlers, message)
+        self.assertEquals(len(result), 1)
+        self.assertEquals(len(handler3.handled), 1)
+        self.assertEquals(len(handler2.handled), 1)
+
+    def test_get_dispatch_table(self):
+        handlers1 = [[HandlerMock()]]
+        handlers2 = [[HandlerMock()]]
+        table1 = self.comp.get_dispatch_table(handlers1)
+        table2 = self.comp.get_dispatch_table(handlers2)
+        self.assertNotEquals(table1, table2)
+        self.assertTrue(self.comp.get_dispatch_table(handlers1) is table1)
+        self.assertTrue(self.comp.get_dispatch_table(handlers2) is table2)
+        handlers1[0].append(HandlerMock())
+        table3 = self.comp.get_dispatch_table(handlers1)
+        self.assertFalse(table3 is table1)
+        self.assertEquals(len(self.comp.dispatch_tables), 2)
+
+    def test_apply_registered_behavior_shared_filter(self):
+        self.comp.stream = MockStreamNoConnect()
+        self.comp.stream_class = MockStreamNoConnect
+        message = Message(from_jid="user1@test.com",
+                          to_jid="account11@jcl.test.com")
+        calls = []
+        def shared_filter(self, stanza, lang_class):
+            calls.append(self)
+            return None
+        shared_filter = jabber.routed_filter((jabber.ACCOUNT,),
+                                             True)(shared_filter)
+        class SharedFilterHandler(HandlerMock):
+            filter = shared_filter
+        handler1 = SharedFilterHandler()
+        handler2 = SharedFilterHandler()
+        handler3 = HandlerMock()
+        result = self.comp.apply_registered_behavior([[handler1, handler2,
+                                                       handler3]], message)
+        self.assertEquals(len(result), 1)
+        self.assertEquals(result[0][0], message)
+        self.assertEquals(len(calls), 1)
+        self.assertEquals(len(handler3.handled), 1)
+        result = self.comp.apply_registered_behavior([[handler1, handler2,
+                                                       handler3]], message)
+        self.assertEquals(len(result), 1)
+        self.assertEquals(len(calls), 2)
+
 
 class JCLComponent_time_handler_TestCase(JCLComponent_TestCase):
     """time_handler' tests"""
@@ -522,6 +586,33 @@ class JCLComponent_disco_get_items_TestCase(JCLComponent_TestCase):
         self.assertEquals(disco_item.get_node(), account1.name)
         self.assertEquals(disco_item.get_name(), account1.long_name)
 
+    def test_disco_get_items_cached(self):
+        """get_items on main entity twice. Accounts are listed once"""
+        user1 = User(jid="user1@test.com")
+        Account(user=user1,
+                name="account1",
+                jid="account1@jcl.test.com")
+        info_query = Iq(stanza_type="get",
+                        from_jid="user1@test.com/res",
+                        to_jid="jcl.test.com")
+        disco_items = self.comp.disco_get_items(None, info_query)
+        self.assertEquals(len(disco_items.get_items()), 1)
+        account2 = Account(user=user1,
+                           name="account2",
+                           jid="account2@jcl.test.com")
+        disco_items = self.comp.disco_get_items(None, info_query)
+        self.assertEquals(len(disco_items.get_items()), 1)
+        self.assertEquals(self.comp.disco_items_cache.get_stats()["hits"], 1)
+        self.comp.account_manager.remove_account(account2,
+                                                 JID("user1@test.com"))
+        Account(user=user1,
+                name="account3",
+                jid="account3@jcl.test.com")
+        disco_items = self.comp.disco_get_items(None, info_query)
+        self.assertEquals([disco_item.get_node()
+                           for disco_item in disco_items.get_items()],
+                          ["account1", "account3"])
+
     def test_disco_get_items_unknown_node(self):
         self.comp.account_manager.account_classes = (ExampleAccount, )
         account11 = ExampleAccount(user=User(jid="user1@test.com"),
@@ -708,7 +799,7 @@ class JCLComponent_disco_get_items_TestCase(JCLComponent_TestCase):
             info_query)
         self.assertEquals(disco_items.get_node(),
                           "http://jabber.org/protocol/commands")
-        self.assertEquals(len(disco_items.get_items()), 22)
+        self.assertEquals(len(disco_items.get_items()), 23)
 
 
 class JCLComponent_handle_get_version_TestCase(JCLComponent_TestCase):
@@ -1419,6 +1510,7 @@ class JCLComponent_handle_set_register_TestCase(JCLComponent_TestCase):
         model.db_connect()
         _account = account.get_account("user1@test.com", "account1")
         self.assertEquals(_account, None)
+        self.assertEquals(account.get_user("user1@test.com"), None)
         model.db_disconnect()
 
         self.assertEquals(len(stanza_sent), 1)
@@ -3204,7 +3296,8 @@ class Handler_TestCase(JCLTestCase):
 
 class AccountManager_TestCase(JCLTestCase):
     def setUp(self):
-        JCLTestCase.setUp(self, tables=[User, Account, LegacyJID])
+        JCLTestCase.setUp(self, tables=[User, Account, ExampleAccount,
+                                        LegacyJID])
         self.comp = JCLComponent("jcl.test.com",
                                  "password",
                                  "localhost",
@@ -3212,6 +3305,40 @@ class AccountManager_TestCase(JCLTestCase):
                                  None)
         self.account_manager = self.comp.account_manager
 
+    def test_get_registration_form_template(self):
+        template = self.account_manager.get_registration_form_template(\
+            Lang.en, ExampleAccount)
+        self.assertEquals([field.name for (field, label, options)
+                           in template],
+                          ["login", "password", "store_password",
+                           "test_enum", "test_int"])
+        self.assertEquals(template[0][1], "login")
+        self.assertEquals(template[3][2], [("choice1", "choice1"),
+                                           ("choice2", "choice2"),
+                                           ("choice3", "choice3")])
+        self.assertTrue(self.account_manager.get_registration_form_template(\
+                Lang.en, ExampleAccount) is template)
+        self.assertFalse(self.account_manager.get_registration_form_template(\
+                Lang.fr, ExampleAccount) is template)
+        self.account_manager.account_classes = (ExampleAccount,)
+        self.assertFalse(self.account_manager.get_registration_form_template(\
+                Lang.en, ExampleAccount) is template)
+
+    def test_generate_registration_form(self):
+        reg_form = self.account_manager.generate_registration_form(\
+            Lang.en, ExampleAccount, "user1@test.com")
+        self.assertEquals(reg_form["name"].required, True)
+        self.assertEquals(reg_form["login"].required, True)
+        self.assertEquals(reg_form["login"].value, "")
+        self.assertFalse(reg_form["password"].required)
+        self.assertEquals(reg_form["test_enum"].value, "choice2")
+        self.assertEquals(len(reg_form["test_enum"].options), 3)
+        reg_form2 = self.account_manager.generate_registration_form(\
+            Lang.en, ExampleAccount, "user1@test.com")
+        self.assertFalse(reg_form2 is reg_form)
+        reg_form2["login"].value = "login"
+        self.assertEquals(reg_form["login"].value, "")
+
     def test_get_presence_all(self):
         user1 = User(jid="test1@test.com")
         account11 = Account(user=user1,
@@ -3227,7 +3354,11 @@ class AccountManager_TestCase(JCLTestCase):
         account22 = Account(user=user2,
                             name="account22",
                             jid="account22@jcl.test.com")
+        account11.status = account.ONLINE
         result = self.account_manager.get_presence_all("unavailable")
+        self.assertEquals(account11.status, account.ONLINE)
+        result = list(result)
+        self.assertEquals(account11.status, account.OFFLINE)
         self.assertEquals(len(result), 6)
         self.assertEquals(result[0].get_from(), "jcl.test.com")
         self.assertEquals(result[0].get_to(), "test1@test.com")
@@ -3248,6 +3379,63 @@ class AccountManager_TestCase(JCLTestCase):
         self.assertEquals(result[5].get_to(), "test2@test.com")
         self.assertEquals(result[5].get_type(), "unavailable")
 
+    def test_get_presence_all_volatile_password(self):
+        user1 = User(jid="test1@test.com")
+        account11 = ExampleAccount(user=user1,
+                                   name="account11",
+                                   jid="account11@jcl.test.com",
+                                   password="pass",
+                                   store_password=False,
+                                   waiting_password_reply=True)
+        account11.status = account.ONLINE
+        account12 = ExampleAccount(user=user1,
+                                   name="account12",
+                                   jid="account12@jcl.test.com",
+                                   password="pass",
+                                   store_password=True)
+        account12.status = account.ONLINE
+        result = list(self.account_manager.get_presence_all("unavailable"))
+        self.assertEquals(len(result), 3)
+        self.assertEquals(account11.status, account.OFFLINE)
+        self.assertEquals(account11.password, None)
+        self.assertFalse(account11.waiting_password_reply)
+        self.assertEquals(account12.status, account.OFFLINE)
+        self.assertEquals(account12.password, "pass")
+
+    def test_get_presence_all_account_hook(self):
+        user1 = User(jid="test1@test.com")
+        ExampleAccount(user=user1,
+                       name="account11",
+                       jid="account11@jcl.test.com")
+        def get_account_presence_unavailable(to_jid, _account):
+            return [self.account_manager.get_presence(\
+                    from_jid=_account.jid,
+                    to_jid=to_jid,
+                    status=str(_account.test_int),
+                    presence_type="unavailable")]
+        self.account_manager.get_account_presence_unavailable = \
+            get_account_presence_unavailable
+        result = list(self.account_manager.get_presence_all("unavailable"))
+        self.assertEquals(len(result), 2)
+        self.assertEquals(result[1].get_from(), "account11@jcl.test.com")
+        self.assertEquals(result[1].get_to(), "test1@test.com")
+        self.assertEquals(result[1].get_status(), "42")
+
+    def test_get_presence_all_error(self):
+        user1 = User(jid="test1@test.com")
+        account11 = Account(user=user1,
+                            name="account11",
+                            jid="account11@jcl.test.com")
+        account11.status = account.ONLINE
+        def get_account_presence_unavailable(to_jid, _account):
+            raise Exception("presence error")
+        self.account_manager.get_account_presence_unavailable = \
+            get_account_presence_unavailable
+        result = self.account_manager.get_presence_all("unavailable")
+        self.assertEquals(result.next().get_to(), "test1@test.com")
+        self.assertRaises(Exception, result.next)
+        self.assertEquals(account11.status, account.OFFLINE)
+
     def test_populate_account_handler(self):
         self.comp.stream = MockStream()
         self.comp.stream_class = MockStream
@@ -3351,6 +3539,63 @@ class AccountManager_TestCase(JCLTestCase):
             _account.user.jid, _account, _account.default_lang_class, True)
         self.assertEquals(len(result), 0)
 
+    def test_get_accounts_presence_available(self):
+        """Test statuses update of every account of a user"""
+        user1 = User(jid="user1@test.com")
+        account11 = Account(user=user1,
+                            name="account11",
+                            jid="account11@jcl.test.com")
+        account12 = Account(user=user1,
+                            name="account12",
+                            jid="account12@jcl.test.com",
+                            enabled=False)
+        account13 = Account(user=user1,
+                            name="account13",
+                            jid="account13@jcl.test.com",
+                            error="error")
+        lastlogin = account11.lastlogin
+        result = self.account_manager.get_accounts_presence_available(\
+            "user1@test.com", [account11, account12, account13], Lang.en)
+        self.assertEquals(len(result), 3)
+        self.assertEquals(result[0].get_from_jid(), "account11@jcl.test.com")
+        self.assertEquals(result[0].get_show(), account.ONLINE)
+        self.assertEquals(result[0].get_status(), "account11")
+        self.assertEquals(result[1].get_show(), account.XA)
+        self.assertEquals(result[1].get_status(), Lang.en.account_disabled)
+        self.assertEquals(result[2].get_show(), account.DND)
+        self.assertEquals(result[2].get_status(), Lang.en.account_error)
+        self.assertEquals(account11.status, account.ONLINE)
+        self.assertNotEquals(account11.lastlogin, lastlogin)
+        self.assertEquals(account12.status, account.XA)
+        self.assertEquals(account13.status, account.DND)
+
+    def test_get_accounts_presence_available_overridden(self):
+        """Test overridden get_account_presence_available is called for
+        every account"""
+        class MyAccountManager(AccountManager):
+            def get_account_presence_available(self, to_jid, _account,
+                                               lang_class, update=False):
+                _account.status = account.XA
+                return [self.get_presence(from_jid=_account.jid,
+                                          to_jid=to_jid,
+                                          show=account.XA,
+                                          presence_type="available")]
+        account_manager = MyAccountManager(self.comp)
+        user1 = User(jid="user1@test.com")
+        account11 = Account(user=user1,
+                            name="account11",
+                            jid="account11@jcl.test.com")
+        account12 = Account(user=user1,
+                            name="account12",
+                            jid="account12@jcl.test.com")
+        result = account_manager.get_accounts_presence_available(\
+            "user1@test.com", [account11, account12], Lang.en)
+        self.assertEquals(len(result), 2)
+        self.assertEquals(result[1].get_from_jid(), "account12@jcl.test.com")
+        self.assertEquals(result[1].get_show(), account.XA)
+        self.assertEquals(account11.status, account.XA)
+        self.assertEquals(account12.status, account.XA)
+
 def suite():
     test_suite = unittest.TestSuite()
     test_suite.addTest(unittest.makeSuite(JCLComponent_constructor_TestCase, 'test'))
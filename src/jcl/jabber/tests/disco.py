@@ -24,13 +24,17 @@
 import unittest
 
 from pyxmpp.message import Message
+from pyxmpp.jid import JID
+from pyxmpp.jabber.disco import DiscoItems, DiscoItem
 
 from jcl.tests import JCLTestCase
 from jcl.model.tests.account import ExampleAccount
 
 from jcl.model.account import User, Account
 from jcl.jabber.component import JCLComponent
-from jcl.jabber.disco import DiscoHandler, AccountTypeDiscoGetItemsHandler
+from jcl.jabber.disco import DiscoHandler, AccountTypeDiscoGetItemsHandler, \
+    DiscoItemsCache
+from jcl.lang import Lang
 
 class DiscoHandler_TestCase(JCLTestCase):
     def setUp(self):
@@ -69,11 +73,87 @@ class AccountTypeDiscoGetItemsHandler_TestCase (JCLTestCase):
                                               None, None, None,
                                               "Unknown"), [])
 
+class DiscoItemsCache_TestCase(unittest.TestCase):
+    """Test DiscoItemsCache class"""
+    def setUp(self):
+        self.cache = DiscoItemsCache(max_size=2)
+        self.built = []
+
+    def build(self, name):
+        self.built.append(name)
+        disco_items = DiscoItems()
+        DiscoItem(disco_items, JID(name + "@jcl.test.com"), name, name)
+        return disco_items
+
+    def get(self, bare_jid, account_type="", name="account1"):
+        return self.cache.get(bare_jid, account_type, None, Lang.en,
+                              lambda: self.build(name))
+
+    def test_get(self):
+        disco_items = self.get("user1@test.com")
+        self.assertEquals(len(disco_items.get_items()), 1)
+        disco_items = self.get("user1@test.com", name="account2")
+        self.assertEquals(disco_items.get_items()[0].get_node(), "account1")
+        self.assertEquals(self.built, ["account1"])
+        self.get("user1@test.com", "Example")
+        self.assertEquals(self.built, ["account1", "account1"])
+        self.assertEquals(self.cache.get_stats(),
+                          {"entries": 2, "hits": 1, "misses": 2,
+                           "evicted": 0, "invalidations": 0})
+
+    def test_get_returns_copy(self):
+        disco_items = self.get("user1@test.com")
+        DiscoItem(disco_items, JID("command@jcl.test.com"), "command",
+                  "command")
+        disco_items = self.get("user1@test.com")
+        self.assertEquals(len(disco_items.get_items()), 1)
+
+    def test_invalidate(self):
+        self.cache.max_size = 10
+        self.get("user1@test.com")
+        self.get("user1@test.com", "Example")
+        self.get("user2@test.com")
+        self.cache.invalidate(JID("user1@test.com"))
+        disco_items = self.get("user1@test.com", name="account2")
+        self.assertEquals(disco_items.get_items()[0].get_node(), "account2")
+        self.get("user2@test.com")
+        self.assertEquals(self.built, ["account1", "account1", "account1",
+                                       "account2"])
+        self.assertEquals(self.cache.get_stats()["invalidations"], 1)
+
+    def test_invalidate_while_building(self):
+        def build():
+            self.cache.invalidate("user1@test.com")
+            return self.build("account1")
+        self.cache.get("user1@test.com", "", None, Lang.en, build)
+        self.get("user1@test.com", name="account2")
+        self.assertEquals(self.built, ["account1", "account2"])
+
+    def test_evict(self):
+        self.get("user1@test.com")
+        self.get("user2@test.com")
+        self.get("user1@test.com")
+        self.get("user3@test.com")
+        self.assertEquals(self.cache.get_stats()["evicted"], 1)
+        self.get("user1@test.com")
+        self.get("user2@test.com")
+        self.assertEquals(len(self.built), 4)
+        self.assertEquals(self.cache.user_keys.has_key("user3@test.com"),
+                          False)
+
+    def test_disabled(self):
+        self.cache.max_size = 0
+        self.get("user1@test.com")
+        self.get("user1@test.com")
+        self.assertEquals(len(self.built), 2)
+        self.assertEquals(self.cache.get_stats()["entries"], 0)
+
 def suite():
     test_suite = unittest.TestSuite()
     test_suite.addTest(unittest.makeSuite(DiscoHandler_TestCase, 'test'))
     test_suite.addTest(unittest.makeSuite(AccountTypeDiscoGetItemsHandler_TestCase,
                                           'test'))
+    test_suite.addTest(unittest.makeSuite(DiscoItemsCache_TestCase, 'test'))
     return test_suite
 
 if __name__ == '__main__':
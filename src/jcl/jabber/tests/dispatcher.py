@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+##
+## dispatcher.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+
+import unittest
+import threading
+import time
+from ConfigParser import ConfigParser
+
+from pyxmpp.iq import Iq
+from pyxmpp.message import Message
+
+from jcl.jabber.dispatcher import StanzaDispatcher
+from jcl.jabber.tests.component import JCLComponent_TestCase, MockStream, \
+    MockStreamNoConnect
+
+class StanzaDispatcher_TestCase(JCLComponent_TestCase):
+    def setUp(self):
+        JCLComponent_TestCase.setUp(self)
+        self.comp.stream = MockStream()
+        self.dispatcher = StanzaDispatcher(self.comp, workers=3)
+        self.handled = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        self.dispatcher.stop()
+        JCLComponent_TestCase.tearDown(self)
+
+    def handle_message(self, message):
+        # first messages are slower so that ordering depends on the
+        # per user queues
+        time.sleep(0.01 * (3 - len(self.handled) % 3))
+        self.lock.acquire()
+        try:
+            self.handled.append((unicode(message.get_from()),
+                                 message.get_body()))
+        finally:
+            self.lock.release()
+        return [Message(from_jid=message.get_to(),
+                        to_jid=message.get_from(),
+                        body="re: " + message.get_body())]
+
+    def create_message(self, from_jid, body):
+        return Message(from_jid=from_jid,
+                       to_jid="jcl.test.com",
+                       body=body)
+
+    def test_dispatch_not_started(self):
+        result = self.dispatcher.dispatch(self.handle_message,
+                                          self.create_message(\
+                "user1@test.com/res", "1"))
+        self.assertEquals(len(result), 1)
+        self.assertEquals(self.handled, [("user1@test.com/res", "1")])
+
+    def test_dispatch_per_user_order(self):
+        self.dispatcher.start()
+        handler = self.dispatcher.wrap(self.handle_message)
+        for i in xrange(5):
+            for user in ["user1", "user2", "user3"]:
+                self.assertTrue(handler(self.create_message(\
+                            user + "@test.com/res" + str(i), str(i))))
+        self.dispatcher.stop()
+        self.assertEquals(len(self.handled), 15)
+        for user in ["user1", "user2", "user3"]:
+            self.assertEquals([body for (jid, body) in self.handled
+                               if jid.startswith(user)],
+                              ["0", "1", "2", "3", "4"])
+        self.assertEquals(self.comp.stream.sent, [])
+        self.dispatcher.process_results()
+        self.assertEquals(len(self.comp.stream.sent), 15)
+        stats = self.dispatcher.get_stats()
+        self.assertEquals(stats["depth"], 0)
+        self.assertEquals(stats["users"], 0)
+        self.assertEquals(stats["handled"], 15)
+        self.assertEquals(stats["handlers"]["handle_message"]["count"], 15)
+        self.assertTrue(stats["handlers"]["handle_message"]["max_latency"]
+                        > 0)
+
+    def test_dispatch_backpressure(self):
+        self.dispatcher = StanzaDispatcher(self.comp, workers=1, max_size=2)
+        self.dispatcher.start()
+        handler = self.dispatcher.wrap(self.handle_message)
+        for i in xrange(6):
+            handler(self.create_message("user" + str(i) + "@test.com", "1"))
+            self.assertTrue(self.dispatcher.get_stats()["depth"] <= 2)
+        self.dispatcher.stop()
+        self.assertEquals(len(self.handled), 6)
+        self.assertEquals(self.dispatcher.get_stats()["max_depth"], 2)
+
+    def test_dispatch_handler_error(self):
+        def raise_error(stanza):
+            raise Exception("handler error")
+        self.dispatcher.start()
+        handler = self.dispatcher.wrap(raise_error)
+        handler(Iq(from_jid="user1@test.com",
+                   to_jid="jcl.test.com",
+                   stanza_type="get"))
+        handler(self.create_message("user1@test.com", "1"))
+        self.dispatcher.stop()
+        self.dispatcher.process_results()
+        self.assertEquals(len(self.comp.stream.sent), 1)
+        iq_error = self.comp.stream.sent[0]
+        self.assertEquals(iq_error.get_type(), "error")
+        self.assertEquals(iq_error.get_error().get_condition().name,
+                          "internal-server-error")
+
+class JCLComponent_dispatcher_TestCase(JCLComponent_TestCase):
+    def setUp(self):
+        JCLComponent_TestCase.setUp(self)
+        self.comp.config = ConfigParser()
+        self.comp.config.add_section("component")
+        self.comp.config.set("component", "handler_workers", "2")
+        self.comp.config.set("component", "handler_queue_size", "10")
+
+    def tearDown(self):
+        if self.comp.dispatcher is not None:
+            self.comp.dispatcher.stop()
+        JCLComponent_TestCase.tearDown(self)
+
+    def test_setup_dispatcher_disabled(self):
+        self.comp.config.remove_option("component", "handler_workers")
+        self.comp.setup_dispatcher()
+        self.assertEquals(self.comp.dispatcher, None)
+        self.assertEquals(self.comp.wrap_stanza_handler(\
+                self.comp.handle_message), self.comp.handle_message)
+
+    def test_wrap_stanza_handler(self):
+        self.comp.stream = MockStream()
+        self.comp.setup_dispatcher()
+        self.assertEquals(self.comp.dispatcher.max_size, 10)
+        self.assertEquals(self.comp.dispatcher.slow_handler_threshold, 1.0)
+        handler = self.comp.wrap_stanza_handler(self.comp.handle_get_version)
+        self.assertTrue(handler(Iq(from_jid="user1@test.com",
+                                   to_jid="jcl.test.com",
+                                   stanza_type="get")))
+        self.comp.dispatcher.stop()
+        self.assertEquals(self.comp.stream.sent, [])
+        self.comp.dispatcher.process_results()
+        self.assertEquals(len(self.comp.stream.sent), 1)
+        self.assertEquals(self.comp.stream.sent[0].get_type(), "result")
+
+    def test_run(self):
+        def end_run():
+            self.comp.running = False
+        self.comp.handle_tick = end_run
+        self.comp.stream = MockStreamNoConnect()
+        self.comp.stream_class = MockStreamNoConnect
+        (result, time_to_wait) = self.comp.run()
+        self.assertFalse(result)
+        self.assertEquals(self.comp.dispatcher, None)
+        self.assertEquals(len(threading.enumerate()), 1)
+
+def suite():
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(StanzaDispatcher_TestCase, 'test'))
+    test_suite.addTest(unittest.makeSuite(JCLComponent_dispatcher_TestCase,
+                                          'test'))
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
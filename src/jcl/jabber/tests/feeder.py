@@ -23,12 +23,18 @@
 
 import unittest
 import threading
+import time
+import socket
+import select
 
 from sqlobject import *
 
 from jcl.jabber.component import JCLComponent
 from jcl.jabber.feeder import FeederComponent, Feeder, Sender, MessageSender, \
-    HeadlineSender, FeederHandler
+    HeadlineSender, FeederHandler, FeederEngine, FeedTimeoutError, \
+    FeederScheduler, AsyncFeeder, wait_read, sleep, BatchingSender, \
+    FeedPipeline, FilterStage, TransformStage, DedupStage, BatchStage, \
+    merge_data, wait_files
 from jcl.model.account import Account, LegacyJID, User
 import jcl.model as model
 
@@ -48,6 +54,19 @@ class SenderMock(object):
     def send(self, _account, data):
         self.sent.append((_account, data))
 
+def create_accounts(count):
+    """Create `count` accounts, each one of its own user"""
+    model.db_connect()
+    accounts = []
+    for i in xrange(count):
+        accounts.append(ExampleAccount(user=User(jid="user" + str(i)
+                                                 + "@test.com"),
+                                       name="account" + str(i),
+                                       jid="account" + str(i)
+                                       + "@jcl.test.com"))
+    model.db_disconnect()
+    return accounts
+
 class FeederComponent_TestCase(JCLComponent_TestCase):
     def setUp(self):
         JCLTestCase.setUp(self, tables=[Account, LegacyJID, ExampleAccount,
@@ -311,6 +330,499 @@ class FeederHandler_TestCase(JCLTestCase):
         accounts = self.tick_handlers[0].handle(None, None, [account11, account12])
         self.assertEquals(self.tick_handlers[0].feeder.called, 2)
 
+class BatchingSender_TestCase(JCLTestCase):
+    def setUp(self):
+        JCLTestCase.setUp(self, tables=[Account, User])
+        self.comp = FeederComponent("jcl.test.com",
+                                    "password",
+                                    "localhost",
+                                    "5347",
+                                    None,
+                                    None)
+        self.comp.stream = MockStream()
+        self.comp.stream_class = MockStream
+        self.sender = BatchingSender(self.comp, batch_size=3, max_delay=60)
+        model.db_connect()
+        user1 = User(jid="user1@test.com")
+        self.account11 = Account(user=user1,
+                                 name="account11",
+                                 jid="account11@jcl.test.com")
+        self.account12 = Account(user=user1,
+                                 name="account12",
+                                 jid="account12@jcl.test.com")
+        model.db_disconnect()
+
+    def test_send_batch_size(self):
+        model.db_connect()
+        self.sender.send(self.account11, ("subject1", "body1"))
+        self.sender.send(self.account12, ("subject2", "body2"))
+        self.sender.send(self.account11, ("subject3", "body3"))
+        self.assertEquals(len(self.comp.stream.sent), 0)
+        self.sender.send(self.account11, ("subject4", "body4"))
+        model.db_disconnect()
+        self.assertEquals(len(self.comp.stream.sent), 1)
+        message = self.comp.stream.sent[0]
+        self.assertEquals(message.get_from(), "account11@jcl.test.com")
+        self.assertEquals(message.get_to(), "user1@test.com")
+        self.assertEquals(message.get_subject(), "subject1")
+        self.assertEquals(message.get_body(),
+                          "subject1\nbody1\n\nsubject3\nbody3\n\n"
+                          + "subject4\nbody4")
+        self.assertEquals(len(self.sender.batches), 1)
+
+    def test_flush(self):
+        model.db_connect()
+        self.sender.send(self.account11, ("subject1", "body1"))
+        model.db_disconnect()
+        self.sender.flush()
+        self.assertEquals(len(self.comp.stream.sent), 0)
+        self.assertTrue(self.sender.get_flush_delay() > 59)
+        self.sender.batches.values()[0][0] -= 60
+        self.assertEquals(self.sender.get_flush_delay(), 0)
+        self.sender.flush()
+        self.assertEquals(len(self.comp.stream.sent), 1)
+        self.assertEquals(self.comp.stream.sent[0].get_body(), "body1")
+        self.assertEquals(self.sender.get_flush_delay(), None)
+
+    def test_flush_force(self):
+        model.db_connect()
+        self.sender.send(self.account11, ("subject1", "body1"))
+        self.sender.send(self.account12, ("subject2", "body2"))
+        model.db_disconnect()
+        self.sender.flush(True)
+        self.assertEquals(len(self.comp.stream.sent), 2)
+        self.assertEquals(self.sender.batches, {})
+
+    def test_time_handler_flush(self):
+        self.comp.tick_handlers = [FeederHandler(Feeder(self.comp),
+                                                 self.sender)]
+        model.db_connect()
+        self.sender.send(self.account11, ("subject1", "body1"))
+        model.db_disconnect()
+        self.comp.running = False
+        self.comp.time_handler()
+        self.assertEquals(len(self.comp.stream.sent), 1)
+        self.assertEquals(self.sender.batches, {})
+
+class FeedPipeline_TestCase(JCLTestCase):
+    def setUp(self):
+        JCLTestCase.setUp(self, tables=[Account, ExampleAccount, User])
+        model.db_connect()
+        self.account11 = ExampleAccount(user=User(jid="user1@test.com"),
+                                        name="account11",
+                                        jid="account11@jcl.test.com")
+        model.db_disconnect()
+
+    def test_merge_data(self):
+        self.assertEquals(merge_data([("subject", "body")]),
+                          ("subject", "body"))
+        self.assertEquals(merge_data([("subject1", "body1"),
+                                      (None, "body2")]),
+                          ("subject1", "subject1\nbody1\n\nbody2"))
+
+    def test_process(self):
+        pipeline = FeedPipeline([FilterStage(\
+                    lambda _account, data: data[0] != "spam")])
+        pipeline.add(TransformStage(\
+                lambda _account, data: (data[0].upper(), data[1])))
+        pipeline.add(DedupStage(key=lambda data: data[1], max_size=2))
+        pipeline.add(BatchStage(2))
+        items = [("a", "1"), ("spam", "2"), ("b", "1"), ("c", "3"),
+                 ("d", "4")]
+        result = pipeline.process(self.account11, items)
+        self.assertEquals(list(result),
+                          [("A", "A\n1\n\nC\n3"), ("D", "4")])
+        # "1" has been forgotten, "3" and "4" are remembered
+        self.assertEquals(list(pipeline.process(self.account11,
+                                                [("e", "1"), ("f", "4")])),
+                          [("E", "1")])
+
+    def test_process_lazy(self):
+        consumed = []
+        def items():
+            for i in xrange(10):
+                consumed.append(i)
+                yield ("subject", str(i))
+        pipeline = FeedPipeline([BatchStage(2)])
+        result = pipeline.process(self.account11, items())
+        self.assertEquals(consumed, [])
+        result.next()
+        self.assertEquals(consumed, [0, 1])
+
+    def test_feeder_handler_pipeline(self):
+        sender = SenderMock()
+        handler = FeederHandler(FeederMock(), sender,
+                                FeedPipeline([DedupStage()]))
+        handler.pipelines[Example2Account] = FeedPipeline()
+        self.assertEquals(handler.feed_account(self.account11), 1)
+        self.assertEquals(handler.feed_account(self.account11), 0)
+        self.assertEquals(len(sender.sent), 1)
+        handler.pipelines[ExampleAccount] = FeedPipeline()
+        self.assertEquals(handler.feed_account(self.account11), 1)
+
+class FeederEngine_TestCase(JCLTestCase):
+    def setUp(self):
+        JCLTestCase.setUp(self, tables=[Account, ExampleAccount, User])
+        self.comp = FeederComponent("jcl.test.com",
+                                    "password",
+                                    "localhost",
+                                    "5347",
+                                    None,
+                                    None)
+        self.comp.stream = MockStream()
+        self.comp.stream_class = MockStream
+        self.engine = FeederEngine(self.comp, workers=3, poll_interval=0.05)
+        self.lock = threading.Lock()
+        self.fed = []
+
+    def tearDown(self):
+        self.engine.stop()
+        JCLTestCase.tearDown(self)
+
+    def test_run_tick(self):
+        test = self
+        class SlowFeeder(Feeder):
+            def feed(self, _account):
+                time.sleep(0.1)
+                test.lock.acquire()
+                try:
+                    test.fed.append(_account.name)
+                finally:
+                    test.lock.release()
+                return [("subject", "body")]
+        create_accounts(6)
+        sender = SenderMock()
+        self.engine.start()
+        start = time.time()
+        self.engine.run_tick([FeederHandler(SlowFeeder(), sender)], None)
+        self.assertTrue(time.time() - start < 0.5)
+        self.assertEquals(len(self.fed), 6)
+        self.assertEquals(len(sender.sent), 6)
+        stats = self.engine.get_stats()
+        self.assertEquals(stats["ticks"], 1)
+        self.assertEquals(stats["account_types"]["ExampleAccount"]["count"],
+                          6)
+
+    def test_run_tick_error(self):
+        class ErrorFeeder(Feeder):
+            def feed(self, _account):
+                if _account.name == "account0":
+                    raise Exception("feed error")
+                return [("subject", "body")]
+        accounts = create_accounts(2)
+        sender = SenderMock()
+        self.engine.start()
+        self.engine.run_tick([FeederHandler(ErrorFeeder(), sender)], None)
+        self.assertEquals(len(sender.sent), 1)
+        self.assertEquals(sender.sent[0][0].name, "account1")
+        model.db_connect()
+        self.assertEquals(accounts[0].error, "feed error")
+        self.assertEquals(accounts[1].error, None)
+        model.db_disconnect()
+        messages = [stanza for stanza in self.comp.stream.sent
+                    if stanza.get_node().name == "message"]
+        self.assertEquals(len(messages), 1)
+        self.assertEquals(messages[0].get_type(), "error")
+        self.assertEquals(messages[0].get_to(), "user0@test.com")
+        stats = self.engine.get_stats()
+        self.assertEquals(stats["account_types"]["ExampleAccount"]["errors"],
+                          1)
+
+    def test_run_tick_timeout(self):
+        event = threading.Event()
+        class BlockingFeeder(Feeder):
+            def feed(self, _account):
+                if _account.name == "account0":
+                    event.wait(5)
+                return [("subject", "body")]
+        accounts = create_accounts(2)
+        sender = SenderMock()
+        handler = FeederHandler(BlockingFeeder(), sender)
+        self.engine.feed_timeout = 0.2
+        self.engine.start()
+        self.engine.run_tick([handler], None)
+        self.assertEquals(len(sender.sent), 1)
+        model.db_connect()
+        self.assertEquals(accounts[0].error, str(FeedTimeoutError(0.2)))
+        model.db_disconnect()
+        # blocked account is skipped by the next tick
+        self.engine.run_tick([handler], None)
+        self.assertEquals(len(sender.sent), 2)
+        self.assertEquals(sender.sent[1][0].name, "account1")
+        stats = self.engine.get_stats()
+        self.assertEquals(stats["skipped"], 1)
+        self.assertEquals(\
+            stats["account_types"]["ExampleAccount"]["timeouts"], 1)
+        self.assertEquals(len(self.engine.threads), 3)
+        self.assertEquals(stats["abandoned"], 1)
+        event.set()
+
+    def test_run_tick_timeout_max_abandoned(self):
+        event = threading.Event()
+        class BlockingFeeder(Feeder):
+            def feed(self, _account):
+                event.wait(5)
+                return [("subject", "body")]
+        create_accounts(2)
+        handler = FeederHandler(BlockingFeeder(), SenderMock())
+        self.engine.feed_timeout = 0.2
+        self.engine.max_abandoned = 1
+        self.engine.start()
+        self.engine.run_tick([handler], None)
+        stats = self.engine.get_stats()
+        self.assertEquals(\
+            stats["account_types"]["ExampleAccount"]["timeouts"], 2)
+        # only one stuck worker has been replaced
+        self.assertEquals(stats["abandoned"], 1)
+        self.assertEquals(self.engine.worker_count, 4)
+        event.set()
+
+    def test_run_tick_other_handler(self):
+        class OtherHandler(object):
+            def __init__(self):
+                self.handled = False
+            def filter(self, stanza, lang_class):
+                return []
+            def handle(self, stanza, lang_class, data):
+                self.handled = True
+                return []
+        handler = OtherHandler()
+        self.engine.start()
+        self.engine.run_tick([handler], None)
+        self.assertTrue(handler.handled)
+
+class FeederScheduler_TestCase(JCLTestCase):
+    def setUp(self):
+        JCLTestCase.setUp(self, tables=[Account, ExampleAccount, User])
+        self.comp = FeederComponent("jcl.test.com",
+                                    "password",
+                                    "localhost",
+                                    "5347",
+                                    None,
+                                    None)
+        self.comp.stream = MockStream()
+        self.comp.stream_class = MockStream
+        self.scheduler = FeederScheduler(FeederEngine(self.comp, 0),
+                                         default_interval=10, jitter=0,
+                                         max_backoff=4)
+        self.handler = FeederHandler(FeederMock(), SenderMock())
+
+    def test_refresh(self):
+        create_accounts(3)
+        self.scheduler.refresh([self.handler], None, 1000)
+        self.assertEquals(len(self.scheduler.entries), 3)
+        for entry in self.scheduler.entries.itervalues():
+            self.assertTrue(1000 <= entry.due < 1010)
+        self.assertEquals(self.scheduler.pop_due(999), [])
+        self.assertEquals(len(self.scheduler.pop_due(1010)), 3)
+
+    def test_refresh_removed_account(self):
+        accounts = create_accounts(2)
+        self.scheduler.refresh([self.handler], None, 1000)
+        model.db_connect()
+        accounts[0].destroySelf()
+        model.db_disconnect()
+        self.scheduler.refresh([self.handler], None, 1000)
+        self.assertEquals(len(self.scheduler.entries), 1)
+        self.assertEquals(len(self.scheduler.pop_due(1010)), 1)
+
+    def test_get_delay(self):
+        self.assertEquals(self.scheduler.get_delay(1000), 0)
+        create_accounts(1)
+        self.scheduler.refresh([self.handler], None, 1000)
+        self.scheduler.next_handlers_run = 1010
+        entry = self.scheduler.entries.values()[0]
+        self.scheduler.push(entry, 1005)
+        self.assertEquals(self.scheduler.get_delay(1000), 5)
+        # entry rescheduled, first heap item is outdated
+        self.scheduler.push(entry, 1008)
+        self.assertEquals(self.scheduler.get_delay(1000), 8)
+
+    def test_reschedule_backoff(self):
+        create_accounts(1)
+        self.scheduler.refresh([self.handler], None, 1000)
+        entry = self.scheduler.entries.values()[0]
+        self.scheduler.reschedule(entry, 1000, count=0)
+        self.assertEquals(entry.backoff, 1.25)
+        self.assertEquals(entry.due, 1012.5)
+        self.scheduler.reschedule(entry, 1000, error=True)
+        self.assertEquals(entry.backoff, 2.5)
+        self.scheduler.reschedule(entry, 1000, error=True)
+        self.assertEquals(entry.backoff, 4)
+        self.assertEquals(entry.due, 1040)
+        self.scheduler.reschedule(entry, 1000, count=2)
+        self.assertEquals(entry.backoff, 1)
+        self.assertEquals(entry.due, 1010)
+
+    def test_run(self):
+        class ErrorFeeder(Feeder):
+            def feed(self, _account):
+                if _account.name == "account0":
+                    raise Exception("feed error")
+                return [("subject", "body")]
+        self.handler.feeder = ErrorFeeder()
+        create_accounts(3)
+        self.scheduler.run([self.handler], None)
+        for entry in self.scheduler.entries.itervalues():
+            self.scheduler.push(entry, 0)
+        self.scheduler.run([self.handler], None)
+        self.assertEquals(len(self.handler.sender.sent), 2)
+        backoffs = [entry.backoff
+                    for entry in self.scheduler.entries.itervalues()]
+        backoffs.sort()
+        self.assertEquals(backoffs, [1, 1, 2])
+        self.assertEquals(self.scheduler.pop_due(time.time()), [])
+
+class SleepAsyncFeeder(AsyncFeeder):
+    def __init__(self, component=None):
+        AsyncFeeder.__init__(self, component)
+        self.running = 0
+        self.max_running = 0
+
+    def get_host(self, _account):
+        return "host" + str(int(_account.name[-1]) % 2)
+
+    def feed_async(self, _account):
+        self.running += 1
+        self.max_running = max(self.max_running, self.running)
+        try:
+            yield sleep(0.05)
+            yield ("subject", _account.name)
+        finally:
+            self.running -= 1
+
+class AsyncFeeder_TestCase(JCLTestCase):
+    def setUp(self):
+        JCLTestCase.setUp(self, tables=[Account, ExampleAccount, User])
+        self.comp = FeederComponent("jcl.test.com",
+                                    "password",
+                                    "localhost",
+                                    "5347",
+                                    None,
+                                    None)
+        self.comp.stream = MockStream()
+        self.comp.stream_class = MockStream
+        self.engine = FeederEngine(self.comp, 0, poll_interval=0.05,
+                                   async_host_limit=2)
+
+    def test_feed_exist(self):
+        feeder = AsyncFeeder()
+        self.assertRaises(NotImplementedError, feeder.feed_async, None)
+
+    def test_feed_blocking(self):
+        accounts = create_accounts(1)
+        feeder = SleepAsyncFeeder()
+        self.assertEquals(feeder.feed(accounts[0]),
+                          [("subject", "account0")])
+
+    def test_run_tick_limits(self):
+        create_accounts(8)
+        sender = SenderMock()
+        feeder = SleepAsyncFeeder()
+        start = time.time()
+        self.engine.run_tick([FeederHandler(feeder, sender)], None)
+        self.assertTrue(time.time() - start < 0.15 * 4)
+        self.assertEquals(len(sender.sent), 8)
+        # 2 hosts and 2 accounts per host
+        self.assertEquals(feeder.max_running, 4)
+        self.assertEquals(feeder.running, 0)
+        stats = self.engine.get_stats()
+        self.assertEquals(stats["account_types"]["ExampleAccount"]["count"],
+                          8)
+
+    def test_run_tick_socket(self):
+        (sock1, sock2) = socket.socketpair()
+        class SocketFeeder(AsyncFeeder):
+            def feed_async(self, _account):
+                yield wait_read(sock1)
+                yield ("subject", sock1.recv(100))
+        create_accounts(1)
+        sender = SenderMock()
+        timer = threading.Timer(0.1, sock2.send, ["data"])
+        timer.start()
+        try:
+            self.engine.run_tick([FeederHandler(SocketFeeder(), sender)],
+                                 None)
+        finally:
+            timer.join()
+            sock1.close()
+            sock2.close()
+        self.assertEquals(len(sender.sent), 1)
+        self.assertEquals(sender.sent[0][1], ("subject", "data"))
+
+    def test_wait_files(self):
+        (sock1, sock2) = socket.socketpair()
+        try:
+            self.assertEquals(wait_files([sock1], [sock2], 0),
+                              ([], [sock2]))
+            sock2.send("data")
+            self.assertEquals(wait_files([sock1, sock2.fileno()], [], 1),
+                              ([sock1], []))
+        finally:
+            sock1.close()
+            sock2.close()
+
+    def test_wait_files_select(self):
+        poll = select.poll
+        del select.poll
+        try:
+            self.test_wait_files()
+        finally:
+            select.poll = poll
+
+    def test_run_tick_error_and_timeout(self):
+        class ErrorFeeder(AsyncFeeder):
+            def feed_async(self, _account):
+                if _account.name == "account0":
+                    raise Exception("feed error")
+                elif _account.name == "account1":
+                    yield sleep(10)
+                yield ("subject", "body")
+        accounts = create_accounts(3)
+        sender = SenderMock()
+        self.engine.feed_timeout = 0.2
+        start = time.time()
+        self.engine.run_tick([FeederHandler(ErrorFeeder(), sender)], None)
+        self.assertTrue(time.time() - start < 1)
+        self.assertEquals(len(sender.sent), 1)
+        self.assertEquals(sender.sent[0][0].name, "account2")
+        model.db_connect()
+        self.assertEquals(accounts[0].error, "feed error")
+        self.assertEquals(accounts[1].error, str(FeedTimeoutError(0.2)))
+        model.db_disconnect()
+        stats = self.engine.get_stats()["account_types"]["ExampleAccount"]
+        self.assertEquals(stats["errors"], 1)
+        self.assertEquals(stats["timeouts"], 1)
+
+    def test_run_tick_ready_and_timeout(self):
+        class SleepFeeder(AsyncFeeder):
+            def feed_async(self, _account):
+                yield sleep(0.2)
+                yield ("subject", "body")
+        create_accounts(1)
+        sender = SenderMock()
+        self.engine.feed_timeout = 0.2
+        self.engine.run_tick([FeederHandler(SleepFeeder(), sender)], None)
+        self.assertEquals(len(sender.sent), 0)
+        stats = self.engine.get_stats()["account_types"]["ExampleAccount"]
+        self.assertEquals(stats["timeouts"], 1)
+
+    def test_run_tick_with_sync_feeder(self):
+        create_accounts(2)
+        async_sender = SenderMock()
+        sync_sender = SenderMock()
+        self.engine.workers = 2
+        self.engine.start()
+        try:
+            self.engine.run_tick([FeederHandler(SleepAsyncFeeder(),
+                                                async_sender),
+                                  FeederHandler(FeederMock(), sync_sender)],
+                                 None)
+        finally:
+            self.engine.stop()
+        self.assertEquals(len(async_sender.sent), 2)
+        self.assertEquals(len(sync_sender.sent), 2)
+
 def suite():
     test_suite = unittest.TestSuite()
     test_suite.addTest(unittest.makeSuite(FeederComponent_TestCase, 'test'))
@@ -319,6 +831,11 @@ def suite():
     test_suite.addTest(unittest.makeSuite(MessageSender_TestCase, 'test'))
     test_suite.addTest(unittest.makeSuite(HeadlineSender_TestCase, 'test'))
     test_suite.addTest(unittest.makeSuite(FeederHandler_TestCase, 'test'))
+    test_suite.addTest(unittest.makeSuite(BatchingSender_TestCase, 'test'))
+    test_suite.addTest(unittest.makeSuite(FeedPipeline_TestCase, 'test'))
+    test_suite.addTest(unittest.makeSuite(FeederEngine_TestCase, 'test'))
+    test_suite.addTest(unittest.makeSuite(FeederScheduler_TestCase, 'test'))
+    test_suite.addTest(unittest.makeSuite(AsyncFeeder_TestCase, 'test'))
     return test_suite
 
 if __name__ == '__main__':
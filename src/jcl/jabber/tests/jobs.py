@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+##
+## jobs.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+
+import unittest
+
+from jcl.jabber.jobs import Job, BroadcastJob, JobManager, JOB_PENDING, \
+    JOB_RUNNING, JOB_COMPLETED, JOB_CANCELED, JOB_FAILED
+import jcl.model.account as account
+from jcl.model.account import Account, User
+from jcl.jabber.tests.component import JCLComponent_TestCase, MockStream
+
+class CountJob(Job):
+    def __init__(self, job_id, count=3, error=False):
+        Job.__init__(self, job_id)
+        self.count = count
+        self.error = error
+
+    def execute(self):
+        self.total = self.count
+        while self.done < self.total and not self.canceled:
+            if self.error:
+                raise Exception("test error")
+            self.done += 1
+            if self.done == 2 and self.job_id == "cancel":
+                self.cancel()
+
+class Job_TestCase(unittest.TestCase):
+    def test_run(self):
+        job = CountJob("test")
+        self.assertEquals(job.state, JOB_PENDING)
+        self.assertFalse(job.is_finished())
+        job.run()
+        self.assertEquals(job.state, JOB_COMPLETED)
+        self.assertEquals(job.done, 3)
+        self.assertTrue(job.is_finished())
+
+    def test_run_canceled(self):
+        job = CountJob("cancel")
+        job.run()
+        self.assertEquals(job.state, JOB_CANCELED)
+        self.assertEquals(job.done, 2)
+
+    def test_run_error(self):
+        job = CountJob("test", error=True)
+        job.run()
+        self.assertEquals(job.state, JOB_FAILED)
+        self.assertTrue(job.is_finished())
+
+    def test_cancel_pending(self):
+        job = CountJob("test")
+        job.cancel()
+        self.assertEquals(job.state, JOB_CANCELED)
+        self.assertTrue(job.wait(0))
+
+class JobManager_TestCase(unittest.TestCase):
+    def test_start(self):
+        job_manager = JobManager()
+        job = job_manager.start(CountJob("test"))
+        self.assertTrue(job.wait(5))
+        self.assertEquals(job_manager.get("test"), job)
+        self.assertEquals(job.state, JOB_COMPLETED)
+
+    def test_cancel(self):
+        job_manager = JobManager()
+        job = job_manager.add(CountJob("test"))
+        self.assertEquals(job_manager.cancel("test"), job)
+        self.assertEquals(job.state, JOB_CANCELED)
+        self.assertEquals(job_manager.cancel("unknown"), None)
+
+    def test_cleanup(self):
+        job_manager = JobManager(max_finished=1)
+        job1 = job_manager.add(CountJob("job1"))
+        job1.run()
+        job2 = job_manager.add(CountJob("job2"))
+        job2.run()
+        job_manager.add(CountJob("job3"))
+        self.assertEquals(job_manager.get("job1"), None)
+        self.assertEquals(job_manager.get("job2"), job2)
+        self.assertEquals(job_manager.get_stats(),
+                          {JOB_PENDING: 1, JOB_RUNNING: 0, JOB_COMPLETED: 1,
+                           JOB_CANCELED: 0, JOB_FAILED: 0})
+
+class BroadcastJob_TestCase(JCLComponent_TestCase):
+    def setUp(self):
+        JCLComponent_TestCase.setUp(self)
+        self.comp.stream = MockStream()
+        for index in range(1, 6):
+            user = User(jid="user" + str(index) + "@test.com")
+            _account = Account(user=user,
+                               name="account" + str(index),
+                               jid="account" + str(index) + "@jcl.test.com")
+            if index != 3:
+                _account.status = account.ONLINE
+
+    def test_execute(self):
+        job = BroadcastJob("test", self.comp, "test broadcast", chunk_size=3)
+        job.run()
+        self.assertEquals(job.state, JOB_COMPLETED)
+        self.assertEquals(job.total, 4)
+        self.assertEquals(job.done, 4)
+        self.assertEquals([unicode(message.get_to())
+                           for message in self.comp.stream.sent],
+                          [u"user1@test.com", u"user2@test.com",
+                           u"user4@test.com", u"user5@test.com"])
+        self.assertEquals(self.comp.stream.sent[0].get_body(),
+                          "test broadcast")
+
+    def test_execute_canceled(self):
+        job = BroadcastJob("test", self.comp, "test broadcast", chunk_size=3)
+        sent = self.comp.stream.sent
+        def send_stanzas(stanzas, priority=None):
+            sent.extend(stanzas)
+            if len(sent) == 2:
+                job.cancel()
+        self.comp.send_stanzas = send_stanzas
+        job.run()
+        self.assertEquals(job.state, JOB_CANCELED)
+        self.assertEquals(job.done, 2)
+        self.assertEquals(len(sent), 2)
+
+def suite():
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(Job_TestCase, 'test'))
+    test_suite.addTest(unittest.makeSuite(JobManager_TestCase, 'test'))
+    test_suite.addTest(unittest.makeSuite(BroadcastJob_TestCase, 'test'))
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
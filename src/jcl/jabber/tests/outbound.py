@@ -0,0 +1,283 @@
+# -*- coding: utf-8 -*-
+##
+## outbound.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+
+import unittest
+import threading
+from ConfigParser import ConfigParser
+
+from pyxmpp.iq import Iq
+from pyxmpp.message import Message
+from pyxmpp.presence import Presence
+
+from jcl.jabber.outbound import TokenBucket, OutboundQueue, \
+    get_stanza_priority, PRIORITY_IQ, PRIORITY_NORMAL, PRIORITY_BULK
+from jcl.jabber.tests.component import JCLComponent_TestCase, MockStream
+
+class MockClock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+class TokenBucket_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.clock = MockClock()
+        self.bucket = TokenBucket(2, 3, self.clock)
+
+    def test_consume_burst(self):
+        self.assertEquals(self.bucket.consume(), 0)
+        self.assertEquals(self.bucket.consume(), 0)
+        self.assertEquals(self.bucket.consume(), 0)
+        self.assertEquals(self.bucket.consume(), 0.5)
+
+    def test_consume_refill(self):
+        for i in xrange(3):
+            self.bucket.consume()
+        self.clock.now += 0.5
+        self.assertEquals(self.bucket.consume(), 0)
+        self.assertEquals(self.bucket.consume(), 0.5)
+        self.clock.now += 10
+        for i in xrange(3):
+            self.assertEquals(self.bucket.consume(), 0)
+        self.assertTrue(self.bucket.consume() > 0)
+
+    def test_get_delay(self):
+        for i in xrange(3):
+            self.assertEquals(self.bucket.get_delay(), 0)
+        self.bucket.consume()
+        self.bucket.consume()
+        self.bucket.consume()
+        self.assertEquals(self.bucket.get_delay(), 0.5)
+        self.assertEquals(self.bucket.consume(), 0.5)
+
+class OutboundQueue_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.sent = []
+        self.clock = MockClock()
+        self.queue = OutboundQueue(self.sent.append, 1, 2, max_size=10,
+                                   time_func=self.clock)
+        self.message = Message(from_jid="jcl.test.com",
+                               to_jid="user1@test.com",
+                               body="message")
+        self.headline = Message(from_jid="jcl.test.com",
+                                to_jid="user1@test.com",
+                                stanza_type="headline",
+                                body="headline")
+        self.iq = Iq(from_jid="jcl.test.com",
+                     to_jid="user1@test.com",
+                     stanza_type="result")
+        self.presence = Presence(from_jid="jcl.test.com",
+                                 to_jid="user1@test.com")
+
+    def test_get_stanza_priority(self):
+        self.assertEquals(get_stanza_priority(self.iq), PRIORITY_IQ)
+        self.assertEquals(get_stanza_priority(self.message), PRIORITY_NORMAL)
+        self.assertEquals(get_stanza_priority(self.presence), PRIORITY_NORMAL)
+        self.assertEquals(get_stanza_priority(self.headline), PRIORITY_BULK)
+
+    def test_flush_priority_order(self):
+        self.queue.put(self.headline)
+        self.queue.put(self.message)
+        self.queue.put(self.presence, PRIORITY_BULK)
+        self.queue.put(self.iq)
+        stats = self.queue.get_stats()
+        self.assertEquals(stats["depth"], 4)
+        self.assertEquals(stats["iq_depth"], 1)
+        self.assertEquals(stats["normal_depth"], 1)
+        self.assertEquals(stats["bulk_depth"], 2)
+        self.queue.flush()
+        self.assertEquals(self.sent, [self.iq, self.message, self.headline,
+                                      self.presence])
+        self.assertEquals(len(self.queue), 0)
+
+    def test_process_rate_limited(self):
+        for i in xrange(4):
+            self.queue.put(self.message)
+        self.assertEquals(self.queue.process(), 0)
+        self.assertEquals(self.queue.process(), 0)
+        self.assertEquals(self.queue.process(), 1)
+        self.assertEquals(len(self.sent), 2)
+        self.clock.now += 1.5
+        self.assertEquals(self.queue.process(), 0)
+        self.assertEquals(self.queue.process(), 0.5)
+        self.assertEquals(len(self.sent), 3)
+        stats = self.queue.get_stats()
+        self.assertEquals(stats["sent"], 3)
+        self.assertEquals(stats["depth"], 1)
+        self.assertEquals(stats["max_depth"], 4)
+        self.assertEquals(stats["max_latency"], 1.5)
+        self.assertEquals(stats["average_latency"], 0.5)
+
+    def test_send_error(self):
+        def send_error(stanza):
+            raise Exception("send error")
+        self.queue.send_func = send_error
+        self.queue.put(self.message)
+        self.queue.flush()
+        self.assertEquals(self.queue.get_stats()["errors"], 1)
+
+    def test_start_stop(self):
+        self.queue = OutboundQueue(self.sent.append, 1000, 1000, max_size=2)
+        self.queue.start()
+        for i in xrange(10):
+            self.queue.put(self.message)
+        self.queue.stop()
+        self.assertEquals(len(self.sent), 10)
+        self.assertEquals(threading.activeCount(), 1)
+
+    def test_put_source(self):
+        pulled = []
+        def stanzas():
+            for i in xrange(3):
+                pulled.append(i)
+                yield self.presence
+        self.queue.put_source(stanzas())
+        self.queue.put(self.message)
+        self.assertEquals(pulled, [])
+        self.assertEquals(self.queue.get_stats()["sources"], 1)
+        self.assertEquals(self.queue.process(), 0)
+        self.assertEquals(self.sent, [self.message])
+        self.assertEquals(self.queue.process(), 0)
+        self.assertEquals(pulled, [0])
+        self.assertEquals(self.sent, [self.message, self.presence])
+        self.assertTrue(self.queue.process() > 0)
+        self.assertEquals(pulled, [0])
+        self.queue.flush()
+        self.assertEquals(pulled, [0, 1, 2])
+        self.assertEquals(len(self.sent), 4)
+        self.assertEquals(self.queue.get_stats()["sources"], 0)
+
+    def test_put_source_exhausted(self):
+        self.queue.put_source([])
+        self.queue.put(self.message)
+        self.queue.put(self.message)
+        self.assertEquals(self.queue.process(), 0)
+        self.assertEquals(self.sent, [])
+        # no token is taken for the exhausted source
+        self.assertEquals(self.queue.process(), 0)
+        self.assertEquals(self.queue.process(), 0)
+        self.assertEquals(len(self.sent), 2)
+
+    def test_put_source_error(self):
+        cleaned = []
+        def stanzas():
+            try:
+                yield self.presence
+                raise Exception("source error")
+            finally:
+                cleaned.append(True)
+        self.queue.put_source(stanzas())
+        self.queue.flush()
+        self.assertEquals(self.sent, [self.presence])
+        self.assertEquals(cleaned, [True])
+        stats = self.queue.get_stats()
+        self.assertEquals(stats["errors"], 1)
+        self.assertEquals(stats["sources"], 0)
+
+    def test_stop_rate_limited(self):
+        self.queue = OutboundQueue(self.sent.append, 1000, 1, max_size=2)
+        self.queue.start()
+        self.queue.put_source([self.message] * 10)
+        self.queue.stop()
+        self.assertEquals(len(self.sent), 10)
+        self.assertEquals(threading.activeCount(), 1)
+
+    def test_stop_timeout(self):
+        self.queue = OutboundQueue(self.sent.append, 0.001, 1, max_size=10)
+        self.queue.start()
+        for i in xrange(3):
+            self.queue.put(self.message)
+        self.queue.stop(0.1)
+        self.assertEquals(len(self.sent), 3)
+        self.assertEquals(threading.activeCount(), 1)
+
+class JCLComponent_outbound_TestCase(JCLComponent_TestCase):
+    def tearDown(self):
+        if self.comp.outbound_queue is not None:
+            self.comp.outbound_queue.stop(0)
+        JCLComponent_TestCase.tearDown(self)
+
+    def test_setup_outbound_queue_disabled(self):
+        self.comp.setup_outbound_queue()
+        self.assertEquals(self.comp.outbound_queue, None)
+
+    def test_send_stanzas_outbound_queue(self):
+        self.comp.config = ConfigParser()
+        self.comp.config.add_section("component")
+        self.comp.config.set("component", "send_rate", "0.001")
+        self.comp.config.set("component", "send_burst", "1")
+        self.comp.stream = MockStream()
+        self.comp.setup_outbound_queue()
+        self.assertEquals(self.comp.outbound_queue.bucket.burst, 1)
+        self.assertEquals(self.comp.outbound_queue.max_size, 10000)
+        message = Message(from_jid="jcl.test.com",
+                          to_jid="user1@test.com",
+                          body="message")
+        message2 = Message(from_jid="jcl.test.com",
+                           to_jid="user2@test.com",
+                           body="message")
+        iq = Iq(from_jid="jcl.test.com",
+                to_jid="user1@test.com",
+                stanza_type="result")
+        self.comp.send_stanzas([message])
+        self.comp.outbound_queue.condition.acquire()
+        try:
+            # first message is sent with the only token, others must wait
+            while self.comp.stream.sent == []:
+                self.comp.outbound_queue.condition.wait(0.1)
+            self.comp.send_stanzas([message2, iq])
+        finally:
+            self.comp.outbound_queue.condition.release()
+        self.assertEquals(self.comp.stream.sent, [message])
+        self.assertEquals(len(self.comp.outbound_queue), 2)
+        self.comp.outbound_queue.stop(0)
+        self.assertEquals(self.comp.stream.sent, [message, iq, message2])
+
+    def test_send_stanzas_bulk_generator(self):
+        self.comp.config = ConfigParser()
+        self.comp.config.add_section("component")
+        self.comp.config.set("component", "send_rate", "0.001")
+        self.comp.config.set("component", "send_burst", "1")
+        self.comp.config.set("component", "send_stop_timeout", "0")
+        self.comp.stream = MockStream()
+        self.comp.setup_outbound_queue()
+        self.assertEquals(self.comp.send_stop_timeout, 0)
+        def stanzas():
+            for i in xrange(3):
+                yield Message(from_jid="jcl.test.com",
+                              to_jid="user1@test.com",
+                              body="message")
+        # returns without waiting for tokens
+        self.comp.send_stanzas(stanzas(), PRIORITY_BULK)
+        self.comp.outbound_queue.stop(self.comp.send_stop_timeout)
+        self.assertEquals(len(self.comp.stream.sent), 3)
+
+def suite():
+    test_suite = unittest.TestSuite()
+    test_suite.addTest(unittest.makeSuite(TokenBucket_TestCase, 'test'))
+    test_suite.addTest(unittest.makeSuite(OutboundQueue_TestCase, 'test'))
+    test_suite.addTest(unittest.makeSuite(JCLComponent_outbound_TestCase,
+                                          'test'))
+    return test_suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
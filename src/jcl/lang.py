@@ -27,6 +27,36 @@ lang -- contains translations
 
 __revision__ = "$Id: lang.py,v 1.3 2005/09/18 20:24:07 dax Exp $"
 
+import inspect
+
+# lang class -> catalog (see get_catalog)
+catalogs = {}
+
+# maximum number of xml:lang tags cached by a Lang instance
+MAX_CACHED_LANGS = 256
+
+def get_catalog(lang_class):
+    """
+    Return a dictionary of every translation of `lang_class`, inherited
+    ones included (fallbacks are resolved once, when the catalog is
+    compiled on first call).
+    """
+    catalog = catalogs.get(lang_class)
+    if catalog is None:
+        catalog = {}
+        mro = list(inspect.getmro(lang_class))
+        mro.reverse()
+        for base_class in mro:
+            for (name, value) in base_class.__dict__.items():
+                if not name.startswith("_"):
+                    catalog[name] = value
+        catalogs[lang_class] = catalog
+    return catalog
+
+def get_label(lang_class, name, default=None):
+    """Return `name` translation of `lang_class`, `default` if missing"""
+    return get_catalog(lang_class).get(name, default)
+
 class Lang:
     """
     Lang.
@@ -35,6 +65,10 @@ class Lang:
     # pylint: disable-msg=W0232, R0903, C0103, C0111
     def __init__(self, default_lang = "en"):
         self.default_lang = default_lang
+        # xml:lang tag -> lang class
+        self.lang_classes = {}
+        # other catalogs are compiled when their language is requested
+        get_catalog(self.get_default_lang_class())
 
     def get_lang_from_node(self, node):
         """
@@ -54,11 +88,20 @@ class Lang:
         :Parameters:
            - `lang`: lang code.
         """
-        if lang is not None:
-            lang = lang[:2]
-        if hasattr(self.__class__, lang):
-            return getattr(self.__class__, lang)
-        return getattr(self.__class__, self.default_lang)
+        lang_class = self.lang_classes.get(lang)
+        if lang_class is not None:
+            return lang_class
+        lang_code = lang
+        if lang_code is not None:
+            lang_code = lang_code[:2]
+        if hasattr(self.__class__, lang_code):
+            lang_class = getattr(self.__class__, lang_code)
+        else:
+            lang_class = getattr(self.__class__, self.default_lang)
+        if len(self.lang_classes) >= MAX_CACHED_LANGS:
+            self.lang_classes.clear()
+        self.lang_classes[lang] = lang_class
+        return lang_class
 
     def get_lang_class_from_node(self, node):
         """Return lang class from XML node.
@@ -186,6 +229,12 @@ class Lang:
         field_disabled_users_num = u"The number of disabled accounts"
         field_online_users_num = u"The number of online accounts"
 
+        command_user_stats = u"Get user statistics"
+        command_user_stats_1_description = \
+            u"Fill out this form with user Jabber ID for which to retrieve" \
+            u" statistics (or leave it empty for statistics of all accounts)"
+        field_roster_size = u"The number of roster items"
+
         field_max_items = u"Maximum number of items to show"
         field_registered_users_list = u"The list of registered accounts"
         field_disabled_users_list = u"The list of disabled accounts"
@@ -238,6 +287,12 @@ class Lang:
         field_240_sec = u"240 seconds"
         field_300_sec = u"300 seconds"
 
+        job_pending = u"Waiting to start"
+        job_running = u"%i/%i messages sent"
+        job_completed = u"Done: %i messages sent"
+        job_canceled = u"Canceled: %i messages sent"
+        job_failed = u"Failed: %i messages sent"
+
         welcome_message_subject = u"Welcome"
 
         account_disabled = u"This account is disabled"
@@ -378,6 +433,13 @@ class Lang:
         field_disabled_users_num = u"Le nombre de comptes désactivés"
         field_online_users_num = u"Le nombre de comptes connectés"
 
+        command_user_stats = u"Récupérer les statistiques utilisateur"
+        command_user_stats_1_description = \
+            u"Remplir ce formulaire avec le Jabber ID utilisateur pour " \
+            u"récupérer ses statistiques (ou le laisser vide pour les " \
+            u"statistiques de tous les comptes)"
+        field_roster_size = u"Le nombre d'éléments de la liste de contacts"
+
         field_max_items = u"Maximum d'éléments à récupérer"
         field_registered_users_list = u"La liste des comptes enregistrés"
         field_disabled_users_list = u"La liste des comptes désactivés"
@@ -431,6 +493,12 @@ class Lang:
         field_240_sec = u"240 secondes"
         field_300_sec = u"300 secondes"
 
+        job_pending = u"En attente de démarrage"
+        job_running = u"%i/%i messages envoyés"
+        job_completed = u"Terminé : %i messages envoyés"
+        job_canceled = u"Annulé : %i messages envoyés"
+        job_failed = u"Échec : %i messages envoyés"
+
         welcome_message_subject = u"Bienvenue"
 
         account_disabled = u"Ce compte est désactivé"
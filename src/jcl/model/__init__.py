@@ -1,31 +1,553 @@
 """Contains data model classes"""
 __revision__ = ""
 
+import logging
+import threading
+import time
+
 from sqlobject.dbconnection import ConnectionHub
-from sqlobject.dbconnection import connectionForURI
+from sqlobject.dbconnection import TheURIOpener
+from sqlobject.dbconnection import Transaction
 
 import jcl.model
 
 db_connection_str = ""
 
+# Connection pool parameters (see [db] section of jcl.conf)
+db_pool_min_size = 1
+db_pool_max_size = 10
+db_pool_idle_timeout = 300
+db_pool_checkout_timeout = 30
+
+# (name, value) pragmas run on each new SQLite connection (see [db] section
+# of jcl.conf)
+db_sqlite_pragmas = []
+
 # create a hub to attach a per thread connection
 hub = ConnectionHub()
 
+# current connection pool, (re)created by get_connection_pool
+pool = None
+pool_lock = threading.Lock()
+
+# in memory registry of users and accounts, None if disabled
+# (see jcl.model.registry)
+account_registry = None
+
+# buffer of pending Account column values, None if disabled
+# (see jcl.model.writebehind)
+write_behind = None
+
+# counters of registered, disabled and online accounts, None if disabled
+# (see jcl.model.counters)
+account_counters = None
+
+# per thread number of db_connect calls not disconnected
+thread_connections = threading.local()
+
+# per thread unit of work (see begin_transaction)
+units_of_work = threading.local()
+
+# per thread stack of request contexts (see jcl.model.context)
+request_contexts = threading.local()
+
+class ConnectionPoolTimeout(Exception):
+    """Raised when no connection is available before checkout timeout"""
+    pass
+
+class ConnectionPool(object):
+    """
+    Bounded pool of the DB-API connections of a single SQLObject
+    connection. Each query, select iteration and transaction run through
+    this SQLObject connection takes a DB-API connection from the pool and
+    gives it back when done, waiting while max_size connections are used
+    by other threads. A thread already holding a connection (a query run
+    while iterating over a select for instance) never waits for another
+    one, connections created beyond max_size this way are closed when
+    checked in.
+    """
+
+    def __init__(self, db_connection_str, min_size=1, max_size=10,
+                 idle_timeout=300, checkout_timeout=30):
+        """ConnectionPool constructor"""
+        self.__logger = logging.getLogger("jcl.model.ConnectionPool")
+        self.db_connection_str = db_connection_str
+        self.min_size = max(min_size, 0)
+        self.max_size = max(max_size, self.min_size, 1)
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.condition = threading.Condition()
+        # idle DB-API connections: list of (connection, checkin time), most
+        # recently checked in last
+        self.idle = []
+        # checked out DB-API connections: id(connection) ->
+        # (connection, thread)
+        self.used = {}
+        # number of DB-API connections checked out by each thread
+        self.thread_counts = {}
+        # last DB-API connection used by a thread, reused first when idle
+        self.last_used = {}
+        self.size = 0
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.high_water_mark = 0
+        self.reaped = 0
+        self.last_reap = time.time()
+        # SQLObject connection attached to threads by db_connect
+        self.connection = self.create_connection()
+        if getattr(self.connection, "_memory", False):
+            # every DB-API connection of an in memory SQLite database is
+            # the same one, SQLObject manages it
+            return
+        for i in xrange(self.min_size):
+            self.idle.append((self.make_connection(), time.time()))
+            self.size += 1
+
+    def create_connection(self):
+        """
+        Create a SQLObject connection (not shared through SQLObject URI
+        cache) taking its DB-API connections from the pool.
+        """
+        scheme = self.db_connection_str.split(":", 1)[0]
+        connection_class = TheURIOpener.dbConnectionForScheme(scheme)
+        connection = connection_class.connectionFromURI(self.db_connection_str)
+        if connection.dbName == "sqlite":
+            if jcl.model.db_sqlite_pragmas:
+                set_sqlite_pragmas(connection, jcl.model.db_sqlite_pragmas)
+            # a pooled connection is used by one thread at a time but not
+            # always by the thread which opened it
+            if connection._memory:
+                return connection
+            connection._connOptions["check_same_thread"] = False
+        def release_connection(raw_connection, explicit=False):
+            try:
+                # statements run outside of a transaction are committed or
+                # rolled back as SQLObject does when it pools connections
+                if connection.supportTransactions and not explicit:
+                    if connection.autoCommit:
+                        if not getattr(raw_connection, "autocommit", False):
+                            raw_connection.commit()
+                    else:
+                        raw_connection.rollback()
+            finally:
+                self.checkin(raw_connection)
+        connection.getConnection = self.checkout
+        connection.releaseConnection = release_connection
+        return connection
+
+    def make_connection(self):
+        """Open a new DB-API connection"""
+        raw_connection = self.connection.makeConnection()
+        # numbering used by SQLObject debug output
+        self.connection._connectionNumbers[id(raw_connection)] = \
+            self.connection._connectionCount
+        self.connection._connectionCount += 1
+        return raw_connection
+
+    def close_connection(self, raw_connection):
+        """Close given DB-API connection, ignoring errors"""
+        try:
+            raw_connection.close()
+        except Exception:
+            self.__logger.debug("Error while closing connection",
+                                exc_info=True)
+
+    def __reclaim_dead_threads(self):
+        """Give back connections of threads that did not check them in"""
+        for (key, (raw_connection, thread)) in self.used.items():
+            if not thread.isAlive():
+                del self.used[key]
+                del self.thread_counts[thread]
+                try:
+                    raw_connection.rollback()
+                except Exception:
+                    self.close_connection(raw_connection)
+                    self.size -= 1
+                    continue
+                self.idle.append((raw_connection, time.time()))
+                self.__logger.debug("Connection reclaimed from dead thread "
+                                    + thread.getName())
+        for thread in self.last_used.keys():
+            if not thread.isAlive():
+                del self.last_used[thread]
+
+    def __take_idle_connection(self, thread):
+        """Return an idle connection, the one last used by `thread` first"""
+        last_connection = self.last_used.get(thread)
+        for i in xrange(len(self.idle) - 1, -1, -1):
+            if self.idle[i][0] is last_connection:
+                return self.idle.pop(i)[0]
+        return self.idle.pop()[0]
+
+    def checkout(self):
+        """
+        Return a DB-API connection, taking an idle one or creating a new
+        one if needed. Wait for a connection to be checked in if the pool
+        is exhausted and the current thread does not hold any connection.
+        """
+        thread = threading.currentThread()
+        self.condition.acquire()
+        try:
+            start = None
+            while True:
+                if not self.idle and self.size >= self.max_size:
+                    self.__reclaim_dead_threads()
+                if self.idle:
+                    raw_connection = self.__take_idle_connection(thread)
+                    break
+                if self.size < self.max_size \
+                        or self.thread_counts.get(thread, 0) > 0:
+                    raw_connection = self.make_connection()
+                    self.size += 1
+                    break
+                now = time.time()
+                if start is None:
+                    start = now
+                    self.waits += 1
+                elif self.checkout_timeout is not None \
+                        and now - start >= self.checkout_timeout:
+                    self.__record_wait(now - start)
+                    raise ConnectionPoolTimeout()
+                if self.checkout_timeout is not None:
+                    self.condition.wait(self.checkout_timeout - (now - start))
+                else:
+                    self.condition.wait()
+            if start is not None:
+                self.__record_wait(time.time() - start)
+            self.used[id(raw_connection)] = (raw_connection, thread)
+            self.thread_counts[thread] = self.thread_counts.get(thread, 0) + 1
+            self.last_used[thread] = raw_connection
+            self.checkouts += 1
+            self.high_water_mark = max(self.high_water_mark, len(self.used))
+            return raw_connection
+        finally:
+            self.condition.release()
+
+    def __record_wait(self, wait_time):
+        """Update wait statistics"""
+        self.wait_time += wait_time
+        self.max_wait_time = max(self.max_wait_time, wait_time)
+
+    def checkin(self, raw_connection):
+        """Give `raw_connection` DB-API connection back to the pool"""
+        self.condition.acquire()
+        try:
+            entry = self.used.pop(id(raw_connection), None)
+            if entry is None:
+                return
+            thread = entry[1]
+            self.thread_counts[thread] -= 1
+            if self.thread_counts[thread] <= 0:
+                del self.thread_counts[thread]
+            if self.size > self.max_size:
+                self.close_connection(raw_connection)
+                self.size -= 1
+            else:
+                self.idle.append((raw_connection, time.time()))
+            self.condition.notify()
+            if self.idle_timeout is not None \
+                    and time.time() - self.last_reap >= self.idle_timeout:
+                self.reap()
+        finally:
+            self.condition.release()
+
+    def reap(self):
+        """
+        Close connections idle for more than idle_timeout, keeping at least
+        min_size connections in the pool. Connections checked out are never
+        closed.
+        """
+        self.condition.acquire()
+        try:
+            now = time.time()
+            self.last_reap = now
+            self.__reclaim_dead_threads()
+            kept_idle = []
+            # oldest checked in connections are reaped first
+            for (raw_connection, checkin_time) in self.idle:
+                if self.size > self.min_size \
+                        and self.idle_timeout is not None \
+                        and now - checkin_time >= self.idle_timeout:
+                    self.close_connection(raw_connection)
+                    self.size -= 1
+                    self.reaped += 1
+                else:
+                    kept_idle.append((raw_connection, checkin_time))
+            self.idle = kept_idle
+        finally:
+            self.condition.release()
+
+    def close(self):
+        """Close every connection of the pool"""
+        self.condition.acquire()
+        try:
+            for (raw_connection, checkin_time) in self.idle:
+                self.close_connection(raw_connection)
+            for (raw_connection, thread) in self.used.values():
+                self.close_connection(raw_connection)
+            self.idle = []
+            self.used = {}
+            self.thread_counts = {}
+            self.last_used = {}
+            self.size = 0
+            self.condition.notifyAll()
+        finally:
+            self.condition.release()
+
+    def get_stats(self):
+        """Return pool statistics as a dictionary"""
+        self.condition.acquire()
+        try:
+            return {"size": self.size,
+                    "idle": len(self.idle),
+                    "in_use": len(self.used),
+                    "checkouts": self.checkouts,
+                    "waits": self.waits,
+                    "wait_time": self.wait_time,
+                    "max_wait_time": self.max_wait_time,
+                    "high_water_mark": self.high_water_mark,
+                    "reaped": self.reaped}
+        finally:
+            self.condition.release()
+
+def set_sqlite_pragmas(connection, pragmas):
+    """
+    Run (name, value) `pragmas` on every low level connection opened by
+    SQLite `connection`.
+    """
+    make_connection = connection.makeConnection
+    def make_connection_with_pragmas():
+        raw_connection = make_connection()
+        cursor = raw_connection.cursor()
+        try:
+            for (name, value) in pragmas:
+                cursor.execute("PRAGMA " + name + " = " + str(value))
+        finally:
+            cursor.close()
+        return raw_connection
+    connection.makeConnection = make_connection_with_pragmas
+
+class PreparedQuery(object):
+    """
+    SQL query built once per DB-API parameter style and run with
+    parameters, so the database module reuses its prepared statement
+    (pysqlite caches prepared statements by query text).
+    """
+
+    markers = {"qmark": "?", "format": "%s", "pyformat": "%s"}
+
+    def __init__(self, build_func):
+        """
+        PreparedQuery constructor. `build_func` returns the query given
+        the parameter marker to use.
+        """
+        self.build_func = build_func
+        # parameter style -> query
+        self.queries = {}
+
+    def get_query(self, connection):
+        """Return the query for the parameter style of `connection`"""
+        paramstyle = connection.module.paramstyle
+        query = self.queries.get(paramstyle)
+        if query is None:
+            query = self.build_func(PreparedQuery.markers[paramstyle])
+            self.queries[paramstyle] = query
+        return query
+
+    def query_all(self, params):
+        """Run the query with `params` and return every row"""
+        db_connect()
+        try:
+            connection = jcl.model.hub.getConnection()
+            query = self.get_query(connection)
+            def execute(raw_connection):
+                cursor = raw_connection.cursor()
+                try:
+                    cursor.execute(query, params)
+                    return cursor.fetchall()
+                finally:
+                    cursor.close()
+            if isinstance(connection, Transaction):
+                # run on the transaction connection in a unit of work
+                connection.assertActive()
+                return execute(connection._connection)
+            return connection._runWithConnection(execute)
+        finally:
+            db_disconnect()
+
+def get_connection_pool():
+    """
+    Return the connection pool for the current db_connection_str,
+    creating it if needed.
+    """
+    jcl.model.pool_lock.acquire()
+    try:
+        if jcl.model.pool is None \
+                or jcl.model.pool.db_connection_str != db_connection_str:
+            if jcl.model.pool is not None:
+                jcl.model.pool.close()
+            jcl.model.pool = ConnectionPool(db_connection_str,
+                                            db_pool_min_size,
+                                            db_pool_max_size,
+                                            db_pool_idle_timeout,
+                                            db_pool_checkout_timeout)
+            # objects fetched by a thread stay usable after db_disconnect
+            # through the pool
+            jcl.model.hub.processConnection = jcl.model.pool.connection
+        return jcl.model.pool
+    finally:
+        jcl.model.pool_lock.release()
+
 def db_connect():
     """
-    Create a new connection to the DataBase (SQLObject use connection
-    pool) associated to the current thread.
+    Associate the connection of the pool to the current thread. Each
+    statement takes a DB-API connection from the pool, waiting for one if
+    the pool is exhausted.
     """
-    #if not jcl.model.db_connected:
-    jcl.model.hub.threadConnection = connectionForURI(db_connection_str)
+    connection = get_connection_pool().connection
+    jcl.model.thread_connections.depth = \
+        getattr(jcl.model.thread_connections, "depth", 0) + 1
+    unit_of_work = get_unit_of_work()
+    if unit_of_work is not None:
+        # statements of a unit of work go through its transaction
+        connection = unit_of_work.transaction
+    jcl.model.hub.threadConnection = connection
     #        account.hub.threadConnection.debug = True
-    #jcl.model.db_connected = True
 
 def db_disconnect():
     """
-    Delete connection associated to the current thread.
+    Release connection associated to the current thread. The connection
+    is detached from the thread when every db_connect call has been
+    released, already fetched objects and lazy select results then go
+    through the connection of the process, which takes its DB-API
+    connections from the same pool.
     """
-    pass
-    #if jcl.model.db_connected:
-    #del jcl.model.hub.threadConnection
-    #jcl.model.db_connected = False
+    depth = getattr(jcl.model.thread_connections, "depth", 0)
+    if depth <= 0:
+        return
+    jcl.model.thread_connections.depth = depth - 1
+    if depth == 1:
+        try:
+            del jcl.model.hub.threadConnection
+        except AttributeError:
+            pass
+
+def db_close():
+    """
+    Close every connection of the pool.
+    """
+    jcl.model.pool_lock.acquire()
+    try:
+        if jcl.model.pool is not None:
+            jcl.model.pool.close()
+            jcl.model.pool = None
+            try:
+                del jcl.model.hub.processConnection
+            except AttributeError:
+                pass
+    finally:
+        jcl.model.pool_lock.release()
+
+class UnitOfWork(object):
+    """Transaction shared by nested begin_transaction calls of a thread"""
+
+    def __init__(self, connection):
+        """UnitOfWork constructor"""
+        self.connection = connection
+        self.transaction = connection.transaction()
+        # number of begin_transaction calls not ended
+        self.depth = 0
+        self.rollback_only = False
+
+def get_unit_of_work():
+    """Return the unit of work of the current thread, None if none"""
+    return getattr(jcl.model.units_of_work, "current", None)
+
+def begin_transaction():
+    """
+    Start a unit of work: statements of the current thread are run in a
+    single transaction until the matching end_transaction call. Nested
+    calls join the current unit of work.
+    """
+    db_connect()
+    unit_of_work = get_unit_of_work()
+    if unit_of_work is None:
+        try:
+            unit_of_work = UnitOfWork(jcl.model.hub.threadConnection)
+        except:
+            db_disconnect()
+            raise
+        jcl.model.units_of_work.current = unit_of_work
+        jcl.model.hub.threadConnection = unit_of_work.transaction
+    unit_of_work.depth += 1
+
+def end_transaction(commit=True):
+    """
+    End a unit of work started with begin_transaction. The transaction is
+    committed when the outermost call ends, unless one of the calls asked
+    for a rollback (`commit` set to False).
+    """
+    unit_of_work = get_unit_of_work()
+    if unit_of_work is None:
+        return
+    unit_of_work.depth -= 1
+    if not commit:
+        unit_of_work.rollback_only = True
+    if unit_of_work.depth > 0:
+        db_disconnect()
+        return
+    jcl.model.units_of_work.current = None
+    jcl.model.hub.threadConnection = unit_of_work.connection
+    try:
+        try:
+            if unit_of_work.rollback_only:
+                unit_of_work.transaction.rollback()
+                # cached objects may hold rolled back values
+                from jcl.model import account
+                account.expire_all()
+            else:
+                unit_of_work.transaction.commit(close=True)
+        finally:
+            # give the DB-API connection of the transaction back to its
+            # SQLObject connection pool
+            if not unit_of_work.transaction._obsolete:
+                unit_of_work.transaction._makeObsolete()
+    finally:
+        db_disconnect()
+
+def transactional(func):
+    """
+    Decorator running `func` in a unit of work: it is committed when `func`
+    returns and rolled back when it raises an exception.
+    """
+    def transactional_func(*args, **kwargs):
+        begin_transaction()
+        try:
+            result = func(*args, **kwargs)
+        except:
+            end_transaction(False)
+            raise
+        end_transaction()
+        return result
+    transactional_func.__name__ = func.__name__
+    transactional_func.__doc__ = func.__doc__
+    return transactional_func
+
+def get_request_contexts():
+    """Return the stack of request contexts of the current thread"""
+    if not hasattr(jcl.model.request_contexts, "stack"):
+        jcl.model.request_contexts.stack = []
+    return jcl.model.request_contexts.stack
+
+def get_request_context(bare_jid):
+    """
+    Return the current request context of the thread if it is the one of
+    `bare_jid` user, None otherwise (see jcl.model.context).
+    """
+    contexts = getattr(jcl.model.request_contexts, "stack", None)
+    if contexts and bare_jid is not None \
+            and contexts[-1].bare_jid == unicode(bare_jid):
+        return contexts[-1]
+    return None
@@ -33,7 +33,7 @@ import exceptions
 from sqlobject.inheritance import InheritableSQLObject
 from sqlobject.col import StringCol, IntCol, BoolCol, ForeignKey, DateTimeCol
 from sqlobject.joins import MultipleJoin
-from sqlobject.sqlbuilder import AND
+from sqlobject.sqlbuilder import AND, OR, IN, NOT, DESC, Select, Update
 
 from jcl.lang import Lang
 from jcl.error import FieldError, MandatoryFieldError
@@ -87,6 +87,75 @@ def no_whitespace_field(field_name, field_value):
         raise FieldError(field_name, message_property="no_whitespace_in_field")
     return field_value
 
+class RegisterField(object):
+    """Register field of an account class (see Account.get_register_fields)"""
+
+    def __init__(self, name, field_type, options, post_func, default_func):
+        """RegisterField constructor"""
+        self.name = name
+        self.type = field_type
+        if options is not None:
+            options = tuple(options)
+        self.options = options
+        self.post_func = post_func
+        self.default_func = default_func
+
+    def get_default(self, bare_from_jid):
+        """Return field default value for `bare_from_jid` user"""
+        return self.default_func(bare_from_jid)
+
+    def process(self, value, bare_from_jid):
+        """Return received `value` checked and converted by post_func"""
+        return self.post_func(value, self.default_func, bare_from_jid)
+
+    def is_required(self, bare_from_jid):
+        """Return True if `bare_from_jid` user must give a value: post_func
+        rejects an empty value"""
+        try:
+            self.process(None, bare_from_jid)
+        except:
+            return True
+        return False
+
+class RegisterSchema(object):
+    """
+    Register fields of an account class, built once from its
+    get_register_fields tuples (see Account.get_register_schema).
+    """
+
+    def __init__(self, register_fields):
+        """RegisterSchema constructor"""
+        # tuples with a None field name are page separators (not supported
+        # yet)
+        self.fields = tuple([RegisterField(*register_field)
+                             for register_field in register_fields
+                             if register_field[0] is not None])
+        self.fields_by_name = {}
+        for field in self.fields:
+            self.fields_by_name[field.name] = field
+
+    def get_field(self, name):
+        """Return `name` field, None if unknown"""
+        return self.fields_by_name.get(name)
+
+    def process(self, x_data, bare_from_jid):
+        """
+        Return (field name, value) tuples of every field, values being
+        taken from `x_data` form (None if missing) and processed by field
+        post functions. FieldError raised by post functions are not caught.
+        """
+        result = []
+        for field in self.fields:
+            if field.name in x_data:
+                value = x_data[field.name].value
+            else:
+                value = None
+            result.append((field.name, field.process(value, bare_from_jid)))
+        return result
+
+# account class -> RegisterSchema
+register_schemas = {}
+
 class User(InheritableSQLObject):
     class sqlmeta:
         table = "user_table"
@@ -97,20 +166,66 @@ class User(InheritableSQLObject):
     has_received_motd = BoolCol(default=False)
     accounts = MultipleJoin("Account")
 
+    def _create(self, id, **kw):
+        InheritableSQLObject._create(self, id, **kw)
+        invalidate_registry(self.jid)
+
+    def _set_jid(self, jid):
+        if not self.sqlmeta._creating:
+            invalidate_registry(self.jid)
+        self._SO_set_jid(jid)
+        invalidate_registry(jid)
+
+    def destroySelf(self):
+        invalidate_registry(self.jid)
+        InheritableSQLObject.destroySelf(self)
+
+def invalidate_registry(bare_jid):
+    """
+    Drop `bare_jid` user objects from the account registry if enabled
+    (see jcl.model.registry) and from the current request context (see
+    jcl.model.context)
+    """
+    if bare_jid is None:
+        return
+    if model.account_registry is not None:
+        model.account_registry.invalidate(unicode(bare_jid))
+    context = model.get_request_context(bare_jid)
+    if context is not None:
+        context.invalidate()
+
+def is_cached():
+    """Return True if user objects are cached by the account registry or
+    by a request context"""
+    return model.account_registry is not None \
+        or len(model.get_request_contexts()) > 0
+
 def get_user(bare_from_jid, user_class=User):
-    result = None
+    context = model.get_request_context(bare_from_jid)
+    if context is not None:
+        return context.get_user(user_class)
     model.db_connect()
-    users = user_class.select(User.q.jid == bare_from_jid)
-    if users.count() > 0:
-        result = users[0]
-    return result
+    try:
+        if model.account_registry is not None:
+            return model.account_registry.get_user(unicode(bare_from_jid),
+                                                   user_class)
+        for user in _get_objects(User, user_query.query_all(\
+                (unicode(bare_from_jid),))):
+            if isinstance(user, user_class):
+                return user
+        return None
+    finally:
+        model.db_disconnect()
 
 def get_all_users(user_class=User, limit=None, filter=None,
                   distinct=False):
     model.db_connect()
-    users = user_class.select(clause=filter, limit=limit,
-                              distinct=distinct)
-    return users
+    try:
+        users = user_class.select(clause=filter, limit=limit,
+                                  distinct=distinct)
+        return users
+    finally:
+        model.db_disconnect()
 
 class Account(InheritableSQLObject):
     """Base Account class"""
@@ -140,16 +255,18 @@ class Account(InheritableSQLObject):
 
     long_name = property(get_long_name)
 
-    def get_status_msg(self, lang_class=Lang.en):
-        """Return current status"""
+    def get_status_msg(self, lang_class=Lang.en, status=None):
+        """Return current status message, or the one of `status`"""
+        if status is None:
+            status = self.status
         mapping = {"online": self.get_online_status_msg,
                    "chat": self.get_chat_status_msg,
                    "away": self.get_away_status_msg,
                    "xa": self.get_xa_status_msg,
                    "dnd": self.get_dnd_status_msg,
                    "offline": self.get_offline_status_msg}
-        if mapping.has_key(self.status):
-            return mapping[self.status](lang_class)
+        if mapping.has_key(status):
+            return mapping[status](lang_class)
         return self.name
 
     status_msg = property(get_status_msg)
@@ -215,6 +332,17 @@ class Account(InheritableSQLObject):
 
     get_register_fields = classmethod(_get_register_fields)
 
+    def _get_register_schema(cls):
+        """Return RegisterSchema of the class, built on first call from
+        get_register_fields"""
+        schema = register_schemas.get(cls)
+        if schema is None:
+            schema = RegisterSchema(cls.get_register_fields())
+            register_schemas[cls] = schema
+        return schema
+
+    get_register_schema = classmethod(_get_register_schema)
+
     def get_new_message_subject(self, lang_class):
         """Get localized message subject for new account"""
         return lang_class.new_account_message_subject % (self.name)
@@ -231,22 +359,126 @@ class Account(InheritableSQLObject):
         """Return localized message body for existing account"""
         return lang_class.update_account_message_body
 
+    def _get__status(self):
+        if model.write_behind is not None:
+            return model.write_behind.get(self, "_status",
+                                          self._SO_get__status)
+        return self._SO_get__status()
+
+    def _set__status(self, status):
+        if model.account_counters is not None \
+                and not self.sqlmeta._creating:
+            model.account_counters.status_changed(self._status, status)
+        if model.write_behind is None or self.sqlmeta._creating:
+            self._SO_set__status(status)
+        else:
+            model.write_behind.set(self, "_status", status)
+
+    def _get_lastlogin(self):
+        if model.write_behind is not None:
+            return model.write_behind.get(self, "lastlogin",
+                                          self._SO_get_lastlogin)
+        return self._SO_get_lastlogin()
+
+    def _set_lastlogin(self, lastlogin):
+        if model.write_behind is None or self.sqlmeta._creating:
+            self._SO_set_lastlogin(lastlogin)
+        else:
+            model.write_behind.set(self, "lastlogin", lastlogin)
+
+    def _get_error(self):
+        if model.write_behind is not None:
+            return model.write_behind.get(self, "error", self._SO_get_error)
+        return self._SO_get_error()
+
+    def _set_error(self, error):
+        if model.write_behind is None or self.sqlmeta._creating:
+            self._SO_set_error(error)
+        else:
+            model.write_behind.set(self, "error", error)
+
+    def expire(self):
+        """Drop cached column values, including the ones of parent rows"""
+        InheritableSQLObject.expire(self)
+        parent = getattr(self, "_parent", None)
+        if parent is not None:
+            parent.expire()
+
+    def _invalidate_registry(self):
+        """Drop account user objects from the account registry"""
+        if is_cached() and self.user is not None:
+            invalidate_registry(self.user.jid)
+
+    def _create(self, id, **kw):
+        InheritableSQLObject._create(self, id, **kw)
+        self._invalidate_registry()
+        # rows of parent classes are created with the child row, only the
+        # most derived one is counted
+        if model.account_counters is not None and self.childName is None:
+            model.account_counters.account_created(self.enabled, self._status)
+
+    def _set_enabled(self, enabled):
+        if model.account_counters is not None \
+                and not self.sqlmeta._creating:
+            model.account_counters.enabled_changed(self.enabled, enabled)
+        self._SO_set_enabled(enabled)
+
+    def _set_name(self, name):
+        self._SO_set_name(name)
+        if not self.sqlmeta._creating:
+            self._invalidate_registry()
+
+    def _set_userID(self, user_id):
+        if not self.sqlmeta._creating:
+            self._invalidate_registry()
+        self._SO_set_userID(user_id)
+        if not self.sqlmeta._creating:
+            self._invalidate_registry()
+
+    def destroySelf(self):
+        self._invalidate_registry()
+        if model.account_counters is not None and self.childName is None:
+            model.account_counters.account_destroyed(self.enabled,
+                                                     self._status)
+        if model.write_behind is not None:
+            model.write_behind.discard(self)
+        InheritableSQLObject.destroySelf(self)
+
 def get_account_filter(filter, account_class=Account):
     result = None
     model.db_connect()
-    accounts = account_class.select(filter)
-    if accounts.count() > 0:
-        result = accounts[0]
-    model.db_disconnect()
+    try:
+        accounts = account_class.select(filter)
+        if accounts.count() > 0:
+            result = accounts[0]
+    finally:
+        model.db_disconnect()
     return result
 
 def get_account(bare_user_jid, name, account_class=Account):
-    real_filter = AND(AND(Account.q.name == name,
-                          Account.q.userID == User.q.id),
-                      User.q.jid == unicode(bare_user_jid))
-    return get_account_filter(real_filter, account_class)
+    context = model.get_request_context(bare_user_jid)
+    if context is not None:
+        return context.get_account(name, account_class)
+    if model.account_registry is not None:
+        return model.account_registry.get_account(unicode(bare_user_jid),
+                                                  name, account_class)
+    for _account in _get_objects(Account, account_query.query_all(\
+            (unicode(bare_user_jid), name))):
+        if isinstance(_account, account_class):
+            return _account
+    return None
 
 def get_accounts(bare_user_jid, account_class=Account, filter=None):
+    """
+    Return the list of `bare_user_jid` accounts of class `account_class`
+    (matching `filter`) ordered by id
+    """
+    context = model.get_request_context(bare_user_jid)
+    if context is not None and filter is None:
+        return context.get_accounts(account_class)
+    if model.account_registry is not None and filter is None:
+        return model.account_registry.get_accounts(unicode(bare_user_jid),
+                                                   account_class)
     if filter is not None:
         filter = AND(AND(Account.q.userID == User.q.id,
                          User.q.jid == unicode(bare_user_jid)),
@@ -254,29 +486,380 @@ def get_accounts(bare_user_jid, account_class=Account, filter=None):
     else:
         filter = AND(Account.q.userID == User.q.id,
                      User.q.jid == unicode(bare_user_jid))
-    accounts = account_class.select(filter)
+    model.db_connect()
+    try:
+        accounts = list(account_class.select(filter, orderBy=Account.q.id))
+    finally:
+        model.db_disconnect()
     return accounts
 
+def _get_user_id(_account):
+    """
+    Return `_account` user id. Subclasses do not expose userID, it is read
+    from the Account row loaded with the account.
+    """
+    while _account.sqlmeta.parentClass is not None:
+        _account = _account._parent
+    return _account.userID
+
+def get_accounts_for_users(bare_user_jids, account_classes=(Account,),
+                           filter=None, chunk_size=500):
+    """
+    Return a dictionary associating each class of `account_classes` to the
+    list of (user JID, account) of `bare_user_jids` users, ordered as
+    `bare_user_jids` then by account id. Users and their accounts of each
+    class are read with one query per `chunk_size` users (IN clause)
+    instead of one query per user.
+    """
+    user_jids = []
+    user_indexes = {}
+    for user_jid in bare_user_jids:
+        user_jid = unicode(user_jid)
+        if not user_indexes.has_key(user_jid):
+            user_indexes[user_jid] = len(user_jids)
+            user_jids.append(user_jid)
+    result = {}
+    if model.account_registry is not None and filter is None:
+        for account_class in account_classes:
+            result[account_class] = \
+                [(bare_jid, _account) for bare_jid in user_jids
+                 for _account in model.account_registry.get_accounts(\
+                        bare_jid, account_class)]
+        return result
+    model.db_connect()
+    try:
+        user_id_chunks = []
+        users_jid = {}
+        for index in range(0, len(user_jids), chunk_size):
+            user_ids = []
+            for user in User.select(IN(User.q.jid,
+                                       user_jids[index:index + chunk_size])):
+                users_jid[user.id] = user.jid
+                user_ids.append(user.id)
+            if user_ids:
+                user_id_chunks.append(user_ids)
+        for account_class in account_classes:
+            accounts = []
+            for user_ids in user_id_chunks:
+                clause = IN(Account.q.userID, user_ids)
+                if filter is not None:
+                    clause = AND(clause, filter)
+                # userID does not fetch the user, its JID is already known
+                accounts.extend([(users_jid[_get_user_id(_account)], _account)
+                                 for _account in account_class.select(clause)])
+            accounts.sort(key=lambda (user_jid, _account): \
+                              (user_indexes[user_jid], _account.id))
+            result[account_class] = accounts
+    finally:
+        model.db_disconnect()
+    return result
+
 def get_all_accounts(account_class=Account, filter=None, limit=None):
     model.db_connect()
-    accounts = account_class.select(clause=filter, limit=limit)
-    return accounts
+    try:
+        accounts = account_class.select(clause=filter, limit=limit)
+        return accounts
+    finally:
+        model.db_disconnect()
 
 def get_accounts_count(bare_user_jid, account_class=Account):
+    context = model.get_request_context(bare_user_jid)
+    if context is not None:
+        return len(context.get_accounts(account_class))
+    if account_class is Account:
+        return accounts_count_query.query_all((unicode(bare_user_jid),))[0][0]
     model.db_connect()
-    accounts_count = account_class.select(\
-        AND(Account.q.userID == User.q.id,
-            User.q.jid == unicode(bare_user_jid))).count()
+    try:
+        accounts_count = account_class.select(\
+            AND(Account.q.userID == User.q.id,
+                User.q.jid == unicode(bare_user_jid))).count()
+    finally:
+        model.db_disconnect()
     return accounts_count
 
 def get_all_accounts_count(account_class=Account, filter=None):
     model.db_connect()
-    if filter is None:
-        accounts_count = account_class.select().count()
-    else:
-        accounts_count = account_class.select(filter).count()
+    try:
+        if filter is None:
+            accounts_count = account_class.select().count()
+        else:
+            accounts_count = account_class.select(filter).count()
+    finally:
+        model.db_disconnect()
     return accounts_count
 
+def get_registered_accounts_count():
+    """Return the number of accounts, from account counters if enabled"""
+    if model.account_counters is not None:
+        return model.account_counters.get("registered")
+    return get_all_accounts_count()
+
+def get_disabled_accounts_count():
+    """Return the number of disabled accounts, from account counters if
+    enabled"""
+    if model.account_counters is not None:
+        return model.account_counters.get("disabled")
+    return get_all_accounts_count(filter=(Account.q.enabled == False))
+
+def get_online_accounts_count():
+    """Return the number of accounts not OFFLINE, from account counters if
+    enabled"""
+    if model.account_counters is not None:
+        return model.account_counters.get("online")
+    return get_all_accounts_count(filter=(Account.q._status != OFFLINE))
+
+def query_rows(select, limit=None):
+    """
+    Return every row of `select` (a sqlbuilder expression), at most `limit`
+    rows if given.
+    """
+    model.db_connect()
+    try:
+        connection = model.hub.getConnection()
+        query = connection.sqlrepr(select)
+        if limit is not None:
+            query += " LIMIT %i" % (limit)
+        return connection.queryAll(query)
+    finally:
+        model.db_disconnect()
+
+def iter_query(items, key, where=None, chunk_size=1000):
+    """
+    Yield rows of `items` columns matching `where` ordered by `key` column
+    (sqlbuilder expressions) without loading them all. Each chunk of
+    `chunk_size` rows is read by its own query starting after the last key
+    of the previous chunk, and the connection is checked in before its rows
+    are yielded, so the consumer may block between rows.
+    """
+    last_key = None
+    while True:
+        chunk_where = where
+        if last_key is not None:
+            if where is None:
+                chunk_where = key > last_key
+            else:
+                chunk_where = AND(where, key > last_key)
+        if chunk_where is None:
+            select = Select([key] + items, orderBy=key)
+        else:
+            select = Select([key] + items, where=chunk_where, orderBy=key)
+        rows = query_rows(select, chunk_size)
+        for row in rows:
+            yield tuple(row[1:])
+        if len(rows) < chunk_size:
+            return
+        last_key = rows[-1][0]
+
+def get_all_users_jid(chunk_size=1000):
+    """Yield JID of every user"""
+    for (jid,) in iter_query([User.q.jid], User.q.id,
+                             chunk_size=chunk_size):
+        yield jid
+
+class AccountPresenceInfo(object):
+    """
+    Account columns needed to send its presence, read without building the
+    Account object. Other attributes are read from the Account object,
+    loaded on first access. Values set on it are not stored.
+    """
+
+    def __init__(self, account_id, jid, name, user_jid, status, error,
+                 enabled):
+        """AccountPresenceInfo constructor"""
+        self._account = None
+        self.id = account_id
+        self.jid = jid
+        self.name = name
+        self.user_jid = user_jid
+        self.status = status
+        self.error = error
+        self.enabled = bool(enabled)
+
+    def get_account(self):
+        """Return the Account object of this row"""
+        if self._account is None:
+            model.db_connect()
+            try:
+                self._account = Account.get(self.id)
+            finally:
+                model.db_disconnect()
+        return self._account
+
+    def __getattr__(self, name):
+        return getattr(self.get_account(), name)
+
+def get_all_accounts_presence_info(chunk_size=1000):
+    """
+    Yield an AccountPresenceInfo for every account, read by chunks with a
+    single query joining account and user tables.
+    """
+    for row in iter_query([Account.q.id, Account.q.jid, Account.q.name,
+                           User.q.jid, Account.q._status, Account.q.error,
+                           Account.q.enabled],
+                          Account.q.id,
+                          where=Account.q.userID == User.q.id,
+                          chunk_size=chunk_size):
+        yield AccountPresenceInfo(*row)
+
+def _get_class_names(child_names, parent_class=Account):
+    """
+    Return a dict mapping account id to the name of its most derived class
+    given `child_names`, a dict mapping account id to the child name stored
+    in `parent_class` table. Child tables are only read for accounts whose
+    child class is itself inherited.
+    """
+    class_names = {}
+    inherited_ids = {}
+    for (account_id, child_name) in child_names.items():
+        child_class = parent_class.sqlmeta.childClasses.get(child_name)
+        if child_name is None:
+            class_names[account_id] = parent_class.__name__
+        elif child_class is None or not child_class.sqlmeta.childClasses:
+            class_names[account_id] = child_name
+        else:
+            inherited_ids.setdefault(child_class, []).append(account_id)
+    for (child_class, account_ids) in inherited_ids.items():
+        rows = query_rows(Select([child_class.q.id, child_class.q.childName],
+                                 where=IN(child_class.q.id, account_ids)))
+        class_names.update(_get_class_names(dict(rows), child_class))
+    return class_names
+
+def get_accounts_page(filter=None, after=None, before=None, limit=25):
+    """
+    Return (account id, user JID, account name, account class name) of at
+    most `limit` accounts matching `filter` ordered by account id. Only
+    accounts with an id greater than `after` or lower than `before` are
+    returned (keyset pagination): no Account object is built and no row
+    is skipped with OFFSET.
+    """
+    where = Account.q.userID == User.q.id
+    if filter is not None:
+        where = AND(where, filter)
+    if after is not None:
+        where = AND(where, Account.q.id > after)
+    if before is not None:
+        where = AND(where, Account.q.id < before)
+        order_by = DESC(Account.q.id)
+    else:
+        order_by = Account.q.id
+    rows = list(query_rows(Select([Account.q.id, User.q.jid, Account.q.name,
+                                   Account.q.childName],
+                                  where=where, orderBy=order_by),
+                           limit=limit))
+    if before is not None:
+        rows.reverse()
+    class_names = _get_class_names(dict([(row[0], row[3]) for row in rows]))
+    return [(account_id, user_jid, name, class_names[account_id])
+            for (account_id, user_jid, name, child_name) in rows]
+
+def _get_volatile_password_child_names(account_class=Account):
+    """
+    Return child names of `account_class` whose subclasses might have a
+    volatile password to reset when going offline (see Account.set_status)
+    """
+    def has_volatile_password(child_class):
+        if hasattr(child_class, "waiting_password_reply") \
+                and hasattr(child_class, "store_password") \
+                and hasattr(child_class, "password"):
+            return True
+        for grandchild_class in child_class.sqlmeta.childClasses.values():
+            if has_volatile_password(grandchild_class):
+                return True
+        return False
+    return [child_name for (child_name, child_class)
+            in account_class.sqlmeta.childClasses.items()
+            if has_volatile_password(child_class)]
+
+def set_all_accounts_offline():
+    """
+    Set status of every account to OFFLINE. Accounts with a volatile
+    password go through Account.set_status, others are updated with a
+    single UPDATE.
+    """
+    if model.write_behind is not None:
+        # pending statuses must not be written after this update
+        model.write_behind.flush()
+    model.db_connect()
+    try:
+        connection = model.hub.getConnection()
+        child_names = _get_volatile_password_child_names()
+        where = Account.q._status != OFFLINE
+        if child_names:
+            for _account in Account.select(AND(where,
+                                               IN(Account.q.childName,
+                                                  child_names))):
+                _account.status = OFFLINE
+            where = AND(where, OR(Account.q.childName == None,
+                                  NOT(IN(Account.q.childName,
+                                         child_names))))
+        connection.query(connection.sqlrepr(\
+                Update(Account.sqlmeta.table, {"status": OFFLINE},
+                       where=where)))
+        # cached accounts must reload their status
+        Account.sqlmeta.expireAll()
+        if model.account_counters is not None:
+            model.account_counters.invalidate()
+    finally:
+        model.db_disconnect()
+
+def expire_all():
+    """
+    Expire cached users, accounts and legacy JIDs so they are loaded again
+    from the database, and drop account registry and request contexts
+    objects (used when a unit of work is rolled back).
+    """
+    User.sqlmeta.expireAll()
+    Account.sqlmeta.expireAll()
+    LegacyJID.sqlmeta.expireAll()
+    if model.account_registry is not None:
+        model.account_registry.clear()
+    if model.account_counters is not None:
+        model.account_counters.invalidate()
+    for context in model.get_request_contexts():
+        context.invalidate()
+
+def set_accounts_status(accounts_status):
+    """
+    Set status of every (account, status) pair of `accounts_status` with a
+    single UPDATE run in a transaction (or through the write-behind buffer
+    if enabled). As Account.set_status does, lastlogin
+    is updated for accounts leaving the OFFLINE status. Statuses must not be
+    OFFLINE: volatile passwords are not reset here.
+    """
+    if not accounts_status:
+        return
+    if model.write_behind is not None:
+        # written with the other pending values
+        for (_account, status) in accounts_status:
+            _account.status = status
+        return
+    if model.account_counters is not None:
+        for (_account, status) in accounts_status:
+            model.account_counters.status_changed(_account._status, status)
+    model.begin_transaction()
+    try:
+        connection = model.hub.getConnection()
+        ids = [connection.sqlrepr(_account.id)
+               for (_account, status) in accounts_status]
+        status_cases = " ".join(["WHEN " + connection.sqlrepr(_account.id)
+                                 + " THEN " + connection.sqlrepr(status)
+                                 for (_account, status) in accounts_status])
+        connection.query("UPDATE " + Account.sqlmeta.table
+                         + " SET lastlogin = CASE WHEN status = "
+                         + connection.sqlrepr(OFFLINE) + " THEN "
+                         + connection.sqlrepr(datetime.datetime.today())
+                         + " ELSE lastlogin END, status = CASE "
+                         + Account.sqlmeta.idName + " " + status_cases
+                         + " END WHERE " + Account.sqlmeta.idName
+                         + " IN (" + ", ".join(ids) + ")")
+    except:
+        model.end_transaction(False)
+        raise
+    model.end_transaction()
+    # cached accounts must reload their status and lastlogin
+    for (_account, status) in accounts_status:
+        _account.expire()
+
 class PresenceAccount(Account):
     DO_NOTHING = 0
     DO_SOMETHING = 1
@@ -320,7 +903,7 @@ class PresenceAccount(Account):
     def _get_register_fields(cls, real_class = None):
         """ See Account._get_register_fields """
         def get_possibles_actions(presence_action_field):
-            return real_class.get_presence_actions_fields()[presence_action_field][0]
+            return presence_actions_fields[presence_action_field][0]
 
         def is_action_possible(presence_action_field, action, default_func,
                                bare_from_jid):
@@ -329,10 +912,11 @@ class PresenceAccount(Account):
             raise default_func(bare_from_jid)
 
         def get_default_presence_action(presence_action_field):
-            return real_class.get_presence_actions_fields()[presence_action_field][1]
+            return presence_actions_fields[presence_action_field][1]
 
         if real_class is None:
             real_class = cls
+        presence_actions_fields = real_class.get_presence_actions_fields()
         return Account.get_register_fields(real_class) + \
             [(None, None, None, None, None),
              ("chat_action", "list-single",
@@ -403,12 +987,18 @@ class PresenceAccount(Account):
     action = property(get_action)
 
 def get_legacy_jids(bare_to_jid):
+    context = model.get_request_context(bare_to_jid)
+    if context is not None:
+        return context.get_legacy_jids()
     model.db_connect()
-    legacy_jids = LegacyJID.select(\
-            AND(AND(LegacyJID.q.accountID == Account.q.id,
-                    Account.q.userID == User.q.id),
-                User.q.jid == bare_to_jid))
-    return legacy_jids
+    try:
+        if model.account_registry is not None:
+            return model.account_registry.get_legacy_jids(\
+                unicode(bare_to_jid))
+        return _get_objects(LegacyJID, legacy_jids_query.query_all(\
+                (unicode(bare_to_jid),)))
+    finally:
+        model.db_disconnect()
 
 class LegacyJID(InheritableSQLObject):
     _connection = model.hub
@@ -416,3 +1006,104 @@ class LegacyJID(InheritableSQLObject):
     legacy_address = StringCol()
     jid = StringCol()
     account = ForeignKey('Account')
+
+    def _invalidate_registry(self):
+        """Drop legacy JID user objects from the account registry"""
+        if is_cached() and self.account is not None:
+            self.account._invalidate_registry()
+
+    def _create(self, id, **kw):
+        InheritableSQLObject._create(self, id, **kw)
+        self._invalidate_registry()
+
+    def _set_accountID(self, account_id):
+        if not self.sqlmeta._creating:
+            self._invalidate_registry()
+        self._SO_set_accountID(account_id)
+        if not self.sqlmeta._creating:
+            self._invalidate_registry()
+
+    def destroySelf(self):
+        self._invalidate_registry()
+        InheritableSQLObject.destroySelf(self)
+
+## Prepared lookups (see model.PreparedQuery)
+
+def _get_column_names(cls):
+    """Return id and column names of `cls` table in sqlmeta.columnList
+    order, as expected by get selectResults"""
+    table = cls.sqlmeta.table
+    return ", ".join([table + "." + cls.sqlmeta.idName]
+                     + [table + "." + column.dbName
+                        for column in cls.sqlmeta.columnList])
+
+def _get_objects(cls, rows):
+    """Return `cls` objects from (id, column values...) `rows`"""
+    return [cls.get(row[0], selectResults=row[1:]) for row in rows]
+
+def _get_user_join():
+    """Return the condition joining account and user tables"""
+    return Account.sqlmeta.table + "." \
+        + Account.sqlmeta.columns["userID"].dbName + " = " \
+        + User.sqlmeta.table + "." + User.sqlmeta.idName \
+        + " AND " + User.sqlmeta.table + "." \
+        + User.sqlmeta.columns["jid"].dbName
+
+user_query = model.PreparedQuery(lambda marker: \
+    "SELECT " + _get_column_names(User) + " FROM " + User.sqlmeta.table
+    + " WHERE " + User.sqlmeta.columns["jid"].dbName + " = " + marker
+    + " ORDER BY " + User.sqlmeta.idName)
+
+account_query = model.PreparedQuery(lambda marker: \
+    "SELECT " + _get_column_names(Account) + " FROM "
+    + Account.sqlmeta.table + ", " + User.sqlmeta.table
+    + " WHERE " + _get_user_join() + " = " + marker + " AND "
+    + Account.sqlmeta.table + "." + Account.sqlmeta.columns["name"].dbName
+    + " = " + marker + " ORDER BY " + Account.sqlmeta.table + "."
+    + Account.sqlmeta.idName)
+
+accounts_count_query = model.PreparedQuery(lambda marker: \
+    "SELECT COUNT(*) FROM " + Account.sqlmeta.table + ", "
+    + User.sqlmeta.table + " WHERE " + _get_user_join() + " = " + marker)
+
+def _get_online_users_where(marker):
+    """Return the condition selecting users with an account not OFFLINE"""
+    return Account.sqlmeta.table + "." \
+        + Account.sqlmeta.columns["userID"].dbName + " = " \
+        + User.sqlmeta.table + "." + User.sqlmeta.idName + " AND " \
+        + Account.sqlmeta.table + "." \
+        + Account.sqlmeta.columns["_status"].dbName + " != " + marker
+
+online_users_query = model.PreparedQuery(lambda marker: \
+    "SELECT DISTINCT " + User.sqlmeta.table + "." + User.sqlmeta.idName
+    + ", " + User.sqlmeta.table + "." + User.sqlmeta.columns["jid"].dbName
+    + " FROM " + Account.sqlmeta.table + ", " + User.sqlmeta.table
+    + " WHERE " + _get_online_users_where(marker) + " AND "
+    + User.sqlmeta.table + "." + User.sqlmeta.idName + " > " + marker
+    + " ORDER BY " + User.sqlmeta.table + "." + User.sqlmeta.idName
+    + " LIMIT " + marker)
+
+online_users_count_query = model.PreparedQuery(lambda marker: \
+    "SELECT COUNT(DISTINCT " + User.sqlmeta.table + "."
+    + User.sqlmeta.idName + ") FROM " + Account.sqlmeta.table + ", "
+    + User.sqlmeta.table + " WHERE " + _get_online_users_where(marker))
+
+def get_online_users_jid_page(after=0, limit=1000):
+    """
+    Return (user id, user JID) of at most `limit` users having an account
+    not OFFLINE, ordered by user id, with an id greater than `after`.
+    """
+    return online_users_query.query_all((OFFLINE, after, limit))
+
+def get_online_users_count():
+    """Return the number of users having an account not OFFLINE"""
+    return online_users_count_query.query_all((OFFLINE,))[0][0]
+
+legacy_jids_query = model.PreparedQuery(lambda marker: \
+    "SELECT " + _get_column_names(LegacyJID) + " FROM "
+    + LegacyJID.sqlmeta.table + ", " + Account.sqlmeta.table + ", "
+    + User.sqlmeta.table + " WHERE " + LegacyJID.sqlmeta.table + "."
+    + LegacyJID.sqlmeta.columns["accountID"].dbName + " = "
+    + Account.sqlmeta.table + "." + Account.sqlmeta.idName + " AND "
+    + _get_user_join() + " = " + marker + " ORDER BY "
+    + LegacyJID.sqlmeta.table + "." + LegacyJID.sqlmeta.idName)
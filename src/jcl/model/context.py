@@ -0,0 +1,159 @@
+##
+## context.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+
+"""Request scoped cache of the objects of the user sending a stanza.
+
+A RequestContext is started for the sender bare JID when a stanza is
+handled (see begin and end). While it is the current context of the
+thread, get_user, get_account, get_accounts, get_accounts_count and
+get_legacy_jids from jcl.model.account are served from it for this bare
+JID: the user, its accounts and its legacy JIDs are each loaded at most
+once. Changes invalidating the account registry also drop the context
+objects (see jcl.model.account hooks).
+"""
+
+__revision__ = ""
+
+from sqlobject.sqlbuilder import AND
+
+import jcl.model as model
+from jcl.model.account import User, Account, LegacyJID
+
+class RequestContext(object):
+    """User, accounts and legacy JIDs of a bare JID, loaded lazily"""
+
+    def __init__(self, bare_jid):
+        """RequestContext constructor"""
+        self.bare_jid = unicode(bare_jid)
+        # number of begin calls not ended
+        self.depth = 0
+        self.hits = 0
+        self.misses = 0
+        self.invalidate()
+
+    def invalidate(self):
+        """Drop loaded objects, they are loaded again on next access"""
+        self.user_loaded = False
+        self.user = None
+        # accounts ordered by id
+        self.accounts = None
+        self.legacy_jids = None
+
+    def __load_user(self):
+        """Load User of the context bare JID"""
+        if model.account_registry is not None:
+            self.user = model.account_registry.get_user(self.bare_jid)
+        else:
+            model.db_connect()
+            try:
+                users = list(User.select(User.q.jid == self.bare_jid))
+            finally:
+                model.db_disconnect()
+            if users:
+                self.user = users[0]
+            else:
+                self.user = None
+        self.user_loaded = True
+
+    def get_user(self, user_class=User):
+        """Return User of the context bare JID"""
+        if self.user_loaded:
+            self.hits += 1
+        else:
+            self.misses += 1
+            self.__load_user()
+        if isinstance(self.user, user_class):
+            return self.user
+        return None
+
+    def get_accounts(self, account_class=Account):
+        """Return the list of accounts of the context bare JID"""
+        if self.accounts is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if model.account_registry is not None:
+                self.accounts = \
+                    model.account_registry.get_accounts(self.bare_jid)
+            else:
+                # the user is loaded first and its accounts are read by its
+                # id, so get_user does not query it again
+                if not self.user_loaded:
+                    self.__load_user()
+                if self.user is None:
+                    self.accounts = []
+                else:
+                    model.db_connect()
+                    try:
+                        self.accounts = list(Account.select(\
+                                Account.q.userID == self.user.id,
+                                orderBy=Account.q.id))
+                    finally:
+                        model.db_disconnect()
+        return [_account for _account in self.accounts
+                if isinstance(_account, account_class)]
+
+    def get_account(self, name, account_class=Account):
+        """Return `name` account of the context bare JID"""
+        for _account in self.get_accounts(account_class):
+            if _account.name == name:
+                return _account
+        return None
+
+    def get_legacy_jids(self):
+        """Return the list of legacy JIDs of the context bare JID"""
+        if self.legacy_jids is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            if model.account_registry is not None:
+                self.legacy_jids = \
+                    model.account_registry.get_legacy_jids(self.bare_jid)
+            else:
+                model.db_connect()
+                try:
+                    self.legacy_jids = list(LegacyJID.select(\
+                            AND(AND(LegacyJID.q.accountID == Account.q.id,
+                                    Account.q.userID == User.q.id),
+                                User.q.jid == self.bare_jid),
+                            orderBy=LegacyJID.q.id))
+                finally:
+                    model.db_disconnect()
+        return list(self.legacy_jids)
+
+def begin(bare_jid):
+    """
+    Make a context for `bare_jid` the current context of the thread and
+    return it. The current context is reused if it has the same bare JID.
+    """
+    contexts = model.get_request_contexts()
+    if contexts and contexts[-1].bare_jid == unicode(bare_jid):
+        context = contexts[-1]
+    else:
+        context = RequestContext(bare_jid)
+    context.depth += 1
+    contexts.append(context)
+    return context
+
+def end():
+    """Restore the context which was current before the last begin"""
+    contexts = model.get_request_contexts()
+    if contexts:
+        contexts.pop().depth -= 1
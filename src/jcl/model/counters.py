@@ -0,0 +1,185 @@
+##
+## counters.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+"""Materialized counters of registered, disabled and online accounts.
+
+When enabled, Account updates the counters as accounts are created or
+destroyed, enabled or disabled and change their status, so reading them
+does not scan the account table. Counters are computed again from the
+database every `interval` seconds by a background thread and on the next
+read after a bulk update or a rolled back unit of work, so they also catch
+up with changes made outside of the component.
+"""
+
+__revision__ = ""
+
+import logging
+import threading
+
+import jcl.model as model
+from jcl.model import account
+from jcl.model.account import Account
+
+REGISTERED = "registered"
+DISABLED = "disabled"
+ONLINE = "online"
+
+class AccountCounters(object):
+    """Number of registered, disabled and online accounts"""
+
+    def __init__(self, interval=300):
+        self.__logger = logging.getLogger("jcl.model.counters.AccountCounters")
+        self.interval = interval
+        self.lock = threading.Lock()
+        self.counts = None
+        self.running = False
+        self.event = threading.Event()
+        self.thread = None
+        self.reconciliations = 0
+        self.drifts = 0
+
+    def get(self, name):
+        """Return counter `name`"""
+        return self.get_counts()[name]
+
+    def get_counts(self):
+        """Return a copy of every counter, computed from the database if
+        invalid"""
+        self.lock.acquire()
+        try:
+            if self.counts is not None:
+                return self.counts.copy()
+        finally:
+            self.lock.release()
+        return self.reconcile()
+
+    def update(self, registered=0, disabled=0, online=0):
+        """Add given values to counters (ignored until computed)"""
+        self.lock.acquire()
+        try:
+            if self.counts is not None:
+                self.counts[REGISTERED] += registered
+                self.counts[DISABLED] += disabled
+                self.counts[ONLINE] += online
+        finally:
+            self.lock.release()
+
+    def account_created(self, enabled, status):
+        """Count a new account"""
+        self.update(1, int(not enabled), int(status != account.OFFLINE))
+
+    def account_destroyed(self, enabled, status):
+        """Uncount a destroyed account"""
+        self.update(-1, -int(not enabled), -int(status != account.OFFLINE))
+
+    def enabled_changed(self, old_enabled, enabled):
+        """Count an account being enabled or disabled"""
+        self.update(disabled=int(not enabled) - int(not old_enabled))
+
+    def status_changed(self, old_status, status):
+        """Count an account going online or offline"""
+        self.update(online=int(status != account.OFFLINE)
+                    - int(old_status != account.OFFLINE))
+
+    def invalidate(self):
+        """Compute counters from the database on next read"""
+        self.lock.acquire()
+        try:
+            self.counts = None
+        finally:
+            self.lock.release()
+
+    def reconcile(self):
+        """Compute counters from the database and return them"""
+        if model.write_behind is not None:
+            # statuses kept in memory are counted as online
+            model.write_behind.flush()
+        counts = {REGISTERED: account.get_all_accounts_count(),
+                  DISABLED: account.get_all_accounts_count(\
+                      filter=(Account.q.enabled == False)),
+                  ONLINE: account.get_all_accounts_count(\
+                      filter=(Account.q._status != account.OFFLINE))}
+        self.lock.acquire()
+        try:
+            if self.counts is not None and self.counts != counts:
+                self.__logger.debug("Counters drifted: " + str(self.counts)
+                                    + " != " + str(counts))
+                self.drifts += 1
+            self.counts = counts
+            self.reconciliations += 1
+        finally:
+            self.lock.release()
+        return counts.copy()
+
+    def start(self):
+        """Start reconciliation thread"""
+        self.running = True
+        self.event.clear()
+        self.thread = threading.Thread(target=self.run,
+                                       name="AccountCountersThread")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop reconciliation thread"""
+        self.running = False
+        self.event.set()
+        if self.thread is not None:
+            self.thread.join(self.interval)
+            self.thread = None
+
+    def run(self):
+        """Compute counters from the database every `interval` seconds"""
+        while self.running:
+            self.event.wait(self.interval)
+            if not self.running:
+                break
+            try:
+                self.reconcile()
+            except Exception:
+                self.__logger.error("Error while computing counters",
+                                    exc_info=True)
+
+    def get_stats(self):
+        """Return counters statistics as a dictionary"""
+        self.lock.acquire()
+        try:
+            return {"reconciliations": self.reconciliations,
+                    "drifts": self.drifts}
+        finally:
+            self.lock.release()
+
+def enable(interval=300):
+    """
+    Enable account counters, computed from the database every `interval`
+    seconds.
+    """
+    counters = AccountCounters(interval)
+    if interval > 0:
+        counters.start()
+    model.account_counters = counters
+    return counters
+
+def disable():
+    """Disable account counters"""
+    counters = model.account_counters
+    if counters is None:
+        return
+    model.account_counters = None
+    counters.stop()
@@ -0,0 +1,198 @@
+##
+## migration.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+
+"""Versioned schema migrations.
+
+A migration is a (version, description, upgrade_function) tuple. Pending
+migrations of a schema are applied in version order, each one in its own
+transaction, and the reached version is stored in the schema_version table.
+"""
+
+__revision__ = ""
+
+import logging
+
+from sqlobject.main import SQLObject
+from sqlobject.col import StringCol, IntCol
+
+import jcl.model as model
+from jcl.model.account import User, Account, PresenceAccount, LegacyJID
+from jcl.model.session import CommandSession
+
+class SchemaVersion(SQLObject):
+    """Version of each schema (jcl and components ones) stored in database"""
+    _connection = model.hub
+
+    name = StringCol(length=255, alternateID=True)
+    version = IntCol(default=0)
+
+def get_schema_version(name, connection=None):
+    """Return current version of `name` schema, 0 if never migrated"""
+    result = SchemaVersion.selectBy(name=name, connection=connection)
+    if result.count() == 0:
+        return 0
+    return result[0].version
+
+def set_schema_version(name, version, connection=None):
+    """Store current version of `name` schema"""
+    result = SchemaVersion.selectBy(name=name, connection=connection)
+    if result.count() == 0:
+        SchemaVersion(name=name, version=version, connection=connection)
+    else:
+        result[0].version = version
+
+def migrate(name="jcl", migrations=None, connection=None):
+    """
+    Apply pending `migrations` of `name` schema. Return reached version.
+    """
+    logger = logging.getLogger("jcl.model.migration")
+    if migrations is None:
+        migrations = jcl_migrations
+    if connection is None:
+        connection = model.hub.getConnection()
+    SchemaVersion.createTable(ifNotExists=True, connection=connection)
+    current_version = get_schema_version(name, connection)
+    for (version, description, upgrade) in migrations:
+        if version <= current_version:
+            continue
+        logger.info("Migrating " + name + " schema to version "
+                    + str(version) + ": " + description)
+        trans = connection.transaction()
+        try:
+            upgrade(trans)
+            set_schema_version(name, version, trans)
+            trans.commit(close=True)
+        except:
+            trans.rollback()
+            raise
+        current_version = version
+    return current_version
+
+def get_columns(connection, table):
+    """Return column names of `table` (SQLite only)"""
+    return [column[1] for column
+            in connection.queryAll("PRAGMA table_info(" + table + ")")]
+
+## JCL migrations
+
+def rename_user_table(connection):
+    """
+    2008-11-09: 'user' table renamed to 'user_table' (SQLite only, previous
+    schemas have only been released for SQLite).
+    """
+    if connection.dbName == "sqlite" \
+            and connection.tableExists("user") \
+            and not connection.tableExists("user_table"):
+        connection.query("ALTER TABLE user RENAME TO user_table")
+
+def rename_account_user_id(connection):
+    """
+    2009-02-17: account.user_id renamed to account.user_table_id (SQLite
+    only). The account table is rebuilt so its foreign key references
+    user_table.
+    """
+    if connection.dbName != "sqlite" \
+            or not connection.tableExists("account") \
+            or not "user_id" in get_columns(connection, "account"):
+        return
+    connection.query("ALTER TABLE account RENAME TO account_backup")
+    connection.query("""CREATE TABLE account (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    jid TEXT,
+    status TEXT,
+    error TEXT,
+    enabled BOOLEAN,
+    lastlogin TIMESTAMP,
+    user_table_id INT CONSTRAINT user_table_id_exists REFERENCES user_table(id),
+    child_name VARCHAR (255)
+)""")
+    connection.query("INSERT INTO account (id, name, jid, status, error, "
+                     + "enabled, lastlogin, user_table_id, child_name) "
+                     + "SELECT id, name, jid, status, error, enabled, "
+                     + "lastlogin, user_id, child_name FROM account_backup")
+    connection.query("DROP TABLE account_backup")
+
+def create_tables(connection):
+    """Create JCL tables if they do not exist yet"""
+    for model_class in [User, Account, PresenceAccount, LegacyJID]:
+        model_class.createTable(ifNotExists=True, connection=connection)
+
+# length of the indexed prefix of TEXT columns for databases (MySQL) that
+# cannot index a whole TEXT column. 191 characters fit in the 767 bytes
+# InnoDB key limit with 4 bytes characters.
+TEXT_INDEX_PREFIX_LENGTH = 191
+
+def get_text_index_column(connection, column):
+    """
+    Return `column` TEXT column as written in a CREATE INDEX statement for
+    `connection` database
+    """
+    if connection.dbName == "mysql":
+        return column + "(" + str(TEXT_INDEX_PREFIX_LENGTH) + ")"
+    return column
+
+def create_indexes(connection):
+    """
+    Index columns used to lookup users, accounts and legacy JIDs.
+    account(user_table_id, name) index is unique unless existing accounts
+    already break this constraint. It also serves lookups on user_table_id
+    alone. On MySQL, only a prefix of TEXT columns is indexed.
+    """
+    jid = get_text_index_column(connection, "jid")
+    name = get_text_index_column(connection, "name")
+    status = get_text_index_column(connection, "status")
+    connection.query("CREATE INDEX user_table_jid_idx ON user_table ("
+                     + jid + ")")
+    connection.query("CREATE INDEX account_name_idx ON account (" + name
+                     + ")")
+    connection.query("CREATE INDEX account_jid_idx ON account (" + jid + ")")
+    connection.query("CREATE INDEX account_status_idx ON account (" + status
+                     + ")")
+    connection.query("CREATE INDEX legacy_j_id_account_id_idx "
+                     + "ON legacy_j_id (account_id)")
+    duplicates = connection.queryAll("SELECT user_table_id, name "
+                                     + "FROM account "
+                                     + "GROUP BY user_table_id, name "
+                                     + "HAVING COUNT(*) > 1")
+    if duplicates:
+        logging.getLogger("jcl.model.migration").warning(
+            "Duplicate account names " + str(duplicates)
+            + ", account(user_table_id, name) index is not unique")
+        connection.query("CREATE INDEX account_user_table_id_name_idx "
+                         + "ON account (user_table_id, " + name + ")")
+    else:
+        connection.query("CREATE UNIQUE INDEX account_user_table_id_name_idx "
+                         + "ON account (user_table_id, " + name + ")")
+
+def create_command_session_table(connection):
+    """
+    Create the table of ad-hoc command sessions stored in database (see
+    jcl.model.session.SQLSessionBackend)
+    """
+    CommandSession.createTable(ifNotExists=True, connection=connection)
+
+jcl_migrations = [(1, "rename user table to user_table", rename_user_table),
+                  (2, "rename account.user_id to user_table_id",
+                   rename_account_user_id),
+                  (3, "create tables", create_tables),
+                  (4, "add lookup indexes", create_indexes),
+                  (5, "create command sessions table",
+                   create_command_session_table)]
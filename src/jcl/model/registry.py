@@ -0,0 +1,227 @@
+##
+## registry.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+
+"""In memory registry of users, accounts and legacy JIDs.
+
+When enabled, get_user, get_account, get_accounts and get_legacy_jids from
+jcl.model.account are served from memory. Objects are the SQLObject
+instances shared through the connection cache, so attribute sets are still
+written to the database. Creating or destroying a User, an Account or a
+LegacyJID, or changing one of their lookup attributes, invalidates the
+registry entry of the user bare JID (see jcl.model.account hooks).
+The registry assumes the database is only modified by this process.
+"""
+
+__revision__ = ""
+
+import logging
+import threading
+
+from sqlobject.sqlbuilder import AND
+
+import jcl.model as model
+from jcl.model.account import User, Account, LegacyJID
+
+class UserEntry(object):
+    """Objects associated to a user bare JID"""
+
+    def __init__(self, user=None, accounts=None, legacy_jids=None):
+        self.user = user
+        # accounts ordered by id
+        self.accounts = accounts or []
+        self.accounts_by_name = {}
+        for _account in self.accounts:
+            self.accounts_by_name[_account.name] = _account
+        self.legacy_jids = legacy_jids or []
+
+class AccountRegistry(object):
+    """
+    Hold User, Account and LegacyJID objects indexed by user bare JID and
+    by (user bare JID, account name).
+    """
+
+    def __init__(self):
+        self.__logger = logging.getLogger("jcl.model.registry.AccountRegistry")
+        self.lock = threading.RLock()
+        # bare JID -> UserEntry, only for existing users
+        self.entries = {}
+        # True when every user has been loaded by load(): unknown bare JIDs
+        # do not need to be looked up in the database
+        self.complete = False
+        # bare JIDs invalidated since load()
+        self.invalidated = set()
+        # incremented on each invalidation to detect concurrent changes
+        # while loading an entry
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def load_entry(self, bare_jid):
+        """Load objects of `bare_jid` user from the database"""
+        model.db_connect()
+        try:
+            users = User.select(User.q.jid == bare_jid)
+            if users.count() == 0:
+                return None
+            user = users[0]
+            accounts = list(Account.select(Account.q.userID == user.id,
+                                           orderBy="id"))
+            legacy_jids = list(LegacyJID.select(\
+                    AND(LegacyJID.q.accountID == Account.q.id,
+                        Account.q.userID == user.id),
+                    orderBy=LegacyJID.q.id))
+            return UserEntry(user, accounts, legacy_jids)
+        finally:
+            model.db_disconnect()
+
+    def load(self):
+        """Load every user, account and legacy JID from the database"""
+        model.db_connect()
+        try:
+            # user id -> (user, accounts, legacy JIDs)
+            users = {}
+            for user in User.select():
+                users[user.id] = (user, [], [])
+            for _account in Account.select(orderBy="id"):
+                if _account.user is not None:
+                    users[_account.user.id][1].append(_account)
+            for legacy_jid in LegacyJID.select(orderBy="id"):
+                if legacy_jid.account is not None \
+                        and legacy_jid.account.user is not None:
+                    users[legacy_jid.account.user.id][2].append(legacy_jid)
+        finally:
+            model.db_disconnect()
+        self.lock.acquire()
+        try:
+            self.entries = {}
+            for (user, accounts, legacy_jids) in users.itervalues():
+                self.entries[user.jid] = UserEntry(user, accounts,
+                                                   legacy_jids)
+            self.complete = True
+            self.invalidated = set()
+            self.generation += 1
+        finally:
+            self.lock.release()
+        self.__logger.info("Registry loaded " + str(len(users)) + " users")
+
+    def get_entry(self, bare_jid):
+        """
+        Return UserEntry of `bare_jid` user, None if it does not exist.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.entries.get(bare_jid)
+            if entry is not None \
+                    or (self.complete and not bare_jid in self.invalidated):
+                self.hits += 1
+                return entry
+            self.misses += 1
+            generation = self.generation
+        finally:
+            self.lock.release()
+        # database is not accessed while holding the lock
+        entry = self.load_entry(bare_jid)
+        self.lock.acquire()
+        try:
+            if generation == self.generation:
+                self.invalidated.discard(bare_jid)
+                if entry is not None:
+                    self.entries[bare_jid] = entry
+            return entry
+        finally:
+            self.lock.release()
+
+    def invalidate(self, bare_jid):
+        """Drop `bare_jid` user objects, they are reloaded on next access"""
+        self.lock.acquire()
+        try:
+            self.entries.pop(bare_jid, None)
+            if self.complete:
+                self.invalidated.add(bare_jid)
+            self.generation += 1
+        finally:
+            self.lock.release()
+
+    def clear(self):
+        """Drop every object"""
+        self.lock.acquire()
+        try:
+            self.entries = {}
+            self.complete = False
+            self.invalidated = set()
+            self.generation += 1
+        finally:
+            self.lock.release()
+
+    def get_user(self, bare_jid, user_class=User):
+        """Return `bare_jid` User"""
+        entry = self.get_entry(bare_jid)
+        if entry is not None and isinstance(entry.user, user_class):
+            return entry.user
+        return None
+
+    def get_account(self, bare_jid, name, account_class=Account):
+        """Return `name` account of `bare_jid` user"""
+        entry = self.get_entry(bare_jid)
+        if entry is not None:
+            _account = entry.accounts_by_name.get(name)
+            if isinstance(_account, account_class):
+                return _account
+        return None
+
+    def get_accounts(self, bare_jid, account_class=Account):
+        """Return the list of `bare_jid` user accounts"""
+        entry = self.get_entry(bare_jid)
+        if entry is None:
+            return []
+        return [_account for _account in entry.accounts
+                if isinstance(_account, account_class)]
+
+    def get_legacy_jids(self, bare_jid):
+        """Return the list of `bare_jid` user legacy JIDs"""
+        entry = self.get_entry(bare_jid)
+        if entry is None:
+            return []
+        return list(entry.legacy_jids)
+
+    def get_stats(self):
+        """Return registry statistics as a dictionary"""
+        self.lock.acquire()
+        try:
+            return {"users": len(self.entries),
+                    "complete": self.complete,
+                    "hits": self.hits,
+                    "misses": self.misses}
+        finally:
+            self.lock.release()
+
+def enable(preload=False):
+    """
+    Enable the account registry, loading every user when `preload` is True.
+    """
+    registry = AccountRegistry()
+    if preload:
+        registry.load()
+    model.account_registry = registry
+    return registry
+
+def disable():
+    """Disable the account registry"""
+    model.account_registry = None
@@ -0,0 +1,261 @@
+##
+## session.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+"""Store of ad-hoc command sessions.
+
+A session is a (step, context) tuple indexed by session ID (see
+jcl.jabber.command.CommandManager). SessionStore keeps sessions in memory
+with an expiration delay (ttl) and a maximum number of sessions (least
+recently used ones are dropped first). A backend can also store them (see
+SQLSessionBackend) so sessions survive a restart.
+"""
+
+__revision__ = ""
+
+import logging
+import pickle
+import threading
+import time
+import uuid
+
+from sqlobject.main import SQLObject
+from sqlobject.col import StringCol, IntCol, FloatCol
+
+import jcl.model as model
+
+class CommandSession(SQLObject):
+    """Ad-hoc command session stored by SQLSessionBackend"""
+    _connection = model.hub
+
+    session_id = StringCol(length=255, alternateID=True)
+    step = IntCol(default=1)
+    # pickled context dictionary
+    context = StringCol(default=None)
+    last_access = FloatCol(default=0)
+
+class MemorySessionBackend(object):
+    """Backend keeping sessions in SessionStore memory only"""
+
+    def load(self, session_id):
+        """Return (step, context, last access time) of `session_id`
+        session, None if unknown"""
+        return None
+
+    def save(self, session_id, step, context, last_access):
+        """Store `session_id` session"""
+        pass
+
+    def delete(self, session_id):
+        """Delete `session_id` session"""
+        pass
+
+    def expire(self, expire_time):
+        """Delete sessions not accessed since `expire_time`"""
+        pass
+
+class SQLSessionBackend(MemorySessionBackend):
+    """Backend storing sessions in command_session table"""
+
+    def load(self, session_id):
+        model.db_connect()
+        try:
+            sessions = list(CommandSession.selectBy(session_id=session_id))
+            if not sessions:
+                return None
+            return (sessions[0].step, pickle.loads(str(sessions[0].context)),
+                    sessions[0].last_access)
+        finally:
+            model.db_disconnect()
+
+    def save(self, session_id, step, context, last_access):
+        model.db_connect()
+        try:
+            sessions = list(CommandSession.selectBy(session_id=session_id))
+            if sessions:
+                sessions[0].set(step=step, context=pickle.dumps(context),
+                                last_access=last_access)
+            else:
+                CommandSession(session_id=session_id, step=step,
+                               context=pickle.dumps(context),
+                               last_access=last_access)
+        finally:
+            model.db_disconnect()
+
+    def delete(self, session_id):
+        model.db_connect()
+        try:
+            CommandSession.deleteMany(CommandSession.q.session_id \
+                                          == session_id)
+        finally:
+            model.db_disconnect()
+
+    def expire(self, expire_time):
+        model.db_connect()
+        try:
+            CommandSession.deleteMany(CommandSession.q.last_access \
+                                          < expire_time)
+        finally:
+            model.db_disconnect()
+
+class SessionStore(object):
+    """
+    Dictionary like store of (step, context) sessions indexed by session
+    ID. Contexts modified in place must be stored again with save.
+    """
+
+    def __init__(self, backend=None, ttl=600, max_size=1000):
+        """
+        SessionStore constructor. Sessions not accessed for `ttl` seconds
+        expire, at most `max_size` sessions are kept in memory.
+        """
+        self.__logger = logging.getLogger("jcl.model.session.SessionStore")
+        if backend is None:
+            backend = MemorySessionBackend()
+        self.backend = backend
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.RLock()
+        # session ID -> [step, context, last access time]
+        self.sessions = {}
+        self.last_expire = time.time()
+        self.expired = 0
+        self.evicted = 0
+
+    def new_session_id(self, prefix):
+        """Return a new unique session ID starting with `prefix`"""
+        return prefix + ":" + uuid.uuid4().hex
+
+    def __get_entry(self, session_id):
+        """Return `session_id` entry loading it from the backend if needed,
+        None if unknown or expired (lock must be held)"""
+        now = time.time()
+        entry = self.sessions.get(session_id)
+        loaded = False
+        if entry is None:
+            entry = self.backend.load(session_id)
+            if entry is None:
+                return None
+            entry = list(entry)
+            loaded = True
+        if now - entry[2] > self.ttl:
+            self.__delete(session_id)
+            self.expired += 1
+            return None
+        entry[2] = now
+        if loaded:
+            self.sessions[session_id] = entry
+            self.__evict()
+        return entry
+
+    def __delete(self, session_id):
+        """Delete `session_id` session (lock must be held)"""
+        self.sessions.pop(session_id, None)
+        self.backend.delete(session_id)
+
+    def __evict(self):
+        """Drop least recently used sessions above max_size (lock must be
+        held)"""
+        while len(self.sessions) > self.max_size:
+            oldest = None
+            for (session_id, entry) in self.sessions.iteritems():
+                if oldest is None or entry[2] < self.sessions[oldest][2]:
+                    oldest = session_id
+            self.__logger.debug("Dropping session " + oldest)
+            self.__delete(oldest)
+            self.evicted += 1
+
+    def __getitem__(self, session_id):
+        self.lock.acquire()
+        try:
+            entry = self.__get_entry(session_id)
+            if entry is None:
+                raise KeyError(session_id)
+            return (entry[0], entry[1])
+        finally:
+            self.lock.release()
+
+    def __setitem__(self, session_id, session):
+        (step, context) = session
+        self.lock.acquire()
+        try:
+            now = time.time()
+            if now - self.last_expire > self.ttl:
+                self.expire(now)
+            self.sessions[session_id] = [step, context, now]
+            self.backend.save(session_id, step, context, now)
+            self.__evict()
+        finally:
+            self.lock.release()
+
+    def __delitem__(self, session_id):
+        self.lock.acquire()
+        try:
+            if session_id not in self.sessions \
+                    and self.backend.load(session_id) is None:
+                raise KeyError(session_id)
+            self.__delete(session_id)
+        finally:
+            self.lock.release()
+
+    def __contains__(self, session_id):
+        self.lock.acquire()
+        try:
+            return self.__get_entry(session_id) is not None
+        finally:
+            self.lock.release()
+
+    has_key = __contains__
+
+    def __len__(self):
+        return len(self.sessions)
+
+    def save(self, session_id):
+        """Store `session_id` session again after its context changed"""
+        self.lock.acquire()
+        try:
+            entry = self.sessions.get(session_id)
+            if entry is not None:
+                self.backend.save(session_id, entry[0], entry[1], entry[2])
+        finally:
+            self.lock.release()
+
+    def expire(self, now=None):
+        """Drop sessions not accessed for ttl seconds"""
+        if now is None:
+            now = time.time()
+        self.lock.acquire()
+        try:
+            for (session_id, entry) in self.sessions.items():
+                if now - entry[2] > self.ttl:
+                    del self.sessions[session_id]
+                    self.expired += 1
+            self.backend.expire(now - self.ttl)
+            self.last_expire = now
+        finally:
+            self.lock.release()
+
+    def get_stats(self):
+        """Return store statistics as a dictionary"""
+        self.lock.acquire()
+        try:
+            return {"sessions": len(self.sessions),
+                    "expired": self.expired,
+                    "evicted": self.evicted}
+        finally:
+            self.lock.release()
@@ -9,7 +9,6 @@ import sys
 
 from sqlobject import SQLObject
 from sqlobject.col import StringCol
-from sqlobject.dbconnection import TheURIOpener
 
 import jcl.model as model
 
@@ -36,9 +35,8 @@ class ModelModule_TestCase(unittest.TestCase):
     def tearDown(self):
         model.db_connect()
         MyMockSQLObject.dropTable(ifExists=True)
-        del TheURIOpener.cachedURIs[self.db_url]
-        model.hub.threadConnection.close()
         model.db_disconnect()
+        model.db_close()
         if os.path.exists(self.db_path):
             os.unlink(self.db_path)
 
@@ -73,11 +71,285 @@ class ModelModule_TestCase(unittest.TestCase):
         self.assertEquals(objs.count(), 200)
         model.db_disconnect()
 
+    def test_transactional(self):
+        def create_objects():
+            MyMockSQLObject(string_attr="obj1")
+            self.assertTrue(model.get_unit_of_work() is not None)
+            MyMockSQLObject(string_attr="obj2")
+            return 2
+        self.assertEquals(model.transactional(create_objects)(), 2)
+        self.assertEquals(model.get_unit_of_work(), None)
+        model.db_connect()
+        self.assertEquals(MyMockSQLObject.select().count(), 2)
+        model.db_disconnect()
+
+    def test_transactional_rollback(self):
+        def create_objects():
+            MyMockSQLObject(string_attr="obj1")
+            raise Exception("error")
+        self.assertRaises(Exception, model.transactional(create_objects))
+        self.assertEquals(model.get_unit_of_work(), None)
+        model.db_connect()
+        self.assertEquals(MyMockSQLObject.select().count(), 0)
+        model.db_disconnect()
+
+    def test_nested_transaction_rollback(self):
+        model.begin_transaction()
+        MyMockSQLObject(string_attr="obj1")
+        unit_of_work = model.get_unit_of_work()
+        model.begin_transaction()
+        self.assertTrue(model.get_unit_of_work() is unit_of_work)
+        MyMockSQLObject(string_attr="obj2")
+        model.end_transaction(False)
+        self.assertEquals(unit_of_work.depth, 1)
+        model.end_transaction()
+        self.assertEquals(model.get_unit_of_work(), None)
+        model.db_connect()
+        self.assertEquals(MyMockSQLObject.select().count(), 0)
+        model.db_disconnect()
+
+    def test_db_disconnect_detach_connection(self):
+        model.db_connect()
+        model.db_connect()
+        self.assertTrue(model.hub.threadConnection is model.pool.connection)
+        model.db_disconnect()
+        self.assertTrue(model.hub.threadConnection is model.pool.connection)
+        model.db_disconnect()
+        self.assertRaises(AttributeError, getattr, model.hub,
+                          "threadConnection")
+        self.assertEquals(model.pool.get_stats()["in_use"], 0)
+
+    def test_transaction_release_connection(self):
+        model.begin_transaction()
+        unit_of_work = model.get_unit_of_work()
+        model.begin_transaction()
+        MyMockSQLObject(string_attr="obj1")
+        model.end_transaction()
+        model.end_transaction(False)
+        self.assertTrue(unit_of_work.transaction._obsolete)
+        self.assertEquals(model.pool.get_stats()["in_use"], 0)
+        model.begin_transaction()
+        unit_of_work = model.get_unit_of_work()
+        model.end_transaction()
+        self.assertTrue(unit_of_work.transaction._obsolete)
+        self.assertEquals(model.pool.get_stats()["in_use"], 0)
+
+    def test_prepared_query(self):
+        query = model.PreparedQuery(lambda marker: \
+            "SELECT string_attr FROM my_mock_sql_object WHERE string_attr = "
+            + marker)
+        model.db_connect()
+        MyMockSQLObject(string_attr="obj1")
+        MyMockSQLObject(string_attr="obj2")
+        model.db_disconnect()
+        self.assertEquals(query.query_all(("obj2",)), [("obj2",)])
+        self.assertEquals(query.queries.values(),
+                          ["SELECT string_attr FROM my_mock_sql_object"
+                           + " WHERE string_attr = ?"])
+        self.assertEquals(query.query_all(("obj3",)), [])
+
+    def test_prepared_query_transaction(self):
+        query = model.PreparedQuery(lambda marker: \
+            "SELECT COUNT(*) FROM my_mock_sql_object WHERE string_attr = "
+            + marker)
+        model.begin_transaction()
+        MyMockSQLObject(string_attr="obj1")
+        self.assertEquals(query.query_all(("obj1",)), [(1,)])
+        model.end_transaction(False)
+        self.assertEquals(query.query_all(("obj1",)), [(0,)])
+
+class ConnectionPool_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.db_path = tempfile.mktemp("db", "jcltest", DB_DIR)
+        self.db_url = "sqlite://" + self.db_path
+        self.pool = model.ConnectionPool(self.db_url, min_size=1, max_size=2,
+                                         idle_timeout=None,
+                                         checkout_timeout=0.1)
+
+    def tearDown(self):
+        self.pool.close()
+        if os.path.exists(self.db_path):
+            os.unlink(self.db_path)
+
+    def test_min_size(self):
+        self.assertEquals(self.pool.get_stats()["size"], 1)
+        self.assertEquals(self.pool.get_stats()["idle"], 1)
+
+    def test_checkout_same_thread(self):
+        connection1 = self.pool.checkout()
+        connection2 = self.pool.checkout()
+        self.assertFalse(connection1 is connection2)
+        stats = self.pool.get_stats()
+        self.assertEquals(stats["checkouts"], 2)
+        self.assertEquals(stats["in_use"], 2)
+        self.assertEquals(stats["waits"], 0)
+        self.pool.checkin(connection2)
+        self.assertEquals(self.pool.get_stats()["in_use"], 1)
+        self.pool.checkin(connection1)
+        self.assertEquals(self.pool.get_stats()["in_use"], 0)
+        self.assertEquals(self.pool.get_stats()["idle"], 2)
+
+    def test_checkout_same_thread_exhausted(self):
+        connections = [self.pool.checkout() for i in xrange(3)]
+        stats = self.pool.get_stats()
+        self.assertEquals(stats["size"], 3)
+        self.assertEquals(stats["waits"], 0)
+        for connection in connections:
+            self.pool.checkin(connection)
+        # connection opened beyond max_size is closed
+        self.assertEquals(self.pool.get_stats()["size"], 2)
+        self.assertEquals(self.pool.get_stats()["idle"], 2)
+
+    def test_checkout_reuse_thread_connection(self):
+        connection1 = self.pool.checkout()
+        self.pool.checkin(connection1)
+        connection2 = self.pool.checkout()
+        self.assertTrue(connection1 is connection2)
+        self.assertEquals(self.pool.get_stats()["size"], 1)
+        self.pool.checkin(connection2)
+
+    def test_connection_query(self):
+        self.pool.connection.query("CREATE TABLE test (id INTEGER)")
+        self.assertEquals(self.pool.connection.queryOne(
+                "SELECT COUNT(*) FROM test")[0], 0)
+        stats = self.pool.get_stats()
+        self.assertEquals(stats["in_use"], 0)
+        self.assertEquals(stats["size"], 1)
+
+    def test_sqlite_pragmas(self):
+        model.db_sqlite_pragmas = [("journal_mode", "wal"),
+                                   ("busy_timeout", 1000)]
+        try:
+            pool = model.ConnectionPool(self.db_url)
+        finally:
+            model.db_sqlite_pragmas = []
+        try:
+            self.assertEquals(pool.connection.queryOne(
+                    "PRAGMA journal_mode")[0], "wal")
+            self.assertEquals(pool.connection.queryOne(
+                    "PRAGMA busy_timeout")[0], 1000)
+        finally:
+            pool.close()
+
+    def test_checkout_other_thread(self):
+        connections = []
+        def checkout_thread():
+            connections.append(self.pool.checkout())
+            self.pool.checkin(connections[0])
+        connection = self.pool.checkout()
+        thread = threading.Thread(target=checkout_thread)
+        thread.start()
+        thread.join(1)
+        self.assertEquals(len(connections), 1)
+        self.assertFalse(connections[0] is connection)
+        stats = self.pool.get_stats()
+        self.assertEquals(stats["size"], 2)
+        self.assertEquals(stats["high_water_mark"], 2)
+        self.pool.checkin(connection)
+
+    def test_reclaim_dead_thread_connection(self):
+        def checkout_thread():
+            self.pool.checkout()
+        connection = self.pool.checkout()
+        thread = threading.Thread(target=checkout_thread)
+        thread.start()
+        thread.join(1)
+        self.assertEquals(self.pool.get_stats()["in_use"], 2)
+        connections = []
+        def checkout_thread2():
+            connections.append(self.pool.checkout())
+            self.pool.checkin(connections[0])
+        thread = threading.Thread(target=checkout_thread2)
+        thread.start()
+        thread.join(1)
+        # connection of the dead thread has been reused
+        self.assertEquals(len(connections), 1)
+        self.assertEquals(self.pool.get_stats()["size"], 2)
+        self.pool.checkin(connection)
+
+    def test_checkout_timeout(self):
+        errors = []
+        def checkout_timeout_thread():
+            try:
+                self.pool.checkout()
+            except model.ConnectionPoolTimeout:
+                errors.append(True)
+        connection_holder = threading.Event()
+        def hold_connection_thread():
+            connection = self.pool.checkout()
+            connection_holder.wait(1)
+            self.pool.checkin(connection)
+        holders = [threading.Thread(target=hold_connection_thread)
+                   for i in xrange(2)]
+        for holder in holders:
+            holder.start()
+        thread = threading.Thread(target=checkout_timeout_thread)
+        thread.start()
+        thread.join(1)
+        connection_holder.set()
+        for holder in holders:
+            holder.join(1)
+        self.assertEquals(errors, [True])
+        stats = self.pool.get_stats()
+        self.assertEquals(stats["waits"], 1)
+        self.assertTrue(stats["wait_time"] > 0)
+
+    def test_checkout_wait(self):
+        connections = []
+        def checkout_thread():
+            connection = self.pool.checkout()
+            connections.append(connection)
+            self.pool.checkin(connection)
+        self.pool.checkout_timeout = 1
+        connection_holder = threading.Event()
+        def hold_connection_thread():
+            connection = self.pool.checkout()
+            connections.append(connection)
+            connection_holder.wait(1)
+            self.pool.checkin(connection)
+        holders = [threading.Thread(target=hold_connection_thread)
+                   for i in xrange(2)]
+        for holder in holders:
+            holder.start()
+        thread = threading.Thread(target=checkout_thread)
+        thread.start()
+        connection_holder.set()
+        thread.join(2)
+        for holder in holders:
+            holder.join(1)
+        self.assertEquals(len(connections), 3)
+        self.assertEquals(self.pool.get_stats()["size"], 2)
+
+    def test_reap(self):
+        connections = []
+        def checkout_thread():
+            connections.append(self.pool.checkout())
+            self.pool.checkin(connections[0])
+        connection = self.pool.checkout()
+        thread = threading.Thread(target=checkout_thread)
+        thread.start()
+        thread.join(1)
+        self.pool.checkin(connection)
+        self.assertEquals(self.pool.get_stats()["size"], 2)
+        self.pool.idle_timeout = 0
+        self.pool.reap()
+        stats = self.pool.get_stats()
+        self.assertEquals(stats["size"], 1)
+        self.assertEquals(stats["reaped"], 1)
+
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(ModelModule_TestCase, 'test'))
-    from jcl.model.tests import account
+    suite.addTest(unittest.makeSuite(ConnectionPool_TestCase, 'test'))
+    from jcl.model.tests import account, context, migration, registry, \
+        writebehind, session, counters
     suite.addTest(account.suite())
+    suite.addTest(migration.suite())
+    suite.addTest(registry.suite())
+    suite.addTest(context.suite())
+    suite.addTest(writebehind.suite())
+    suite.addTest(session.suite())
+    suite.addTest(counters.suite())
     return suite
 
 if __name__ == '__main__':
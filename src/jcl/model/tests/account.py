@@ -218,12 +218,193 @@ class AccountModule_TestCase(JCLTestCase):
                 name="account11",
                 jid="accout11@jcl.test.com")
         accounts = account.get_accounts("user1@test.com")
+        self.assertTrue(isinstance(accounts, list))
+        self.assertEquals([_account.name for _account in accounts],
+                          ["account11", "account12"])
         i = 0
         for _account in accounts:
             i += 1
             self.assertEquals(_account.user.jid, "user1@test.com")
         self.assertEquals(i, 2)
 
+    def test_lookups_checkin_connection(self):
+        user1 = User(jid="user1@test.com")
+        Account(user=user1,
+                name="account11",
+                jid="accout11@jcl.test.com")
+        account.get_user("user1@test.com")
+        account.get_accounts_count("user1@test.com", ExampleAccount)
+        account.get_all_accounts_count()
+        account.get_accounts_for_users(["user1@test.com"])
+        list(account.get_all_accounts())
+        list(account.get_all_users())
+        self.assertEquals(model.pool.get_stats()["in_use"], 0)
+
+    def test_get_accounts_for_users(self):
+        user1 = User(jid="user1@test.com")
+        account11 = Account(user=user1,
+                            name="account11",
+                            jid="account11@jcl.test.com")
+        account12 = ExampleAccount(user=user1,
+                                   name="account12",
+                                   jid="account12@jcl.test.com",
+                                   enabled=False)
+        user2 = User(jid="user2@test.com")
+        account21 = ExampleAccount(user=user2,
+                                   name="account21",
+                                   jid="account21@jcl.test.com")
+        Account(user=User(jid="user3@test.com"),
+                name="account31",
+                jid="account31@jcl.test.com")
+        accounts = account.get_accounts_for_users(\
+            ["user2@test.com", "user1@test.com", "unknown@test.com",
+             "user2@test.com"], [Account, ExampleAccount], chunk_size=1)
+        self.assertEquals(accounts[Account],
+                          [("user2@test.com", account21),
+                           ("user1@test.com", account11),
+                           ("user1@test.com", account12)])
+        self.assertEquals(accounts[ExampleAccount],
+                          [("user2@test.com", account21),
+                           ("user1@test.com", account12)])
+        accounts = account.get_accounts_for_users(\
+            ["user1@test.com", "user2@test.com"], [ExampleAccount],
+            filter=(Account.q.enabled == True))
+        self.assertEquals(accounts[ExampleAccount],
+                          [("user2@test.com", account21)])
+        self.assertEquals(account.get_accounts_for_users([], [Account]),
+                          {Account: []})
+
+    def test_register_schema_process(self):
+        class FormField(object):
+            def __init__(self, value):
+                self.value = value
+        schema = ExampleAccount.get_register_schema()
+        self.assertTrue(schema.get_field("login").is_required("user1@test.com"))
+        self.assertFalse(schema.get_field("test_int").is_required(\
+                "user1@test.com"))
+        self.assertEquals(schema.get_field("test_enum").options,
+                          ("choice1", "choice2", "choice3"))
+        result = schema.process({"login": FormField("mylogin"),
+                                 "test_int": FormField("42")},
+                                "user1@test.com")
+        self.assertEquals(result, [("login", "mylogin"),
+                                   ("password", None),
+                                   ("store_password", True),
+                                   ("test_enum", "choice2"),
+                                   ("test_int", 42)])
+        self.assertRaises(FieldError, schema.process, {}, "user1@test.com")
+
+    def test_get_all_users_jid(self):
+        User(jid="user1@test.com")
+        User(jid="user2@test.com")
+        self.assertEquals(list(account.get_all_users_jid(chunk_size=1)),
+                          ["user1@test.com", "user2@test.com"])
+
+    def test_get_all_accounts_presence_info(self):
+        user1 = User(jid="user1@test.com")
+        Account(user=user1,
+                name="account11",
+                jid="account11@jcl.test.com")
+        ExampleAccount(user=User(jid="user2@test.com"),
+                       name="account21",
+                       jid="account21@jcl.test.com",
+                       enabled=False,
+                       error="error")
+        result = list(account.get_all_accounts_presence_info(chunk_size=1))
+        self.assertEquals(len(result), 2)
+        self.assertEquals((result[0].jid, result[0].name, result[0].user_jid,
+                           result[0].status, result[0].error),
+                          ("account11@jcl.test.com", "account11",
+                           "user1@test.com", account.OFFLINE, None))
+        self.assertTrue(result[0].enabled)
+        self.assertEquals((result[1].jid, result[1].name, result[1].user_jid,
+                           result[1].status, result[1].error),
+                          ("account21@jcl.test.com", "account21",
+                           "user2@test.com", account.OFFLINE, "error"))
+        self.assertFalse(result[1].enabled)
+        self.assertEquals(model.pool.get_stats()["in_use"], 0)
+        # other attributes are read from the Account object
+        self.assertEquals(result[1].test_int, 42)
+        self.assertTrue(isinstance(result[1].get_account(), ExampleAccount))
+
+    def test_get_accounts_page(self):
+        user1 = User(jid="user1@test.com")
+        account11 = Account(user=user1,
+                            name="account11",
+                            jid="account11@jcl.test.com")
+        account12 = ExampleAccount(user=user1,
+                                   name="account12",
+                                   jid="account12@jcl.test.com",
+                                   enabled=False)
+        account21 = ExampleAccount(user=User(jid="user2@test.com"),
+                                   name="account21",
+                                   jid="account21@jcl.test.com")
+        self.assertEquals(account.get_accounts_page(limit=2),
+                          [(account11.id, "user1@test.com", "account11",
+                            "Account"),
+                           (account12.id, "user1@test.com", "account12",
+                            "ExampleAccount")])
+        self.assertEquals(account.get_accounts_page(after=account11.id),
+                          [(account12.id, "user1@test.com", "account12",
+                            "ExampleAccount"),
+                           (account21.id, "user2@test.com", "account21",
+                            "ExampleAccount")])
+        self.assertEquals(account.get_accounts_page(before=account21.id,
+                                                    limit=1),
+                          [(account12.id, "user1@test.com", "account12",
+                            "ExampleAccount")])
+        self.assertEquals(\
+            account.get_accounts_page(filter=(Account.q.enabled == True)),
+            [(account11.id, "user1@test.com", "account11", "Account"),
+             (account21.id, "user2@test.com", "account21",
+              "ExampleAccount")])
+
+    def test_get_online_users_jid_page(self):
+        user1 = User(jid="user1@test.com")
+        account11 = Account(user=user1,
+                            name="account11",
+                            jid="account11@jcl.test.com")
+        account12 = Account(user=user1,
+                            name="account12",
+                            jid="account12@jcl.test.com")
+        account11.status = account.ONLINE
+        account12.status = "away"
+        user2 = User(jid="user2@test.com")
+        Account(user=user2,
+                name="account21",
+                jid="account21@jcl.test.com")
+        user3 = User(jid="user3@test.com")
+        account31 = Account(user=user3,
+                            name="account31",
+                            jid="account31@jcl.test.com")
+        account31.status = "dnd"
+        self.assertEquals(account.get_online_users_count(), 2)
+        self.assertEquals(account.get_online_users_jid_page(limit=1),
+                          [(user1.id, "user1@test.com")])
+        self.assertEquals(account.get_online_users_jid_page(after=user1.id),
+                          [(user3.id, "user3@test.com")])
+        self.assertEquals(account.get_online_users_jid_page(after=user3.id),
+                          [])
+
+    def test_set_accounts_status(self):
+        user1 = User(jid="user1@test.com")
+        account11 = Account(user=user1,
+                            name="account11",
+                            jid="account11@jcl.test.com")
+        account12 = ExampleAccount(user=user1,
+                                   name="account12",
+                                   jid="account12@jcl.test.com")
+        account12.status = account.ONLINE
+        # lastlogin as stored by the database
+        account12.expire()
+        lastlogin = account12.lastlogin
+        account.set_accounts_status([(account11, account.ONLINE),
+                                     (account12, account.DND)])
+        self.assertEquals(account11.status, account.ONLINE)
+        self.assertEquals(account12.status, account.DND)
+        self.assertEquals(account12.lastlogin, lastlogin)
+        account.set_accounts_status([])
+
     def test_get_accounts_type(self):
         user1 = User(jid="user1@test.com")
         Account(user=user1,
@@ -284,6 +465,18 @@ class InheritableAccount_TestCase(JCLTestCase):
                     pass
         model.db_disconnect()
 
+    def test_get_register_schema(self):
+        schema = self.account_class.get_register_schema()
+        self.assertTrue(self.account_class.get_register_schema() is schema)
+        field_names = [field[0] for field
+                       in self.account_class.get_register_fields()
+                       if field[0] is not None]
+        self.assertEquals([field.name for field in schema.fields],
+                          field_names)
+        for field_name in field_names:
+            self.assertEquals(schema.get_field(field_name).name, field_name)
+        self.assertEquals(schema.get_field("unknown"), None)
+
 class Account_TestCase(InheritableAccount_TestCase):
     def setUp(self):
         JCLTestCase.setUp(self, tables=[User, Account, ExampleAccount])
@@ -327,6 +520,11 @@ class PresenceAccount_TestCase(InheritableAccount_TestCase):
         model.db_disconnect()
         self.account_class = PresenceAccount
 
+    def test_get_accounts_page_class_name(self):
+        self.assertEquals(account.get_accounts_page(),
+                          [(self.account.id, "test1@test.com", "account11",
+                            "PresenceAccountExample")])
+
     def test_get_presence_actions_fields(self):
         fields = self.account_class.get_presence_actions_fields()
         self.assertEquals(len(fields), 6)
@@ -0,0 +1,138 @@
+##
+## context.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+
+import unittest
+
+import jcl.model as model
+from jcl.model import account, context
+from jcl.model.account import Account, PresenceAccount, User, LegacyJID
+
+from jcl.model.tests.account import ExampleAccount
+from jcl.tests import JCLTestCase
+
+class RequestContext_TestCase(JCLTestCase):
+    def setUp(self):
+        JCLTestCase.setUp(self, tables=[User, Account, PresenceAccount,
+                                        ExampleAccount, LegacyJID])
+        model.db_connect()
+        self.user1 = User(jid="user1@test.com")
+        self.account11 = Account(user=self.user1,
+                                 name="account11",
+                                 jid="account11@jcl.test.com")
+        self.account12 = ExampleAccount(user=self.user1,
+                                        name="account12",
+                                        jid="account12@jcl.test.com")
+        self.user2 = User(jid="user2@test.com")
+        self.account21 = Account(user=self.user2,
+                                 name="account11",
+                                 jid="account11@jcl.test.com")
+        LegacyJID(legacy_address="legacy1@test.com",
+                  jid="legacy1%test.com@jcl.test.com",
+                  account=self.account11)
+        model.db_disconnect()
+
+    def tearDown(self):
+        while model.get_request_contexts():
+            context.end()
+        JCLTestCase.tearDown(self)
+
+    def test_begin_end(self):
+        context1 = context.begin("user1@test.com")
+        self.assertEquals(model.get_request_context("user1@test.com"),
+                          context1)
+        self.assertEquals(model.get_request_context("user2@test.com"), None)
+        self.assertEquals(context.begin("user1@test.com"), context1)
+        self.assertEquals(context1.depth, 2)
+        context2 = context.begin("user2@test.com")
+        self.assertNotEquals(context2, context1)
+        self.assertEquals(model.get_request_context("user1@test.com"), None)
+        context.end()
+        context.end()
+        self.assertEquals(context1.depth, 1)
+        self.assertEquals(model.get_request_context("user1@test.com"),
+                          context1)
+        context.end()
+        self.assertEquals(model.get_request_context("user1@test.com"), None)
+        self.assertEquals(model.get_request_contexts(), [])
+
+    def test_get_user(self):
+        context1 = context.begin("user1@test.com")
+        self.assertEquals(account.get_user("user1@test.com"), self.user1)
+        self.assertEquals(account.get_user("user1@test.com"), self.user1)
+        self.assertEquals(context1.misses, 1)
+        self.assertEquals(context1.hits, 1)
+        self.assertEquals(account.get_user("user2@test.com"), self.user2)
+        self.assertEquals(context1.misses, 1)
+
+    def test_get_accounts(self):
+        context1 = context.begin("user1@test.com")
+        self.assertEquals(list(account.get_accounts("user1@test.com")),
+                          [self.account11, self.account12])
+        self.assertEquals(list(account.get_accounts("user1@test.com",
+                                                    ExampleAccount)),
+                          [self.account12])
+        self.assertEquals(account.get_account("user1@test.com", "account12"),
+                          self.account12)
+        self.assertEquals(account.get_accounts_count("user1@test.com"), 2)
+        self.assertEquals(context1.misses, 1)
+        self.assertEquals(context1.hits, 3)
+        # the user has been loaded with its accounts
+        self.assertEquals(account.get_user("user1@test.com"), self.user1)
+        self.assertEquals(context1.misses, 1)
+        self.assertEquals(context1.hits, 4)
+
+    def test_get_legacy_jids(self):
+        context1 = context.begin("user1@test.com")
+        legacy_jids = list(account.get_legacy_jids("user1@test.com"))
+        self.assertEquals(len(legacy_jids), 1)
+        self.assertEquals(legacy_jids[0].legacy_address, "legacy1@test.com")
+        account.get_legacy_jids("user1@test.com")
+        self.assertEquals(context1.misses, 1)
+        self.assertEquals(context1.hits, 1)
+
+    def test_invalidate_on_create(self):
+        context1 = context.begin("user1@test.com")
+        self.assertEquals(len(list(account.get_accounts("user1@test.com"))),
+                          2)
+        model.db_connect()
+        account13 = Account(user=self.user1,
+                            name="account13",
+                            jid="account13@jcl.test.com")
+        model.db_disconnect()
+        self.assertEquals(list(account.get_accounts("user1@test.com")),
+                          [self.account11, self.account12, account13])
+        self.assertEquals(context1.misses, 2)
+
+    def test_end_clears_cache(self):
+        context.begin("user1@test.com")
+        account.get_user("user1@test.com")
+        context.end()
+        context1 = context.begin("user1@test.com")
+        account.get_user("user1@test.com")
+        self.assertEquals(context1.misses, 1)
+        self.assertEquals(context1.hits, 0)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(RequestContext_TestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,153 @@
+##
+## counters.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+
+import unittest
+
+import jcl.model as model
+from jcl.model import account, counters
+from jcl.model.account import Account, PresenceAccount, User, LegacyJID
+
+from jcl.model.tests.account import ExampleAccount
+from jcl.tests import JCLTestCase
+
+class AccountCounters_TestCase(JCLTestCase):
+    def setUp(self):
+        JCLTestCase.setUp(self, tables=[User, Account, PresenceAccount,
+                                        ExampleAccount, LegacyJID])
+        model.db_connect()
+        self.user1 = User(jid="user1@test.com")
+        self.account11 = Account(user=self.user1,
+                                 name="account11",
+                                 jid="account11@jcl.test.com")
+        self.account12 = ExampleAccount(user=self.user1,
+                                        name="account12",
+                                        jid="account12@jcl.test.com",
+                                        enabled=False)
+        model.db_disconnect()
+        self.counters = counters.enable(0)
+
+    def tearDown(self):
+        counters.disable()
+        JCLTestCase.tearDown(self)
+
+    def test_get_counts(self):
+        self.assertEquals(self.counters.get_counts(),
+                          {counters.REGISTERED: 2,
+                           counters.DISABLED: 1,
+                           counters.ONLINE: 0})
+        self.assertEquals(self.counters.get_counts(),
+                          {counters.REGISTERED: 2,
+                           counters.DISABLED: 1,
+                           counters.ONLINE: 0})
+        # computed once from the database
+        self.assertEquals(self.counters.get_stats()["reconciliations"], 1)
+
+    def test_create_destroy(self):
+        self.counters.get_counts()
+        model.db_connect()
+        account13 = ExampleAccount(user=self.user1,
+                                   name="account13",
+                                   jid="account13@jcl.test.com",
+                                   enabled=False)
+        self.assertEquals(self.counters.get(counters.REGISTERED), 3)
+        self.assertEquals(self.counters.get(counters.DISABLED), 2)
+        account13.destroySelf()
+        self.account11.status = account.ONLINE
+        self.account11.destroySelf()
+        model.db_disconnect()
+        self.assertEquals(self.counters.get_counts(),
+                          {counters.REGISTERED: 1,
+                           counters.DISABLED: 1,
+                           counters.ONLINE: 0})
+
+    def test_set_enabled_status(self):
+        self.counters.get_counts()
+        model.db_connect()
+        self.account12.enabled = True
+        self.account11.enabled = True
+        self.account11.status = account.ONLINE
+        self.account11.status = account.DND
+        self.account12.status = account.ONLINE
+        self.account12.status = account.OFFLINE
+        model.db_disconnect()
+        self.assertEquals(self.counters.get_counts(),
+                          {counters.REGISTERED: 2,
+                           counters.DISABLED: 0,
+                           counters.ONLINE: 1})
+        self.assertEquals(self.counters.reconcile(),
+                          self.counters.get_counts())
+        self.assertEquals(self.counters.get_stats()["drifts"], 0)
+
+    def test_set_accounts_status(self):
+        self.counters.get_counts()
+        account.set_accounts_status([(self.account11, account.ONLINE),
+                                     (self.account12, account.DND)])
+        self.assertEquals(self.counters.get(counters.ONLINE), 2)
+        model.db_connect()
+        account.set_all_accounts_offline()
+        model.db_disconnect()
+        self.assertEquals(self.counters.get(counters.ONLINE), 0)
+        self.assertEquals(self.counters.get_stats()["reconciliations"], 2)
+
+    def test_reconcile_drift(self):
+        self.counters.get_counts()
+        model.db_connect()
+        connection = model.hub.getConnection()
+        connection.query("UPDATE account SET enabled = "
+                         + connection.sqlrepr(False))
+        model.db_disconnect()
+        self.assertEquals(self.counters.get(counters.DISABLED), 1)
+        self.counters.reconcile()
+        self.assertEquals(self.counters.get(counters.DISABLED), 2)
+        self.assertEquals(self.counters.get_stats()["drifts"], 1)
+
+    def test_rollback(self):
+        self.counters.get_counts()
+        model.begin_transaction()
+        ExampleAccount(user=self.user1,
+                       name="account13",
+                       jid="account13@jcl.test.com")
+        model.end_transaction(False)
+        self.assertEquals(self.counters.get(counters.REGISTERED), 2)
+
+    def test_get_accounts_count(self):
+        self.account11.status = account.ONLINE
+        self.assertEquals(account.get_registered_accounts_count(), 2)
+        self.assertEquals(account.get_disabled_accounts_count(), 1)
+        self.assertEquals(account.get_online_accounts_count(), 1)
+        counters.disable()
+        self.assertEquals(model.account_counters, None)
+        self.assertEquals(account.get_registered_accounts_count(), 2)
+        self.assertEquals(account.get_disabled_accounts_count(), 1)
+        self.assertEquals(account.get_online_accounts_count(), 1)
+
+    def test_run(self):
+        counters.disable()
+        self.counters = counters.enable(0.1)
+        self.counters.thread.join(0.5)
+        self.assertTrue(self.counters.get_stats()["reconciliations"] > 0)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(AccountCounters_TestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,161 @@
+##
+## migration.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+
+import unittest
+
+from sqlobject.dberrors import DuplicateEntryError
+
+import jcl.model as model
+from jcl.model import migration
+from jcl.model.migration import SchemaVersion
+from jcl.model.account import Account, PresenceAccount, User, LegacyJID
+from jcl.model.session import CommandSession
+
+from jcl.tests import JCLTestCase
+
+class Migration_TestCase(JCLTestCase):
+    def setUp(self):
+        JCLTestCase.setUp(self)
+        # tables are created by migrations
+        self.tables = [SchemaVersion, CommandSession, LegacyJID,
+                       PresenceAccount, Account, User]
+
+    def get_indexes(self, table):
+        return dict([(index[1], index[2]) for index in
+                     model.hub.threadConnection.queryAll(\
+                    "PRAGMA index_list(" + table + ")")])
+
+    def test_migrate_new_db(self):
+        model.db_connect()
+        self.assertEquals(migration.migrate(), 5)
+        self.assertEquals(migration.get_schema_version("jcl"), 5)
+        for table in ["user_table", "account", "presence_account",
+                      "legacy_j_id", "command_session"]:
+            self.assertTrue(model.hub.threadConnection.tableExists(table))
+        self.assertTrue("user_table_jid_idx" in self.get_indexes("user_table"))
+        self.assertTrue("legacy_j_id_account_id_idx"
+                        in self.get_indexes("legacy_j_id"))
+        indexes = self.get_indexes("account")
+        self.assertTrue("account_name_idx" in indexes)
+        self.assertTrue("account_jid_idx" in indexes)
+        self.assertTrue("account_status_idx" in indexes)
+        self.assertTrue(indexes["account_user_table_id_name_idx"])
+        model.db_disconnect()
+
+    def test_migrate_up_to_date(self):
+        model.db_connect()
+        migration.migrate()
+        self.assertEquals(migration.migrate(), 5)
+        self.assertEquals(SchemaVersion.select().count(), 1)
+        model.db_disconnect()
+
+    def test_migrate_unique_account_name(self):
+        model.db_connect()
+        migration.migrate()
+        user1 = User(jid="test1@test.com")
+        Account(user=user1, name="account1", jid="account1@jcl.test.com")
+        self.assertRaises(DuplicateEntryError, Account, user=user1,
+                          name="account1", jid="account1@jcl.test.com")
+        model.db_disconnect()
+
+    def test_migrate_duplicate_account_name(self):
+        model.db_connect()
+        migration.migrate(migrations=migration.jcl_migrations[:3])
+        user1 = User(jid="test1@test.com")
+        Account(user=user1, name="account1", jid="account1@jcl.test.com")
+        Account(user=user1, name="account1", jid="account1@jcl.test.com")
+        self.assertEquals(migration.migrate(), 5)
+        self.assertFalse(\
+            self.get_indexes("account")["account_user_table_id_name_idx"])
+        model.db_disconnect()
+
+    def test_get_text_index_column(self):
+        model.db_connect()
+        connection = model.hub.threadConnection
+        self.assertEquals(migration.get_text_index_column(connection, "jid"),
+                          "jid")
+        connection.dbName = "mysql"
+        try:
+            self.assertEquals(\
+                migration.get_text_index_column(connection, "jid"),
+                "jid(191)")
+        finally:
+            del connection.dbName
+        model.db_disconnect()
+
+    def test_migrate_2008_11_08(self):
+        model.db_connect()
+        connection = model.hub.threadConnection
+        connection.query("CREATE TABLE user (id INTEGER PRIMARY KEY, "
+                         + "jid TEXT, has_received_motd BOOLEAN, "
+                         + "child_name VARCHAR (255))")
+        connection.query("CREATE TABLE account (id INTEGER PRIMARY KEY, "
+                         + "name TEXT, jid TEXT, status TEXT, error TEXT, "
+                         + "enabled BOOLEAN, lastlogin TIMESTAMP, "
+                         + "user_id INT CONSTRAINT user_id_exists "
+                         + "REFERENCES user(id), child_name VARCHAR (255))")
+        connection.query("INSERT INTO user VALUES (1, 'test1@test.com', 0, "
+                         + "NULL)")
+        connection.query("INSERT INTO account VALUES (1, 'account1', "
+                         + "'account1@jcl.test.com', 'offline', NULL, 1, "
+                         + "NULL, 1, NULL)")
+        self.assertEquals(migration.migrate(), 5)
+        self.assertFalse(connection.tableExists("user"))
+        self.assertFalse(connection.tableExists("account_backup"))
+        account1 = Account.get(1)
+        self.assertEquals(account1.name, "account1")
+        self.assertEquals(account1.user.jid, "test1@test.com")
+        model.db_disconnect()
+
+    def test_migrate_component_schema(self):
+        applied = []
+        def upgrade(connection):
+            applied.append(connection)
+        model.db_connect()
+        migration.migrate()
+        self.assertEquals(migration.migrate("component",
+                                            [(1, "first", upgrade),
+                                             (2, "second", upgrade)]), 2)
+        self.assertEquals(len(applied), 2)
+        self.assertEquals(migration.migrate("component",
+                                            [(1, "first", upgrade),
+                                             (2, "second", upgrade),
+                                             (3, "third", upgrade)]), 3)
+        self.assertEquals(len(applied), 3)
+        self.assertEquals(migration.get_schema_version("jcl"), 5)
+        model.db_disconnect()
+
+    def test_migrate_failure(self):
+        def upgrade(connection):
+            connection.query("CREATE TABLE migration_test (id INTEGER)")
+            raise Exception("migration error")
+        model.db_connect()
+        self.assertRaises(Exception, migration.migrate, "component",
+                          [(1, "failing", upgrade)])
+        self.assertEquals(migration.get_schema_version("component"), 0)
+        model.db_disconnect()
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(Migration_TestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,186 @@
+##
+## registry.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+
+import unittest
+
+import jcl.model as model
+from jcl.model import account, registry
+from jcl.model.account import Account, PresenceAccount, User, LegacyJID
+
+from jcl.model.tests.account import ExampleAccount
+from jcl.tests import JCLTestCase
+
+class AccountRegistry_TestCase(JCLTestCase):
+    def setUp(self):
+        JCLTestCase.setUp(self, tables=[User, Account, PresenceAccount,
+                                        ExampleAccount, LegacyJID])
+        model.db_connect()
+        self.user1 = User(jid="user1@test.com")
+        self.account11 = Account(user=self.user1,
+                                 name="account11",
+                                 jid="account11@jcl.test.com")
+        self.account12 = ExampleAccount(user=self.user1,
+                                        name="account12",
+                                        jid="account12@jcl.test.com")
+        self.user2 = User(jid="user2@test.com")
+        self.account21 = Account(user=self.user2,
+                                 name="account11",
+                                 jid="account11@jcl.test.com")
+        LegacyJID(legacy_address="legacy1@test.com",
+                  jid="legacy1%test.com@jcl.test.com",
+                  account=self.account11)
+        model.db_disconnect()
+        self.registry = registry.enable()
+
+    def tearDown(self):
+        registry.disable()
+        JCLTestCase.tearDown(self)
+
+    def test_get_user(self):
+        self.assertEquals(account.get_user("user1@test.com"), self.user1)
+        self.assertEquals(self.registry.get_stats()["misses"], 1)
+        self.assertEquals(account.get_user("user1@test.com"), self.user1)
+        self.assertEquals(self.registry.get_stats()["misses"], 1)
+        self.assertEquals(self.registry.get_stats()["hits"], 1)
+        self.assertEquals(account.get_user("unknown@test.com"), None)
+
+    def test_get_account(self):
+        _account = account.get_account("user1@test.com", "account11")
+        self.assertEquals(_account, self.account11)
+        self.assertEquals(account.get_account("user2@test.com", "account11"),
+                          self.account21)
+        self.assertEquals(account.get_account("user1@test.com", "account13"),
+                          None)
+        self.assertEquals(account.get_account("user1@test.com", "account11",
+                                              ExampleAccount), None)
+        self.assertEquals(account.get_account("user1@test.com", "account12",
+                                              ExampleAccount),
+                          self.account12)
+
+    def test_get_accounts(self):
+        self.assertEquals(account.get_accounts("user1@test.com"),
+                          [self.account11, self.account12])
+        self.assertEquals(account.get_accounts("user1@test.com",
+                                               ExampleAccount),
+                          [self.account12])
+        self.assertEquals(account.get_accounts("unknown@test.com"), [])
+        self.assertEquals(self.registry.get_stats()["misses"], 2)
+
+    def test_get_legacy_jids(self):
+        legacy_jids = account.get_legacy_jids("user1@test.com")
+        self.assertEquals(len(legacy_jids), 1)
+        self.assertEquals(legacy_jids[0].legacy_address, "legacy1@test.com")
+        self.assertEquals(account.get_legacy_jids("user2@test.com"), [])
+        model.db_connect()
+        LegacyJID(legacy_address="legacy2@test.com",
+                  jid="legacy2%test.com@jcl.test.com",
+                  account=self.account21)
+        model.db_disconnect()
+        self.assertEquals(len(account.get_legacy_jids("user2@test.com")), 1)
+
+    def test_create_account(self):
+        self.assertEquals(len(account.get_accounts("user2@test.com")), 1)
+        model.db_connect()
+        account22 = ExampleAccount(user=self.user2,
+                                   name="account22",
+                                   jid="account22@jcl.test.com")
+        model.db_disconnect()
+        self.assertEquals(account.get_accounts("user2@test.com"),
+                          [self.account21, account22])
+        self.assertEquals(account.get_account("user2@test.com", "account22"),
+                          account22)
+
+    def test_destroy_account(self):
+        self.assertEquals(account.get_account("user1@test.com", "account12"),
+                          self.account12)
+        model.db_connect()
+        self.account12.destroySelf()
+        model.db_disconnect()
+        self.assertEquals(account.get_account("user1@test.com", "account12"),
+                          None)
+        self.assertEquals(account.get_accounts("user1@test.com"),
+                          [self.account11])
+
+    def test_destroy_user(self):
+        self.assertEquals(account.get_user("user2@test.com"), self.user2)
+        model.db_connect()
+        self.account21.destroySelf()
+        self.user2.destroySelf()
+        model.db_disconnect()
+        self.assertEquals(account.get_user("user2@test.com"), None)
+
+    def test_set_account_name(self):
+        self.assertEquals(account.get_account("user1@test.com", "account12"),
+                          self.account12)
+        model.db_connect()
+        self.account12.name = "account13"
+        model.db_disconnect()
+        self.assertEquals(account.get_account("user1@test.com", "account12"),
+                          None)
+        self.assertEquals(account.get_account("user1@test.com", "account13"),
+                          self.account12)
+
+    def test_set_account_user(self):
+        self.assertEquals(len(account.get_accounts("user1@test.com")), 2)
+        self.assertEquals(len(account.get_accounts("user2@test.com")), 1)
+        model.db_connect()
+        self.account12.user = self.user2
+        model.db_disconnect()
+        self.assertEquals(account.get_accounts("user1@test.com"),
+                          [self.account11])
+        self.assertEquals(account.get_accounts("user2@test.com"),
+                          [self.account12, self.account21])
+
+    def test_set_attribute_write_through(self):
+        _account = account.get_account("user1@test.com", "account11")
+        model.db_connect()
+        _account.status = account.ONLINE
+        self.assertEquals(Account.select(\
+                Account.q._status == account.ONLINE).count(), 1)
+        model.db_disconnect()
+        self.assertEquals(account.get_account("user1@test.com",
+                                              "account11").status,
+                          account.ONLINE)
+
+    def test_preload(self):
+        self.registry.load()
+        self.assertTrue(self.registry.get_stats()["complete"])
+        self.assertEquals(account.get_user("user1@test.com"), self.user1)
+        self.assertEquals(account.get_accounts("user1@test.com"),
+                          [self.account11, self.account12])
+        self.assertEquals(account.get_user("unknown@test.com"), None)
+        self.assertEquals(self.registry.get_stats()["misses"], 0)
+        model.db_connect()
+        user3 = User(jid="unknown@test.com")
+        model.db_disconnect()
+        self.assertEquals(account.get_user("unknown@test.com"), user3)
+        self.assertEquals(self.registry.get_stats()["misses"], 1)
+
+    def test_disable(self):
+        registry.disable()
+        self.assertEquals(len(account.get_accounts("user1@test.com")), 2)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(AccountRegistry_TestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,117 @@
+##
+## session.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+
+import unittest
+import time
+
+import jcl.model as model
+from jcl.model.session import SessionStore, MemorySessionBackend, \
+    SQLSessionBackend, CommandSession
+
+from jcl.tests import JCLTestCase
+
+class SessionStore_TestCase(unittest.TestCase):
+    def setUp(self):
+        self.store = SessionStore(ttl=60, max_size=2)
+
+    def test_default_backend(self):
+        self.assertTrue(isinstance(self.store.backend, MemorySessionBackend))
+        self.store["session1"] = (1, {})
+        # sessions are not kept once dropped from memory
+        self.store.sessions.clear()
+        self.assertFalse(self.store.has_key("session1"))
+
+    def test_set_get(self):
+        self.store["session1"] = (1, {"field": ["value"]})
+        self.assertTrue(self.store.has_key("session1"))
+        self.assertTrue("session1" in self.store)
+        self.assertEquals(self.store["session1"], (1, {"field": ["value"]}))
+        self.assertFalse(self.store.has_key("session2"))
+        self.assertRaises(KeyError, self.store.__getitem__, "session2")
+
+    def test_del(self):
+        self.store["session1"] = (1, {})
+        del self.store["session1"]
+        self.assertFalse(self.store.has_key("session1"))
+        self.assertRaises(KeyError, self.store.__delitem__, "session1")
+
+    def test_new_session_id(self):
+        session_id1 = self.store.new_session_id("add_user")
+        session_id2 = self.store.new_session_id("add_user")
+        self.assertTrue(session_id1.startswith("add_user:"))
+        self.assertNotEquals(session_id1, session_id2)
+
+    def test_ttl(self):
+        self.store["session1"] = (1, {})
+        self.store.sessions["session1"][2] -= 61
+        self.assertFalse(self.store.has_key("session1"))
+        self.assertEquals(self.store.get_stats()["expired"], 1)
+
+    def test_expire(self):
+        self.store["session1"] = (1, {})
+        self.store["session2"] = (1, {})
+        self.store.sessions["session1"][2] -= 61
+        self.store.expire()
+        self.assertEquals(len(self.store), 1)
+        self.assertTrue(self.store.has_key("session2"))
+
+    def test_max_size(self):
+        self.store["session1"] = (1, {})
+        self.store["session2"] = (1, {})
+        self.store.sessions["session1"][2] -= 2
+        self.store.sessions["session2"][2] -= 1
+        # session1 is the least recently used one
+        self.store["session3"] = (1, {})
+        self.assertEquals(len(self.store), 2)
+        self.assertFalse(self.store.has_key("session1"))
+        self.assertTrue(self.store.has_key("session2"))
+        self.assertEquals(self.store.get_stats()["evicted"], 1)
+
+class SQLSessionBackend_TestCase(JCLTestCase):
+    def setUp(self):
+        JCLTestCase.setUp(self, tables=[CommandSession])
+        self.store = SessionStore(SQLSessionBackend(), ttl=60)
+
+    def test_restart(self):
+        self.store["session1"] = (1, {"field": [u"value"]})
+        self.store["session1"][1]["field2"] = [u"value2"]
+        self.store.save("session1")
+        store = SessionStore(SQLSessionBackend(), ttl=60)
+        self.assertEquals(store["session1"],
+                          (1, {"field": [u"value"], "field2": [u"value2"]}))
+        del store["session1"]
+        model.db_connect()
+        self.assertEquals(CommandSession.select().count(), 0)
+        model.db_disconnect()
+
+    def test_expire(self):
+        self.store["session1"] = (2, {})
+        self.store.expire(time.time() + 61)
+        store = SessionStore(SQLSessionBackend(), ttl=60)
+        self.assertFalse(store.has_key("session1"))
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(SessionStore_TestCase, 'test'))
+    suite.addTest(unittest.makeSuite(SQLSessionBackend_TestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
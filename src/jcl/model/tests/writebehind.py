@@ -0,0 +1,117 @@
+##
+## writebehind.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+
+import unittest
+
+import jcl.model as model
+from jcl.model import account, writebehind
+from jcl.model.account import Account, PresenceAccount, User, LegacyJID
+
+from jcl.model.tests.account import ExampleAccount
+from jcl.tests import JCLTestCase
+
+class WriteBehindBuffer_TestCase(JCLTestCase):
+    def setUp(self):
+        JCLTestCase.setUp(self, tables=[User, Account, PresenceAccount,
+                                        ExampleAccount, LegacyJID])
+        model.db_connect()
+        self.user1 = User(jid="user1@test.com")
+        self.account11 = Account(user=self.user1,
+                                 name="account11",
+                                 jid="account11@jcl.test.com")
+        self.account12 = ExampleAccount(user=self.user1,
+                                        name="account12",
+                                        jid="account12@jcl.test.com")
+        model.db_disconnect()
+        self.buffer = writebehind.enable(0)
+
+    def tearDown(self):
+        writebehind.disable()
+        JCLTestCase.tearDown(self)
+
+    def get_db_status(self, _account):
+        model.db_connect()
+        connection = model.hub.getConnection()
+        status = connection.queryOne("SELECT status FROM account WHERE id = "
+                                     + str(_account.id))[0]
+        model.db_disconnect()
+        return status
+
+    def test_set_status(self):
+        lastlogin = self.account11.lastlogin
+        self.account11.status = account.ONLINE
+        self.account11.error = "error"
+        self.assertEquals(self.account11.status, account.ONLINE)
+        self.assertEquals(self.account11.error, "error")
+        self.assertNotEquals(self.account11.lastlogin, lastlogin)
+        self.assertEquals(self.get_db_status(self.account11), account.OFFLINE)
+        self.assertEquals(self.buffer.get_stats()["pending"], 1)
+
+    def test_flush(self):
+        self.account11.status = account.ONLINE
+        self.account12.status = account.DND
+        self.account12.error = "error"
+        self.buffer.flush()
+        stats = self.buffer.get_stats()
+        self.assertEquals(stats["pending"], 0)
+        self.assertEquals(stats["flushes"], 1)
+        # one UPDATE per column
+        self.assertEquals(stats["updates"], 3)
+        self.assertEquals(self.get_db_status(self.account11), account.ONLINE)
+        self.assertEquals(self.get_db_status(self.account12), account.DND)
+        model.db_connect()
+        self.assertEquals(self.account12.error, "error")
+        model.db_disconnect()
+
+    def test_destroy(self):
+        self.account11.status = account.ONLINE
+        model.db_connect()
+        self.account11.destroySelf()
+        model.db_disconnect()
+        self.assertEquals(self.buffer.get_stats()["pending"], 0)
+
+    def test_set_all_accounts_offline(self):
+        model.db_connect()
+        self.account11.status = account.ONLINE
+        account.set_all_accounts_offline()
+        model.db_disconnect()
+        self.assertEquals(self.buffer.get_stats()["pending"], 0)
+        self.assertEquals(self.get_db_status(self.account11), account.OFFLINE)
+
+    def test_disable(self):
+        self.account11.status = account.ONLINE
+        writebehind.disable()
+        self.assertEquals(model.write_behind, None)
+        self.assertEquals(self.get_db_status(self.account11), account.ONLINE)
+
+    def test_run(self):
+        writebehind.disable()
+        self.buffer = writebehind.enable(0.1)
+        self.account11.status = account.ONLINE
+        self.buffer.thread.join(0.5)
+        self.assertEquals(self.get_db_status(self.account11), account.ONLINE)
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(WriteBehindBuffer_TestCase, 'test'))
+    return suite
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
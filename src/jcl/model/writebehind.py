@@ -0,0 +1,203 @@
+##
+## writebehind.py
+## Login : David Rousselie <dax@happycoders.org>
+##
+## Copyright (C) 2009 David Rousselie
+## This program is free software; you can redistribute it and/or modify
+## it under the terms of the GNU General Public License as published by
+## the Free Software Foundation; either version 2 of the License, or
+## (at your option) any later version.
+##
+## This program is distributed in the hope that it will be useful,
+## but WITHOUT ANY WARRANTY; without even the implied warranty of
+## MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+## GNU General Public License for more details.
+##
+## You should have received a copy of the GNU General Public License
+## along with this program; if not, write to the Free Software
+## Foundation, Inc., 59 Temple Place, Suite 330, Boston, MA 02111-1307 USA
+##
+"""Write-behind buffer of frequently rewritten Account columns.
+
+When enabled, setting the status (and so lastlogin) or the error of an
+Account does not write it to the database: the value is kept in memory and
+returned by later reads of any instance of the account. Pending values are
+written by a background thread every `interval` seconds with one UPDATE
+per column, in a single transaction, and when the buffer is disabled.
+Raw queries (get_all_accounts_presence_info for instance) may see values up
+to `interval` seconds old.
+"""
+
+__revision__ = ""
+
+import logging
+import threading
+
+import jcl.model as model
+from jcl.model.account import Account
+
+# Account columns handled by the buffer
+COLUMNS = ["_status", "lastlogin", "error"]
+
+class WriteBehindBuffer(object):
+    """Pending Account column values indexed by account id"""
+
+    def __init__(self, interval=5):
+        self.__logger = logging.getLogger("jcl.model.writebehind.WriteBehindBuffer")
+        self.interval = interval
+        self.lock = threading.Lock()
+        # account id -> (account, {column: value})
+        self.pending = {}
+        self.running = False
+        self.event = threading.Event()
+        self.thread = None
+        self.flushes = 0
+        self.writes = 0
+        self.updates = 0
+
+    def get(self, _account, column, load_func):
+        """
+        Return pending `column` value of `_account`, the one returned by
+        `load_func` if none.
+        """
+        self.lock.acquire()
+        try:
+            entry = self.pending.get(_account.id)
+            if entry is not None and column in entry[1]:
+                return entry[1][column]
+        finally:
+            self.lock.release()
+        return load_func()
+
+    def set(self, _account, column, value):
+        """Keep `value` of `_account` `column` until the next flush"""
+        self.lock.acquire()
+        try:
+            entry = self.pending.setdefault(_account.id, (_account, {}))
+            entry[1][column] = value
+            self.writes += 1
+        finally:
+            self.lock.release()
+
+    def discard(self, _account):
+        """Drop pending values of `_account` (destroyed)"""
+        self.lock.acquire()
+        try:
+            self.pending.pop(_account.id, None)
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        """Write pending values with one UPDATE per column"""
+        self.lock.acquire()
+        try:
+            flushed = [(account_id, _account, values.copy())
+                       for (account_id, (_account, values))
+                       in self.pending.items()]
+        finally:
+            self.lock.release()
+        if not flushed:
+            return
+        model.begin_transaction()
+        try:
+            connection = model.hub.getConnection()
+            for column in COLUMNS:
+                cases = [(account_id, values[column])
+                         for (account_id, _account, values) in flushed
+                         if column in values]
+                if not cases:
+                    continue
+                self.__update(connection, column, cases)
+        except:
+            model.end_transaction(False)
+            raise
+        model.end_transaction()
+        self.lock.acquire()
+        try:
+            # values set while flushing are kept for the next flush
+            for (account_id, _account, values) in flushed:
+                entry = self.pending.get(account_id)
+                if entry is not None and entry[1] == values:
+                    del self.pending[account_id]
+                    # cached values must be reloaded from the database
+                    _account.expire()
+            self.flushes += 1
+        finally:
+            self.lock.release()
+
+    def __update(self, connection, column, cases):
+        """Set `column` of (account id, value) `cases` with one UPDATE"""
+        id_name = Account.sqlmeta.idName
+        connection.query("UPDATE " + Account.sqlmeta.table + " SET "
+                         + Account.sqlmeta.columns[column].dbName
+                         + " = CASE " + id_name + " "
+                         + " ".join(["WHEN " + connection.sqlrepr(account_id)
+                                     + " THEN " + connection.sqlrepr(value)
+                                     for (account_id, value) in cases])
+                         + " END WHERE " + id_name + " IN ("
+                         + ", ".join([connection.sqlrepr(account_id)
+                                      for (account_id, value) in cases])
+                         + ")")
+        self.updates += 1
+
+    def start(self):
+        """Start flushing thread"""
+        self.running = True
+        self.event.clear()
+        self.thread = threading.Thread(target=self.run,
+                                       name="WriteBehindThread")
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def stop(self):
+        """Stop flushing thread"""
+        self.running = False
+        self.event.set()
+        if self.thread is not None:
+            self.thread.join(self.interval)
+            self.thread = None
+
+    def run(self):
+        """Flush pending values every `interval` seconds"""
+        while self.running:
+            self.event.wait(self.interval)
+            if not self.running:
+                break
+            try:
+                self.flush()
+            except Exception:
+                # pending values are kept for the next flush
+                self.__logger.error("Error while writing pending values",
+                                    exc_info=True)
+
+    def get_stats(self):
+        """Return buffer statistics as a dictionary"""
+        self.lock.acquire()
+        try:
+            return {"pending": len(self.pending),
+                    "writes": self.writes,
+                    "flushes": self.flushes,
+                    "updates": self.updates}
+        finally:
+            self.lock.release()
+
+def enable(interval=5):
+    """
+    Enable the write-behind buffer, flushed every `interval` seconds.
+    """
+    buffer = WriteBehindBuffer(interval)
+    if interval > 0:
+        buffer.start()
+    model.write_behind = buffer
+    return buffer
+
+def disable():
+    """Disable the write-behind buffer, writing its pending values"""
+    buffer = model.write_behind
+    if buffer is None:
+        return
+    buffer.stop()
+    buffer.flush()
+    model.write_behind = None
+    # values set while disabling
+    buffer.flush()
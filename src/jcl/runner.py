@@ -32,7 +32,7 @@ import threading
 from jcl.lang import Lang
 from jcl.jabber.component import JCLComponent
 import jcl.model as model
-from jcl.model.account import Account, PresenceAccount, User, LegacyJID
+from jcl.model import migration, registry, writebehind, counters
 
 LOG_FORMATTER = logging.Formatter(fmt="[%(levelname)s] %(asctime)s (%(pathname)s:%(lineno)d): %(message)s")
 
@@ -54,6 +54,17 @@ class JCLRunner(object):
         self.service_jid = "jcl.localhost"
         self.language = "en"
         self.db_url = "sqlite:///var/spool/jabber/jcl.db"
+        self.db_pool_min_size = 1
+        self.db_pool_max_size = 10
+        self.db_pool_idle_timeout = 300
+        self.db_account_registry = "none"
+        self.db_write_behind_interval = 0
+        self.db_account_counters_interval = 0
+        self.db_sqlite_journal_mode = "wal"
+        self.db_sqlite_synchronous = "normal"
+        self.db_sqlite_mmap_size = 67108864
+        self.db_sqlite_cache_size = -16000
+        self.db_sqlite_busy_timeout = 5000
         self.pid_file = "/var/run/jabber/jcl.pid"
         self.log_stdout = False
         self.log_file = None
@@ -145,6 +156,25 @@ class JCLRunner(object):
                                               self.config_file)
                             set_func(config_property)
 
+    def __apply_db_pool_config(self):
+        """Read connection pool, registry, write-behind, account counters
+        and SQLite parameters from [db] section"""
+        for attr in ["db_pool_min_size", "db_pool_max_size",
+                     "db_pool_idle_timeout", "db_write_behind_interval",
+                     "db_account_counters_interval",
+                     "db_sqlite_mmap_size", "db_sqlite_cache_size",
+                     "db_sqlite_busy_timeout"]:
+            option = attr[len("db_"):]
+            if self.config.has_option("db", option):
+                self.set_attr(attr, int(self.config.get("db", option)))
+        for attr in ["db_sqlite_journal_mode", "db_sqlite_synchronous"]:
+            option = attr[len("db_"):]
+            if self.config.has_option("db", option):
+                self.set_attr(attr, self.config.get("db", option))
+        if self.config.has_option("db", "account_registry"):
+            self.set_attr("db_account_registry",
+                          self.config.get("db", "account_registry"))
+
     def configure(self):
         """
         Apply configuration from command line and configuration file.
@@ -172,6 +202,7 @@ class JCLRunner(object):
             self.debug = False
         self.__apply_configfile(commandline_args, cleanopts)
         self.__apply_commandline_args(commandline_args, cleanopts)
+        self.__apply_db_pool_config()
         if self.log_stdout:
             handler = logging.StreamHandler()
             handler.setFormatter(LOG_FORMATTER)
@@ -207,11 +238,53 @@ class JCLRunner(object):
 
     debug = property(get_debug, set_debug)
 
+    def setup_db_connection(self):
+        """Configure model connection pool"""
+        model.db_connection_str = self.db_url
+        model.db_pool_min_size = self.db_pool_min_size
+        model.db_pool_max_size = self.db_pool_max_size
+        model.db_pool_idle_timeout = self.db_pool_idle_timeout
+        model.db_sqlite_pragmas = \
+            [(name, getattr(self, "db_sqlite_" + name))
+             for name in ["journal_mode", "synchronous", "mmap_size",
+                          "cache_size", "busy_timeout"]
+             if getattr(self, "db_sqlite_" + name) not in [None, ""]]
+
     def setup_db(self):
-        User.createTable(ifNotExists=True)
-        Account.createTable(ifNotExists=True)
-        PresenceAccount.createTable(ifNotExists=True)
-        LegacyJID.createTable(ifNotExists=True)
+        """Create or upgrade JCL tables and indexes"""
+        migration.migrate()
+
+    def setup_account_registry(self):
+        """
+        Enable in memory account registry if configured: 'lazy' loads users
+        on first access, 'preload' loads them all at startup.
+        """
+        if self.db_account_registry == "lazy":
+            registry.enable()
+        elif self.db_account_registry == "preload":
+            registry.enable(preload=True)
+        else:
+            registry.disable()
+
+    def setup_write_behind(self):
+        """
+        Enable write-behind buffer of account status, lastlogin and error
+        if a flush interval is configured.
+        """
+        if self.db_write_behind_interval > 0:
+            writebehind.enable(self.db_write_behind_interval)
+        else:
+            writebehind.disable()
+
+    def setup_account_counters(self):
+        """
+        Enable counters of registered, disabled and online accounts if a
+        reconciliation interval is configured.
+        """
+        if self.db_account_counters_interval > 0:
+            counters.enable(self.db_account_counters_interval)
+        else:
+            counters.disable()
 
     def setup_pidfile(self):
         pidfile = open(self.pid_file, "w")
@@ -224,10 +297,15 @@ class JCLRunner(object):
         else:
             try:
                 self.setup_pidfile()
-                model.db_connection_str = self.db_url
+                self.setup_db_connection()
                 model.db_connect()
-                self.setup_db()
-                model.db_disconnect()
+                try:
+                    self.setup_db()
+                finally:
+                    model.db_disconnect()
+                self.setup_account_registry()
+                self.setup_write_behind()
+                self.setup_account_counters()
                 self.logger.debug(self.component_name + " v" +
                                   self.component_version + " is starting ...")
                 restart = True
@@ -236,6 +314,8 @@ class JCLRunner(object):
                     self.wait_event.wait(time_to_wait)
                 self.logger.debug(self.component_name + " is exiting")
             finally:
+                counters.disable()
+                writebehind.disable()
                 if os.path.exists(self.pid_file):
                     os.remove(self.pid_file)
 
@@ -259,7 +339,7 @@ class JCLRunner(object):
         from IPython.Shell import IPShellEmbed
         # pre-import jcl.model.account to be used in the shell
         import jcl.model.account as account
-        model.db_connection_str = self.db_url
+        self.setup_db_connection()
         model.db_connect()
         self.setup_db()
         ipshell = IPShellEmbed(["-pi1", self.component_short_name + "[\\#]: "],
@@ -9,7 +9,6 @@ import types
 import libxml2
 import logging
 
-from sqlobject.dbconnection import TheURIOpener
 import jcl.model
 
 if sys.platform == "win32":
@@ -476,9 +475,8 @@ class JCLTestCase(unittest.TestCase):
         jcl.model.db_connect()
         for table in self.tables:
             table.dropTable(ifExists=True)
-        del TheURIOpener.cachedURIs[self.db_url]
-        jcl.model.hub.threadConnection.close()
         jcl.model.db_disconnect()
+        jcl.model.db_close()
         if os.path.exists(self.db_path):
             os.unlink(self.db_path)
 
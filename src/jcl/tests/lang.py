@@ -21,6 +21,7 @@
 ##
 
 import unittest
+from jcl import lang
 from jcl.lang import Lang
 
 from pyxmpp.iq import Iq
@@ -69,6 +70,27 @@ class Lang_TestCase(unittest.TestCase):
         self.lang = Lang("fr")
         self.assertEquals(self.lang.get_default_lang_class(), Lang.fr)
 
+    def test_get_lang_class_cached(self):
+        lang_class = self.lang.get_lang_class("fr_FR")
+        self.assertEquals(self.lang.lang_classes["fr_FR"], Lang.fr)
+        self.assertTrue(self.lang.get_lang_class("fr_FR") is lang_class)
+
+    def test_get_catalog(self):
+        self.assertTrue(Lang.en in lang.catalogs)
+        catalog = lang.get_catalog(Lang.fr)
+        self.assertEquals(catalog["account_name"], Lang.fr.account_name)
+        self.assertTrue(lang.get_catalog(Lang.fr) is catalog)
+        for name in dir(Lang.en):
+            if not name.startswith("_"):
+                self.assertEquals(catalog[name], getattr(Lang.fr, name))
+
+    def test_get_label(self):
+        self.assertEquals(lang.get_label(Lang.en, "account_name"),
+                          Lang.en.account_name)
+        self.assertEquals(lang.get_label(Lang.en, "unknown", "default"),
+                          "default")
+        self.assertEquals(lang.get_label(Lang.en, "unknown"), None)
+
 class Language_TestCase(unittest.TestCase):
     """Test language classes"""
 
@@ -195,6 +217,11 @@ class Language_TestCase(unittest.TestCase):
         self.assertNotEquals(self.lang_class.field_disabled_users_num, None)
         self.assertNotEquals(self.lang_class.field_online_users_num, None)
 
+        self.assertNotEquals(self.lang_class.command_user_stats, None)
+        self.assertNotEquals(self.lang_class.command_user_stats_1_description,
+                             None)
+        self.assertNotEquals(self.lang_class.field_roster_size, None)
+
         self.assertNotEquals(self.lang_class.field_max_items, None)
         self.assertNotEquals(self.lang_class.field_registered_users_list, None)
         self.assertNotEquals(self.lang_class.field_disabled_users_list, None)
@@ -238,6 +265,12 @@ class Language_TestCase(unittest.TestCase):
         self.assertNotEquals(self.lang_class.field_240_sec, None)
         self.assertNotEquals(self.lang_class.field_300_sec, None)
 
+        self.assertNotEquals(self.lang_class.job_pending, None)
+        self.assertNotEquals(self.lang_class.job_running, None)
+        self.assertNotEquals(self.lang_class.job_completed, None)
+        self.assertNotEquals(self.lang_class.job_canceled, None)
+        self.assertNotEquals(self.lang_class.job_failed, None)
+
         self.assertNotEquals(self.lang_class.welcome_message_subject, None)
 
         self.assertNotEquals(self.lang_class.account_disabled, None)
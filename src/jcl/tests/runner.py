@@ -46,6 +46,7 @@ class JCLRunner_TestCase(unittest.TestCase):
     def tearDown(self):
         self.runner = None
         sys.argv = [""]
+        model.db_sqlite_pragmas = []
 
     def test_configure_default(self):
         self.runner.configure()
@@ -56,6 +57,14 @@ class JCLRunner_TestCase(unittest.TestCase):
         self.assertEquals(self.runner.service_jid, "jcl.localhost")
         self.assertEquals(self.runner.language, "en")
         self.assertEquals(self.runner.db_url, "sqlite:///var/spool/jabber/jcl.db")
+        self.assertEquals(self.runner.db_pool_min_size, 1)
+        self.assertEquals(self.runner.db_pool_max_size, 10)
+        self.assertEquals(self.runner.db_pool_idle_timeout, 300)
+        self.assertEquals(self.runner.db_account_registry, "none")
+        self.assertEquals(self.runner.db_write_behind_interval, 0)
+        self.assertEquals(self.runner.db_account_counters_interval, 0)
+        self.assertEquals(self.runner.db_sqlite_journal_mode, "wal")
+        self.assertEquals(self.runner.db_sqlite_busy_timeout, 5000)
         self.assertEquals(self.runner.pid_file, "/var/run/jabber/jcl.pid")
         self.assertFalse(self.runner.debug)
         self.assertEquals(self.runner.logger.getEffectiveLevel(),
@@ -70,6 +79,15 @@ class JCLRunner_TestCase(unittest.TestCase):
         self.assertEquals(self.runner.service_jid, "test_jcl.localhost")
         self.assertEquals(self.runner.language, "test_en")
         self.assertEquals(self.runner.db_url, "test_sqlite://root@localhost/var/spool/jabber/test_jcl.db")
+        self.assertEquals(self.runner.db_pool_min_size, 2)
+        self.assertEquals(self.runner.db_pool_max_size, 5)
+        self.assertEquals(self.runner.db_pool_idle_timeout, 60)
+        self.assertEquals(self.runner.db_account_registry, "preload")
+        self.assertEquals(self.runner.db_write_behind_interval, 10)
+        self.assertEquals(self.runner.db_account_counters_interval, 60)
+        self.assertEquals(self.runner.db_sqlite_journal_mode, "delete")
+        self.assertEquals(self.runner.db_sqlite_synchronous, "normal")
+        self.assertEquals(self.runner.db_sqlite_busy_timeout, 1000)
         self.assertEquals(self.runner.pid_file, "/var/run/jabber/test_jcl.pid")
         self.assertFalse(self.runner.debug)
         self.assertEquals(self.runner.logger.getEffectiveLevel(),
@@ -271,6 +289,50 @@ class JCLRunner_TestCase(unittest.TestCase):
         self.assertFalse(os.access("/tmp/jcl.pid", os.F_OK))
         self.assertEquals(self.i, 2)
 
+    def test_setup_db_connection(self):
+        self.runner.db_url = "sqlite:///tmp/test_jcl.db"
+        self.runner.db_pool_min_size = 2
+        self.runner.db_pool_max_size = 5
+        self.runner.db_pool_idle_timeout = 60
+        self.runner.setup_db_connection()
+        self.assertEquals(model.db_connection_str, "sqlite:///tmp/test_jcl.db")
+        self.assertEquals(model.db_pool_min_size, 2)
+        self.assertEquals(model.db_pool_max_size, 5)
+        self.assertEquals(model.db_pool_idle_timeout, 60)
+        self.assertEquals(model.db_sqlite_pragmas[0], ("journal_mode", "wal"))
+        self.assertEquals(len(model.db_sqlite_pragmas), 5)
+        model.db_pool_min_size = 1
+        model.db_pool_max_size = 10
+        model.db_pool_idle_timeout = 300
+        model.db_sqlite_pragmas = []
+
+    def test_setup_account_registry(self):
+        self.runner.db_account_registry = "lazy"
+        self.runner.setup_account_registry()
+        self.assertNotEquals(model.account_registry, None)
+        self.assertFalse(model.account_registry.complete)
+        self.runner.db_account_registry = "none"
+        self.runner.setup_account_registry()
+        self.assertEquals(model.account_registry, None)
+
+    def test_setup_write_behind(self):
+        self.runner.db_write_behind_interval = 10
+        self.runner.setup_write_behind()
+        self.assertNotEquals(model.write_behind, None)
+        self.assertEquals(model.write_behind.interval, 10)
+        self.runner.db_write_behind_interval = 0
+        self.runner.setup_write_behind()
+        self.assertEquals(model.write_behind, None)
+
+    def test_setup_account_counters(self):
+        self.runner.db_account_counters_interval = 60
+        self.runner.setup_account_counters()
+        self.assertNotEquals(model.account_counters, None)
+        self.assertEquals(model.account_counters.interval, 60)
+        self.runner.db_account_counters_interval = 0
+        self.runner.setup_account_counters()
+        self.assertEquals(model.account_counters, None)
+
     def test__get_help(self):
         self.assertNotEquals(self.runner._get_help(), None)
 